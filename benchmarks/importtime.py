@@ -0,0 +1,54 @@
+"""
+Benchmark for the time it takes to import the package in a fresh interpreter, which short-lived workers pay on every start
+
+fhir.resources, html2text, and fhirpathpy are only imported by the code paths that need them, so importing fhirsearchhelper loads none of them. Run with:
+
+    python -m benchmarks.importtime --repeat 10
+"""
+
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+
+# Dependencies that importing fhirsearchhelper must not load
+DEFERRED_MODULES: tuple[str, ...] = ("fhir.resources", "fhir_core", "html2text", "fhirpathpy")
+
+IMPORT_SCRIPT: str = """
+import json, logging, sys, time
+start = time.perf_counter()
+import {module}
+seconds = time.perf_counter() - start
+print(json.dumps({{"seconds": seconds, "modules": sorted(sys.modules), "handlers": len(logging.getLogger("fhirsearchhelper").handlers)}}))
+"""
+
+
+def measure_import(module: str = "fhirsearchhelper") -> dict:
+    """Function to import module in a new interpreter, returning the seconds it took, the modules it loaded, and the handlers on the package logger"""
+
+    result: subprocess.CompletedProcess = subprocess.run([sys.executable, "-c", IMPORT_SCRIPT.format(module=module)], capture_output=True, text=True, check=True)
+    return json.loads(result.stdout)
+
+
+def get_deferred_modules_loaded(loaded_modules: list[str]) -> list[str]:
+    return [name for name in loaded_modules if any([name == deferred or name.startswith(f"{deferred}.") for deferred in DEFERRED_MODULES])]
+
+
+def main(argv: list[str] | None = None) -> list[float]:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Benchmark importing fhirsearchhelper in a fresh interpreter")
+    parser.add_argument("--module", default="fhirsearchhelper", help="The module to import")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of fresh interpreters to import in, the minimum is reported alongside the mean")
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    measurements: list[dict] = [measure_import(args.module) for _ in range(args.repeat)]
+    seconds: list[float] = [measurement["seconds"] for measurement in measurements]
+    print(f"import {args.module}: min {min(seconds) * 1000:.1f} ms, mean {statistics.mean(seconds) * 1000:.1f} ms over {args.repeat} runs")
+    deferred_loaded: list[str] = get_deferred_modules_loaded(measurements[0]["modules"])
+    if deferred_loaded:
+        print(f"Loaded at import, but should be deferred: {', '.join(deferred_loaded)}")
+    return seconds
+
+
+if __name__ == "__main__":
+    main()
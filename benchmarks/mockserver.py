@@ -0,0 +1,234 @@
+"""File for an in-process mock FHIR server that serves synthetic searchsets and their referenced resources for benchmarking"""
+
+import asyncio
+import base64
+import json
+import math
+import time
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from typing import Any
+
+import httpx
+
+EPIC_CAPABILITY_STATEMENT_PATH: Path = Path(__file__).parents[1] / "fhirsearchhelper" / "capabilitystatements" / "epic_r4_metadata_edited.json"
+RXNORM_SYSTEM: str = "http://www.nlm.nih.gov/research/umls/rxnorm"
+FIRST_RXNORM_CODE: int = 1049221
+START_TIME: datetime = datetime(2020, 1, 1, tzinfo=timezone.utc)
+
+
+class MockFHIRServer:
+    """
+    Stand-in for a FHIR server built on httpx.MockTransport, so the whole search pipeline can run without a network.
+
+    Every search returns count synthetic resources of the searched type for any patient, page_size at a time with Bundle.link[relation=next]. The
+    server also answers the lookups the expansions make: MedicationRequests reference one of count // 10 Medications and Conditions one of count // 10
+    Encounters, so lookups are shared the way they are for real patients, while every DocumentReference has its own Binary. The Epic
+    CapabilityStatement is served at <base_url>/metadata. MedicationRequest searches with _include=MedicationRequest:medication also return the
+    Medications referenced from each page. Resource index i is dated START_TIME plus i hours, and searches with date=ge|gt|lt|le<date> only return the
+    resources dated in that range. Since every resource is dated, searches with date:missing=true return none.
+
+    Parameters:
+    - count (int): The number of resources returned by each search.
+    - page_size (int, optional): The number of resources on each searchset page (default: 1000).
+    - latency (float, optional): The number of seconds added to every response (default: 0).
+    - binary_size (int, optional): The approximate size in bytes of the HTML note in each Binary (default: 4096).
+    - base_url (str, optional): The base url the server answers for.
+    - batch (bool, optional): Add the batch interaction to the CapabilityStatement and answer batch Bundles of reads POSTed to base_url (default: False).
+
+    requests counts the requests served by resource type (or "metadata" or "batch").
+    """
+
+    def __init__(self, count: int, page_size: int = 1000, latency: float = 0.0, binary_size: int = 4096, base_url: str = "https://fhir.benchmark.local/R4", batch: bool = False) -> None:
+        self.count: int = count
+        self.page_size: int = page_size
+        self.latency: float = latency
+        self.binary_size: int = binary_size
+        self.base_url: str = base_url
+        self.reference_count: int = max(count // 10, 1)
+        self.requests: Counter[str] = Counter()
+        with open(EPIC_CAPABILITY_STATEMENT_PATH, "r") as fopen:
+            self.capability_statement: dict = json.load(fopen)
+        if batch:
+            self.capability_statement["rest"][0]["interaction"] = [{"code": "batch"}]
+
+    def client(self) -> httpx.Client:
+        return httpx.Client(transport=httpx.MockTransport(self.handle))
+
+    def async_client(self) -> httpx.AsyncClient:
+        return httpx.AsyncClient(transport=httpx.MockTransport(self.handle_async))
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            time.sleep(self.latency)
+        return self.route(request)
+
+    async def handle_async(self, request: httpx.Request) -> httpx.Response:
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        return self.route(request)
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        if request.method == "POST":
+            self.requests["batch"] += 1
+            return self.batch(json.loads(request.content))
+
+        path_parts: list[str] = request.url.path.removeprefix(httpx.URL(self.base_url).path).strip("/").split("/")
+        resource_type: str = path_parts[0]
+        self.requests[resource_type] += 1
+
+        if resource_type == "metadata":
+            return httpx.Response(200, json=self.capability_statement)
+        if len(path_parts) == 2:
+            return self.read(resource_type, path_parts[1])
+        return httpx.Response(
+            200,
+            json=self.search_page(
+                resource_type,
+                int(request.url.params.get("page", 1)),
+                request.url.params.get_list("_include"),
+                request.url.params.get_list("date"),
+                request.url.params.get("date:missing") == "true",
+            ),
+        )
+
+    def read(self, resource_type: str, resource_id: str) -> httpx.Response:
+        index: int = int(resource_id.rsplit("-", 1)[1])
+        match resource_type:
+            case "Medication":
+                return httpx.Response(200, json=make_medication(index))
+            case "Encounter":
+                return httpx.Response(200, json=make_encounter(index))
+            case "Binary":
+                return httpx.Response(200, json=make_binary(index, self.binary_size))
+        return httpx.Response(404, json={"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-found"}]})
+
+    def batch(self, batch_bundle: dict[str, Any]) -> httpx.Response:
+        """Function to answer a batch Bundle of reads with a batch-response Bundle"""
+
+        if "batch" not in [interaction["code"] for interaction in self.capability_statement["rest"][0].get("interaction", [])]:
+            return httpx.Response(405, json={"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "not-supported"}]})
+        response_entries: list[dict[str, Any]] = []
+        for entry in batch_bundle.get("entry", []):
+            resource_type, resource_id = entry["request"]["url"].split("/")
+            read_response: httpx.Response = self.read(resource_type, resource_id)
+            response_entries.append({"resource": read_response.json(), "response": {"status": f"{read_response.status_code} {read_response.reason_phrase}"}})
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "batch-response", "entry": response_entries})
+
+    def search_page(self, resource_type: str, page: int, includes: list[str] | None = None, dates: list[str] | None = None, date_missing: bool = False) -> dict[str, Any]:
+        """Function to build one page of the searchset for resource_type, with the Medications of the page when includes asks for them"""
+
+        matched: range = range(0) if date_missing else get_date_range(dates or [], self.count)
+        start: int = matched.start + (page - 1) * self.page_size
+        end: int = min(start + self.page_size, matched.stop)
+        bundle: dict[str, Any] = synthetic_bundle(resource_type, range(start, end), self.reference_count, self.base_url)
+        bundle["total"] = len(matched)
+        extra_query: str = "".join(f"&_include={include}" for include in includes or []) + "".join(f"&date={date}" for date in dates or []) + ("&date:missing=true" if date_missing else "")
+        bundle["link"] = [{"relation": "self", "url": f"{self.base_url}/{resource_type}?page={page}{extra_query}"}]
+        if end < matched.stop:
+            bundle["link"].append({"relation": "next", "url": f"{self.base_url}/{resource_type}?page={page + 1}{extra_query}"})
+        if resource_type == "MedicationRequest" and "MedicationRequest:medication" in (includes or []):
+            medication_indexes: list[int] = sorted({index % self.reference_count for index in range(start, end)})
+            bundle["entry"].extend({"fullUrl": f"{self.base_url}/Medication/med-{index}", "resource": make_medication(index), "search": {"mode": "include"}} for index in medication_indexes)
+        return bundle
+
+
+def get_date_range(dates: list[str], count: int) -> range:
+    """Function to get the indexes of the resources dated within every date=<prefix><date> in dates, where resource index i is dated START_TIME plus i hours"""
+
+    start, stop = 0, count
+    for date_param in dates:
+        prefix, value = date_param[:2], date_param[2:]
+        bound: datetime = datetime.fromisoformat(value)
+        if bound.tzinfo is None:
+            bound = bound.replace(tzinfo=timezone.utc)
+        hours: float = (bound - START_TIME).total_seconds() / 3600
+        match prefix:
+            case "ge":
+                start = max(start, math.ceil(hours))
+            case "gt":
+                start = max(start, math.floor(hours) + 1)
+            case "lt":
+                stop = min(stop, math.ceil(hours))
+            case "le":
+                stop = min(stop, math.floor(hours) + 1)
+    return range(max(start, 0), max(min(stop, count), 0))
+
+
+def synthetic_bundle(resource_type: str, indexes: range, reference_count: int, base_url: str = "https://fhir.benchmark.local/R4") -> dict[str, Any]:
+    """Function to build a searchset Bundle of synthetic resources of resource_type, one per index"""
+
+    return {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": len(indexes),
+        "entry": [
+            {"fullUrl": f"{base_url}/{resource_type}/{resource['id']}", "resource": resource, "search": {"mode": "match"}}
+            for resource in (make_resource(resource_type, index, reference_count) for index in indexes)
+        ],
+    }
+
+
+def make_resource(resource_type: str, index: int, reference_count: int) -> dict[str, Any]:
+    """Function to build a synthetic resource whose searchable elements vary with index"""
+
+    subject: dict[str, str] = {"reference": "Patient/123"}
+    recorded: str = (START_TIME + timedelta(hours=index)).isoformat()
+    match resource_type:
+        case "Observation":
+            return {
+                "resourceType": "Observation",
+                "id": f"obs-{index}",
+                "status": "final",
+                "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/observation-category", "code": "laboratory"}]}],
+                "code": {"coding": [{"system": "http://loinc.org", "code": "789-8"}], "text": "Erythrocytes"},
+                "subject": subject,
+                "effectiveDateTime": recorded,
+                "valueQuantity": {"value": index % 10, "unit": "10*6/uL", "system": "http://unitsofmeasure.org", "code": "10*6/uL"},
+            }
+        case "Condition":
+            return {
+                "resourceType": "Condition",
+                "id": f"cond-{index}",
+                "clinicalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-clinical", "code": "active" if index % 2 else "resolved"}]},
+                "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-category", "code": "encounter-diagnosis"}]}],
+                "code": {"coding": [{"system": "http://snomed.info/sct", "code": "38341003"}], "text": "Hypertension"},
+                "subject": subject,
+                "encounter": {"reference": f"Encounter/enc-{index % reference_count}"},
+            }
+        case "MedicationRequest":
+            return {
+                "resourceType": "MedicationRequest",
+                "id": f"medreq-{index}",
+                "status": "active",
+                "intent": "order",
+                "subject": subject,
+                "authoredOn": recorded,
+                "medicationReference": {"reference": f"Medication/med-{index % reference_count}"},
+            }
+        case "DocumentReference":
+            return {
+                "resourceType": "DocumentReference",
+                "id": f"doc-{index}",
+                "status": "current",
+                "category": [{"coding": [{"system": "http://hl7.org/fhir/us/core/CodeSystem/us-core-documentreference-category", "code": "clinical-note"}]}],
+                "subject": subject,
+                "date": recorded,
+                "content": [{"attachment": {"contentType": "text/html", "url": f"Binary/bin-{index}"}}],
+            }
+    raise ValueError(f"There is no synthetic resource for {resource_type}")
+
+
+def make_medication(index: int) -> dict[str, Any]:
+    return {"resourceType": "Medication", "id": f"med-{index}", "code": {"coding": [{"system": RXNORM_SYSTEM, "code": str(FIRST_RXNORM_CODE + index)}]}}
+
+
+def make_encounter(index: int) -> dict[str, Any]:
+    return {"resourceType": "Encounter", "id": f"enc-{index}", "status": "finished", "class": {"code": "AMB"}, "period": {"start": (START_TIME + timedelta(days=index)).isoformat()}}
+
+
+def make_binary(index: int, binary_size: int) -> dict[str, Any]:
+    paragraph: str = f"<p>Patient {index} is <b>stable</b>. Continue current medications.</p>"
+    html: str = f"<html><body><h1>Note {index}</h1>{paragraph * max(binary_size // len(paragraph), 1)}</body></html>"
+    return {"resourceType": "Binary", "id": f"bin-{index}", "contentType": "text/html", "data": base64.b64encode(html.encode("utf-8")).decode("utf-8")}
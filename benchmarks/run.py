@@ -0,0 +1,184 @@
+"""
+Benchmarks for the search pipeline against the in-process mock FHIR server
+
+Each resource type is benchmarked stage by stage (gap analysis, gap filtering, validation, reference expansion) on a single synthetic page, and end to
+end through run_fhir_query, run_fhir_query(raw=True), and run_fhir_query_async with paging. Run with:
+
+    python -m benchmarks.run --sizes 10 100 1000 10000 --latency 5
+
+See --help for all of the options. --output writes the results as JSON so runs can be compared.
+"""
+
+import argparse
+import asyncio
+import copy
+import json
+import logging
+import statistics
+import time
+from dataclasses import asdict, dataclass
+from typing import Any, Callable
+
+from fhir.resources.R4B.bundle import Bundle
+
+from fhirsearchhelper.helpers import conditionhelper, documenthelper, medicationhelper
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement_file
+from fhirsearchhelper.helpers.conditionhelper import expand_condition_onset_in_bundle_json
+from fhirsearchhelper.helpers.documenthelper import expand_document_references_in_bundle_json
+from fhirsearchhelper.helpers.fhirfilter import filter_bundle_json
+from fhirsearchhelper.helpers.gapanalysis import run_gap_analysis
+from fhirsearchhelper.helpers.medicationhelper import expand_medication_references_in_bundle_json
+from fhirsearchhelper.main import parse_search_query, run_fhir_query, run_fhir_query_async
+from fhirsearchhelper.models.models import SupportedSearchParams
+
+from .mockserver import FIRST_RXNORM_CODE, RXNORM_SYSTEM, MockFHIRServer, synthetic_bundle
+
+# Each query has a search parameter the Epic CapabilityStatement does not support, so gap filtering has work to do
+BENCHMARK_QUERIES: dict[str, str] = {
+    "Observation": "Observation?patient=123&category=laboratory&value-quantity=ge5",
+    "Condition": "Condition?patient=123&category=encounter-diagnosis&code=http://snomed.info/sct|38341003",
+    "MedicationRequest": f"MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}",
+    "DocumentReference": "DocumentReference?patient=123&category=clinical-note&status=current",
+}
+QUERY_HEADERS: dict[str, str] = {"Authorization": "Bearer benchmark"}
+
+
+@dataclass
+class StageTiming:
+    """The timings of one benchmarked stage, in seconds, over every repeat"""
+
+    resource_type: str
+    size: int
+    stage: str
+    min_seconds: float
+    mean_seconds: float
+    requests: int
+
+    @property
+    def entries_per_second(self) -> float:
+        return self.size / self.min_seconds if self.min_seconds else float("inf")
+
+
+def clear_reference_caches() -> None:
+    for cache in [medicationhelper.cached_medication_resources, conditionhelper.cached_encounter_resources, documenthelper.cached_binary_resources]:
+        if cache is not None:
+            cache.clear()
+
+
+def measure(resource_type: str, size: int, stage: str, server: MockFHIRServer, run: Callable[[Any], Any], setup: Callable[[], Any] | None = None, repeat: int = 3) -> StageTiming:
+    """Function to time run over repeat runs, passing it the result of setup which is called (untimed) before each run with empty reference caches"""
+
+    durations: list[float] = []
+    for _ in range(repeat):
+        clear_reference_caches()
+        argument: Any = setup() if setup else None
+        server.requests.clear()
+        start: float = time.perf_counter()
+        run(argument)
+        durations.append(time.perf_counter() - start)
+    return StageTiming(resource_type, size, stage, min(durations), statistics.mean(durations), sum(server.requests.values()))
+
+
+def benchmark_resource_type(resource_type: str, size: int, latency: float, page_size: int, repeat: int, supported_search_params: list[SupportedSearchParams]) -> list[StageTiming]:
+    """Function to benchmark every stage of the pipeline for one resource type and result size"""
+
+    server: MockFHIRServer = MockFHIRServer(count=size, page_size=page_size, latency=latency)
+    query: str = f"{server.base_url}/{BENCHMARK_QUERIES[resource_type]}"
+    _, search_params = parse_search_query(query)
+    gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=search_params)
+    page: dict[str, Any] = synthetic_bundle(resource_type, range(size), server.reference_count, server.base_url)
+    client = server.client()
+
+    timings: list[StageTiming] = [
+        measure(resource_type, size, "gap_analysis", server, lambda _: run_gap_analysis(supported_search_params=supported_search_params, query_search_params=search_params), repeat=repeat),
+        measure(resource_type, size, "filter", server, lambda _: filter_bundle_json(bundle_json=page, search_params=search_params, gap_analysis_output=gap_output), repeat=repeat),
+        measure(resource_type, size, "validate", server, lambda _: Bundle.model_validate(page), repeat=repeat),
+    ]
+
+    expansions: dict[str, Callable[..., dict[str, Any]]] = {
+        "MedicationRequest": expand_medication_references_in_bundle_json,
+        "Condition": expand_condition_onset_in_bundle_json,
+        "DocumentReference": expand_document_references_in_bundle_json,
+    }
+    if resource_type in expansions:
+        expand: Callable[..., dict[str, Any]] = expansions[resource_type]
+        timings.append(
+            measure(
+                resource_type,
+                size,
+                "expand",
+                server,
+                lambda bundle_json: expand(client=client, bundle_json=bundle_json, base_url=server.base_url, query_headers=QUERY_HEADERS),
+                setup=lambda: copy.deepcopy(page),
+                repeat=repeat,
+            )
+        )
+
+    query_arguments: dict[str, Any] = {"query": query, "query_headers": QUERY_HEADERS, "capability_statement_url": f"{server.base_url}/metadata", "follow_next": True}
+    timings.append(measure(resource_type, size, "end_to_end", server, lambda _: run_fhir_query(client=client, **query_arguments), repeat=repeat))
+    timings.append(measure(resource_type, size, "end_to_end_raw", server, lambda _: run_fhir_query(client=client, raw=True, **query_arguments), repeat=repeat))
+
+    async def run_async() -> None:
+        async with server.async_client() as async_client:
+            await run_fhir_query_async(client=async_client, **query_arguments)
+
+    timings.append(measure(resource_type, size, "end_to_end_async", server, lambda _: asyncio.run(run_async()), repeat=repeat))
+
+    return timings
+
+
+def run_benchmarks(sizes: list[int], resource_types: list[str], latency: float = 0.0, page_size: int = 1000, repeat: int = 3) -> list[StageTiming]:
+    """
+    Function to run the benchmarks for every combination of resource type and size
+
+    Parameters:
+    - sizes (list[int]): The numbers of resources returned by each search.
+    - resource_types (list[str]): The resource types to benchmark, keys of BENCHMARK_QUERIES.
+    - latency (float, optional): The number of seconds the mock server adds to every response (default: 0).
+    - page_size (int, optional): The number of resources on each searchset page (default: 1000).
+    - repeat (int, optional): The number of times each stage is run (default: 3).
+    """
+
+    supported_search_params: list[SupportedSearchParams] = get_supported_search_params(load_capability_statement_file("epic_r4_metadata_edited.json"))
+    timings: list[StageTiming] = []
+    for resource_type in resource_types:
+        for size in sizes:
+            timings.extend(benchmark_resource_type(resource_type, size, latency, page_size, repeat, supported_search_params))
+    return timings
+
+
+def format_timings(timings: list[StageTiming]) -> str:
+    """Function to format benchmark results as a table"""
+
+    lines: list[str] = [f"{'resource type':<18} {'size':>6} {'stage':<17} {'min ms':>10} {'mean ms':>10} {'entries/s':>11} {'requests':>9}"]
+    for timing in timings:
+        lines.append(
+            f"{timing.resource_type:<18} {timing.size:>6} {timing.stage:<17} {timing.min_seconds * 1000:>10.2f} {timing.mean_seconds * 1000:>10.2f} {timing.entries_per_second:>11.0f} {timing.requests:>9}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv: list[str] | None = None) -> list[StageTiming]:
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Benchmark the fhirsearchhelper pipeline against an in-process mock FHIR server")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10, 100, 1000, 10000], help="Numbers of resources returned by each search")
+    parser.add_argument("--resource-types", nargs="+", default=list(BENCHMARK_QUERIES), choices=list(BENCHMARK_QUERIES), help="Resource types to benchmark")
+    parser.add_argument("--latency", type=float, default=0.0, help="Milliseconds added to every mock server response")
+    parser.add_argument("--page-size", type=int, default=1000, help="Resources per searchset page")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs of each stage, the minimum is reported alongside the mean")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    logging.getLogger("fhirsearchhelper").setLevel(logging.WARNING)
+
+    timings: list[StageTiming] = run_benchmarks(sizes=args.sizes, resource_types=args.resource_types, latency=args.latency / 1000, page_size=args.page_size, repeat=args.repeat)
+    print(format_timings(timings))
+
+    if args.output:
+        with open(args.output, "w") as fopen:
+            json.dump([asdict(timing) | {"entries_per_second": timing.entries_per_second} for timing in timings], fopen, indent=2)
+
+    return timings
+
+
+if __name__ == "__main__":
+    main()
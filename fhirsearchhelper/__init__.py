@@ -1 +1,4 @@
-from .main import run_fhir_query
+from .main import run_fhir_query, run_fhir_query_async, run_fhir_query_pages
+from .session import FHIRSearchSession
+
+__all__ = ["run_fhir_query", "run_fhir_query_async", "run_fhir_query_pages", "FHIRSearchSession"]
@@ -0,0 +1,216 @@
+"""File to spill large Binary payloads to disk while they are streamed, and to memory-map them back"""
+
+from __future__ import annotations
+
+import logging
+import mmap
+import os
+import tempfile
+from pathlib import Path
+from typing import TYPE_CHECKING, Any
+from urllib.parse import urlparse
+from urllib.request import url2pathname
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.attachment import Attachment
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.binaryspill")
+
+COPY_CHUNK_SIZE: int = 1024 * 1024
+BASE64_ALPHABET: bytes = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="
+JSON_WHITESPACE: bytes = b" \t\r\n"
+# The extension of an expanded attachment whose content was spilled, with the file URI of the spill file in valueUri. Attachment.url keeps the Binary url.
+SPILL_EXTENSION_URL: str = "https://github.com/SmartChartSuite/FHIRSearchHelper/binary-spill-file"
+
+
+class BinarySpillWriter:
+    """
+    Collects a streamed Binary response in memory until it grows past threshold bytes, then moves it to a file in spill_dir and keeps writing there.
+
+    Parameters:
+    - spill_dir (str): The directory spill files are written to.
+    - threshold (int): The number of bytes kept in memory before spilling to disk.
+    """
+
+    def __init__(self, spill_dir: str, threshold: int) -> None:
+        self.spill_dir: str = spill_dir
+        self.threshold: int = threshold
+        self.buffer: bytearray = bytearray()
+        self.file: Any | None = None
+        self.content_size: int = 0
+
+    @property
+    def spilled(self) -> bool:
+        return self.file is not None
+
+    def write(self, chunk: bytes) -> None:
+        if self.file is None:
+            if len(self.buffer) + len(chunk) <= self.threshold:
+                self.buffer += chunk
+                return
+            self.file = tempfile.NamedTemporaryFile(dir=self.spill_dir, prefix="binary-", suffix=".part", delete=False)
+            self.file.write(self.buffer)
+            self.buffer = bytearray()
+        self.file.write(chunk)
+
+    def finish(self, is_json: bool) -> str:
+        """
+        Close the spill file and return the path of the file holding the content of the Binary, as Attachment.data would hold it in memory
+
+        That is the base64 Binary.data of a JSON Binary, and the response body otherwise. content_size is set to the size of the content in bytes.
+        """
+
+        assert self.file is not None
+        self.file.close()
+        raw_path: str = self.file.name
+        content_path: str = raw_path.removesuffix(".part") + ".bin"
+        if is_json:
+            try:
+                self.content_size = extract_json_binary_data(raw_path, content_path)
+            except BaseException:
+                if os.path.exists(content_path):
+                    os.remove(content_path)
+                raise
+            finally:
+                os.remove(raw_path)
+        else:
+            os.replace(raw_path, content_path)
+            self.content_size = os.path.getsize(content_path)
+        logger.debug(f"Spilled Binary content of {self.content_size} bytes to {content_path}")
+        return content_path
+
+    def discard(self) -> None:
+        """Remove the spill file of a response that could not be read completely"""
+
+        if self.file is not None:
+            self.file.close()
+            os.remove(self.file.name)
+            self.file = None
+
+
+def extract_json_binary_data(raw_path: str, content_path: str) -> int:
+    """
+    Function to write the base64 Binary.data of a JSON Binary resource stored at raw_path to content_path, returning the size of the decoded content
+
+    The resource is memory-mapped and copied in chunks, so the JSON is never fully held in memory. Raises ValueError if the resource has no top-level
+    data element or its value is not base64.
+    """
+
+    with open(raw_path, "rb") as raw_file, mmap.mmap(raw_file.fileno(), 0, access=mmap.ACCESS_READ) as raw:
+        start, end = find_top_level_string(raw, b"data")
+        if start == -1:
+            raise ValueError(f"The Binary resource in {raw_path} does not have a data element")
+
+        data_length: int = 0
+        with open(content_path, "wb") as content_file:
+            for offset in range(start, end, COPY_CHUNK_SIZE):
+                # Base64 only needs escaping for a JSON-escaped solidus (\/), so dropping backslashes leaves the plain base64 alphabet
+                chunk: bytes = raw[offset : min(offset + COPY_CHUNK_SIZE, end)].replace(b"\\", b"")
+                if chunk.translate(None, BASE64_ALPHABET):
+                    raise ValueError(f"The data element of the Binary resource in {raw_path} is not base64")
+                content_file.write(chunk)
+                data_length += len(chunk)
+        if data_length % 4:
+            raise ValueError(f"The data element of the Binary resource in {raw_path} is not base64")
+        padding: int = raw[max(end - 2, start) : end].count(b"=")
+    return data_length * 3 // 4 - padding
+
+
+def find_top_level_string(raw: mmap.mmap, key: bytes) -> tuple[int, int]:
+    """
+    Function to find the string value of key in the top-level object of a JSON document, returning the offsets of its first and past its last character
+
+    Only the structure between strings is read byte by byte. Strings are skipped with find, so long values such as other base64 elements are not looped
+    over, and keys of nested objects or string values that happen to equal key are not matched. Returns (-1, -1) if the top-level object has no key.
+    """
+
+    depth: int = 0
+    previous: int = 0
+    position: int = 0
+    while position < len(raw):
+        character: int = raw[position]
+        if character == ord('"'):
+            string_end: int = find_string_end(raw, position)
+            if depth == 1 and previous in b"{," and raw[position + 1 : string_end] == key:
+                colon: int = skip_whitespace(raw, string_end + 1)
+                value_start: int = skip_whitespace(raw, colon + 1)
+                if raw[colon : colon + 1] != b":" or raw[value_start : value_start + 1] != b'"':
+                    raise ValueError(f"The {key.decode()} element is not a string")
+                return value_start + 1, find_string_end(raw, value_start)
+            previous = character
+            position = string_end + 1
+            continue
+        if character in b"{[":
+            depth += 1
+        elif character in b"}]":
+            depth -= 1
+        if character not in JSON_WHITESPACE:
+            previous = character
+        position += 1
+    return -1, -1
+
+
+def find_string_end(raw: mmap.mmap, string_start: int) -> int:
+    """Function to find the closing quote of the JSON string opening at string_start, skipping escaped quotes"""
+
+    position: int = string_start + 1
+    while True:
+        quote: int = raw.find(b'"', position)
+        if quote == -1:
+            raise ValueError("The JSON document ends inside a string")
+        backslashes: int = 0
+        while raw[quote - 1 - backslashes] == ord("\\"):
+            backslashes += 1
+        if backslashes % 2 == 0:
+            return quote
+        position = quote + 1
+
+
+def skip_whitespace(raw: mmap.mmap, position: int) -> int:
+    while position < len(raw) and raw[position] in JSON_WHITESPACE:
+        position += 1
+    return position
+
+
+def get_spill_path(attachment: Attachment | dict[str, Any]) -> str | None:
+    """Function to get the path of the spill file an expanded attachment references in its SPILL_EXTENSION_URL extension, or None if it has none"""
+
+    extensions: list[Any] = (attachment.get("extension") if isinstance(attachment, dict) else attachment.extension) or []
+    for extension in extensions:
+        extension_json: dict[str, Any] = extension if isinstance(extension, dict) else extension.model_dump(exclude_none=True)
+        if extension_json.get("url") == SPILL_EXTENSION_URL and extension_json.get("valueUri"):
+            return url2pathname(urlparse(extension_json["valueUri"]).path)
+    return None
+
+
+def get_spill_url(spill_path: str) -> str:
+    return Path(spill_path).resolve().as_uri()
+
+
+def get_spilled_attachment_elements(spill_path: str, content_size: int) -> dict[str, Any]:
+    """Function to get the attachment elements added for a Binary spilled to spill_path, which keeps its original Attachment.url"""
+
+    return {"size": content_size, "extension": [{"url": SPILL_EXTENSION_URL, "valueUri": get_spill_url(spill_path)}]}
+
+
+def remove_spilled_attachment(attachment: Attachment | dict[str, Any]) -> None:
+    """Function to delete the spill file of an expanded attachment once its content is no longer needed. Attachments that were not spilled are left alone."""
+
+    spill_path: str | None = get_spill_path(attachment)
+    if spill_path is not None and os.path.exists(spill_path):
+        os.remove(spill_path)
+
+
+def open_spilled_attachment(attachment: Attachment | dict[str, Any]) -> mmap.mmap:
+    """
+    Memory-map the content of an attachment that was spilled to disk during DocumentReference expansion.
+
+    The content is what Attachment.data would have held had it not been spilled, so the base64 data of a JSON Binary. The returned mmap behaves like a
+    read-only bytes object (slicing, find, len) without reading the whole file into memory. Close it when done.
+    """
+
+    spill_path: str | None = get_spill_path(attachment)
+    if spill_path is None:
+        raise ValueError("The attachment does not reference a spilled Binary")
+    with open(spill_path, "rb") as spill_file:
+        return mmap.mmap(spill_file.fileno(), 0, access=mmap.ACCESS_READ)
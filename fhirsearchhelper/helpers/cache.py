@@ -0,0 +1,257 @@
+"""File for the caches used to hold Medication, Encounter, and Binary lookups between queries"""
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Any
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.cache")
+
+
+class ReferenceCache(ABC):
+    """
+    Base class for a cache of resolved references, keyed by <base_url>/<reference>.
+
+    Subclasses implement get, set, delete, clear, and __len__. Values are the JSON-compatible content of a lookup (a resource dictionary or Binary data
+    string). get returns None for missing or expired keys. hits and misses count the results of get. The default __contains__ calls get, so subclasses
+    should override it with a check that does not count as a read.
+    """
+
+    def __init__(self) -> None:
+        self.hits: int = 0
+        self.misses: int = 0
+
+    @abstractmethod
+    def get(self, key: str) -> Any | None: ...
+
+    @abstractmethod
+    def set(self, key: str, value: Any) -> None: ...
+
+    @abstractmethod
+    def delete(self, key: str) -> None: ...
+
+    @abstractmethod
+    def clear(self) -> None: ...
+
+    @abstractmethod
+    def __len__(self) -> int: ...
+
+    def __contains__(self, key: str) -> bool:
+        return self.get(key) is not None
+
+    def record(self, hit: bool) -> None:
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+
+def get_value_size(value: Any) -> int:
+    """Function to estimate the size in bytes of a cached value"""
+
+    if isinstance(value, str):
+        return len(value)
+    if isinstance(value, bytes):
+        return len(value)
+    return len(json.dumps(value, separators=(",", ":")))
+
+
+class LRUCache(ReferenceCache):
+    """
+    Thread-safe in-memory cache with least recently used eviction.
+
+    Parameters:
+    - max_entries (int, optional): The maximum number of entries to keep.
+    - ttl (float, optional): The number of seconds an entry stays valid after it is set.
+    - max_bytes (int, optional): The maximum total size of the cached values, useful for Binary content. Values larger than this are not cached.
+    """
+
+    def __init__(self, max_entries: int | None = None, ttl: float | None = None, max_bytes: int | None = None) -> None:
+        super().__init__()
+        self.max_entries: int | None = max_entries
+        self.ttl: float | None = ttl
+        self.max_bytes: int | None = max_bytes
+        self.total_bytes: int = 0
+        self._entries: OrderedDict[str, tuple[Any, float, int]] = OrderedDict()
+        self._lock: threading.Lock = threading.Lock()
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            cached: tuple[Any, float, int] | None = self._entries.get(key)
+            if cached is None:
+                self.record(hit=False)
+                return None
+            value, stored_at, _ = cached
+            if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+                self._remove(key)
+                self.record(hit=False)
+                return None
+            self._entries.move_to_end(key)
+            self.record(hit=True)
+            return value
+
+    def set(self, key: str, value: Any) -> None:
+        size: int = get_value_size(value) if self.max_bytes is not None else 0
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.max_bytes is not None and size > self.max_bytes:
+                logger.debug(f"Not caching {key} since its size of {size} bytes is larger than the cache")
+                return
+            self._entries[key] = (value, time.monotonic(), size)
+            self.total_bytes += size
+            while (self.max_entries is not None and len(self._entries) > self.max_entries) or (self.max_bytes is not None and self.total_bytes > self.max_bytes):
+                self._remove(next(iter(self._entries)))
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            cached: tuple[Any, float, int] | None = self._entries.get(key)
+            return cached is not None and (self.ttl is None or time.monotonic() - cached[1] <= self.ttl)
+
+    def _remove(self, key: str) -> None:
+        _, _, size = self._entries.pop(key)
+        self.total_bytes -= size
+
+
+class SQLiteCache(ReferenceCache):
+    """
+    Thread-safe on-disk cache backed by SQLite, so cached references survive between processes.
+
+    Values are stored as JSON. Eviction works like LRUCache, using the time each entry was last read. Reads only run a SELECT: the times entries were
+    read are kept in memory and written in one statement when the cache is next written to, when ACCESS_FLUSH_SIZE reads are pending, or when it is closed.
+
+    Parameters:
+    - path (str): The path of the SQLite database file, created if it does not exist.
+    - max_entries (int, optional): The maximum number of entries to keep.
+    - ttl (float, optional): The number of seconds an entry stays valid after it is set.
+    - max_bytes (int, optional): The maximum total size of the cached values. Values larger than this are not cached.
+    """
+
+    ACCESS_FLUSH_SIZE: int = 256
+
+    def __init__(self, path: str, max_entries: int | None = None, ttl: float | None = None, max_bytes: int | None = None) -> None:
+        super().__init__()
+        self.path: str = path
+        self.max_entries: int | None = max_entries
+        self.ttl: float | None = ttl
+        self.max_bytes: int | None = max_bytes
+        self._lock: threading.Lock = threading.Lock()
+        self._pending_accesses: dict[str, float] = {}
+        self._connection: sqlite3.Connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS reference_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, stored_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS reference_cache_accessed_at ON reference_cache (accessed_at)")
+
+    def get(self, key: str) -> Any | None:
+        with self._lock:
+            row: tuple[str, float] | None = self._connection.execute("SELECT value, stored_at FROM reference_cache WHERE key = ?", (key,)).fetchone()
+            now: float = time.time()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                # Expired rows are removed by the next write (see _evict)
+                self.record(hit=False)
+                return None
+            self._pending_accesses[key] = now
+            if len(self._pending_accesses) >= self.ACCESS_FLUSH_SIZE:
+                with self._connection:
+                    self._flush_accesses()
+            self.record(hit=True)
+            return json.loads(row[0])
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            row: tuple[float] | None = self._connection.execute("SELECT stored_at FROM reference_cache WHERE key = ?", (key,)).fetchone()
+            return row is not None and (self.ttl is None or time.time() - row[0] <= self.ttl)
+
+    def set(self, key: str, value: Any) -> None:
+        serialized_value: str = json.dumps(value, separators=(",", ":"))
+        size: int = len(serialized_value)
+        with self._lock, self._connection:
+            if self.max_bytes is not None and size > self.max_bytes:
+                logger.debug(f"Not caching {key} since its size of {size} bytes is larger than the cache")
+                self._connection.execute("DELETE FROM reference_cache WHERE key = ?", (key,))
+                return
+            now: float = time.time()
+            self._pending_accesses.pop(key, None)
+            self._connection.execute("INSERT OR REPLACE INTO reference_cache (key, value, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)", (key, serialized_value, size, now, now))
+            self._flush_accesses()
+            self._evict()
+
+    def delete(self, key: str) -> None:
+        with self._lock, self._connection:
+            self._pending_accesses.pop(key, None)
+            self._connection.execute("DELETE FROM reference_cache WHERE key = ?", (key,))
+
+    def clear(self) -> None:
+        with self._lock, self._connection:
+            self._pending_accesses.clear()
+            self._connection.execute("DELETE FROM reference_cache")
+
+    def close(self) -> None:
+        with self._lock:
+            with self._connection:
+                self._flush_accesses()
+            self._connection.close()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COUNT(*) FROM reference_cache").fetchone()[0]
+
+    def _flush_accesses(self) -> None:
+        if self._pending_accesses:
+            self._connection.executemany("UPDATE reference_cache SET accessed_at = ? WHERE key = ?", [(accessed_at, key) for key, accessed_at in self._pending_accesses.items()])
+            self._pending_accesses.clear()
+
+    def _evict(self) -> None:
+        if self.ttl is not None:
+            self._connection.execute("DELETE FROM reference_cache WHERE stored_at < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            self._connection.execute(
+                "DELETE FROM reference_cache WHERE key IN (SELECT key FROM reference_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,),
+            )
+        if self.max_bytes is not None:
+            total_bytes: int = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM reference_cache").fetchone()[0]
+            while total_bytes > self.max_bytes:
+                oldest: tuple[str, int] | None = self._connection.execute("SELECT key, size FROM reference_cache ORDER BY accessed_at ASC LIMIT 1").fetchone()
+                if oldest is None:
+                    break
+                self._connection.execute("DELETE FROM reference_cache WHERE key = ?", (oldest[0],))
+                total_bytes -= oldest[1]
+
+
+def configure_reference_caches(medication: ReferenceCache | None = None, encounter: ReferenceCache | None = None, binary: ReferenceCache | None = None) -> None:
+    """
+    Function to replace the package-wide caches used by the Medication, Encounter (Condition onset), and Binary (DocumentReference) expansions
+
+    Only the caches that are passed are replaced. For example, configure_reference_caches(medication=SQLiteCache("medications.db")) keeps Medication lookups
+    on disk between runs while leaving the in-memory Encounter cache in place. There is no Binary cache until one is passed, so Binary content is requested
+    again by every expansion unless the caller opts in.
+    """
+
+    from . import conditionhelper, documenthelper, medicationhelper
+
+    if medication is not None:
+        medicationhelper.cached_medication_resources = medication
+    if encounter is not None:
+        conditionhelper.cached_encounter_resources = encounter
+    if binary is not None:
+        documenthelper.cached_binary_resources = binary
@@ -1,13 +1,22 @@
 """File to handle all operations around a CapabilityStatement"""
 
+from __future__ import annotations
+
+import hashlib
 import logging
 import os
+from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING
 
 import httpx
-from fhir.resources.R4B.capabilitystatement import CapabilityStatement
 
-from ..models.models import SupportedSearchParams
+from ..models.models import CompiledCapabilityStatement, SearchParamIndex, SupportedSearchParams
+from .gapanalysis import compile_search_param_index
+from .metrics import count_response
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatement
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.capabilitystatement")
 
@@ -20,28 +29,149 @@ def load_capability_statement(client: httpx.Client, url: str | None = None, file
 
     if url:
         try:
-            cap_statement: dict = client.get(url, headers={"Accept": "application/json"}).json()
+            cap_statement_response: httpx.Response = client.get(url, headers={"Accept": "application/json"})
+            count_response(cap_statement_response, kind="metadata")
+            cap_statement: dict = cap_statement_response.json()
         except Exception as exc:
             logger.error("Something went wrong trying to access the CapabilityStatement via URL")
             raise exc
 
+        cap_statement_object: CapabilityStatement = parse_capability_statement(cap_statement)
+    elif file_path:
+        cap_statement_object = load_capability_statement_file(file_path)
+    else:
+        raise ValueError("You need to pass a url, an option to specify a preloaded CapabilityStatement, or a file path.")
+
+    return cap_statement_object
+
+
+async def load_capability_statement_async(client: httpx.AsyncClient, url: str | None = None, file_path: str | None = None) -> CapabilityStatement:
+    """Async version of load_capability_statement for use with an httpx.AsyncClient"""
+
+    if url and file_path:
+        logger.info("Defaulting to url...")
+
+    if url:
         try:
-            cap_statement_object: CapabilityStatement = CapabilityStatement.parse_obj(cap_statement)
+            cap_statement_response: httpx.Response = await client.get(url, headers={"Accept": "application/json"})
+            count_response(cap_statement_response, kind="metadata")
+            cap_statement: dict = cap_statement_response.json()
         except Exception as exc:
-            logger.error("Something went wrong when trying to turn the retrieved cap statement into a CapabilityStatement object")
+            logger.error("Something went wrong trying to access the CapabilityStatement via URL")
             raise exc
+
+        cap_statement_object: CapabilityStatement = parse_capability_statement(cap_statement)
     elif file_path:
-        if os.path.isfile(f"{Path(__file__).parents[1]}/capabilitystatements/{file_path}"):
-            logger.info(f"Found file {file_path} in the CapabilityStatements folder")
-            file_path = f"{Path(__file__).parents[1]}/capabilitystatements/{file_path}"
-        cap_statement_object = CapabilityStatement.parse_file(file_path)
+        cap_statement_object = load_capability_statement_file(file_path)
     else:
         raise ValueError("You need to pass a url, an option to specify a preloaded CapabilityStatement, or a file path.")
 
     return cap_statement_object
 
 
+def parse_capability_statement(cap_statement: dict) -> CapabilityStatement:
+    """Function to turn a retrieved CapabilityStatement dictionary into a CapabilityStatement object"""
+
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatement
+
+    try:
+        cap_statement_object: CapabilityStatement = CapabilityStatement.parse_obj(cap_statement)
+    except Exception as exc:
+        logger.error("Something went wrong when trying to turn the retrieved cap statement into a CapabilityStatement object")
+        raise exc
+
+    return cap_statement_object
+
+
+def load_capability_statement_file(file_path: str) -> CapabilityStatement:
+    """Function to load a CapabilityStatement from a file, checking the packaged CapabilityStatements folder first"""
+
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatement
+
+    return CapabilityStatement.parse_file(resolve_capability_statement_path(file_path))
+
+
+def resolve_capability_statement_path(file_path: str) -> str:
+    if os.path.isfile(f"{Path(__file__).parents[1]}/capabilitystatements/{file_path}"):
+        logger.info(f"Found file {file_path} in the CapabilityStatements folder")
+        return f"{Path(__file__).parents[1]}/capabilitystatements/{file_path}"
+    return file_path
+
+
+def get_capability_statement_key(cs: CapabilityStatement | CompiledCapabilityStatement) -> str:
+    """Function to fingerprint a loaded CapabilityStatement for the cache keys of outputs that depend on what it supports, as a SHA-256 of its JSON"""
+
+    return hashlib.sha256(cs.model_dump_json(exclude_none=True).encode()).hexdigest()
+
+
+def get_capability_statement_source_key(url: str | None = None, file_path: str | None = None) -> str | None:
+    """
+    Function to identify a CapabilityStatement by where it is loaded from, without loading it: the url, or the resolved file path with its modification
+    time so an edited file gets a new key. None if neither is given.
+    """
+
+    if url:
+        return f"url:{url}"
+    if file_path:
+        resolved_path: str = os.path.abspath(resolve_capability_statement_path(file_path))
+        return f"file:{resolved_path}:{os.path.getmtime(resolved_path) if os.path.exists(resolved_path) else ''}"
+    return None
+
+
+def load_search_capabilities(client: httpx.Client, url: str | None = None, file_path: str | None = None) -> tuple[list[SupportedSearchParams], SearchParamIndex, bool]:
+    """
+    Function to load a CapabilityStatement and return its supported search parameters, their compiled search parameter index, and whether it supports batch
+
+    A CapabilityStatement file is only parsed and compiled again when the file changes. One from a url is fetched and compiled on every call.
+    """
+
+    if file_path and not url:
+        resolved_path: str = resolve_capability_statement_path(file_path)
+        return load_file_search_capabilities(resolved_path, os.path.getmtime(resolved_path))
+    return get_search_capabilities(load_capability_statement(client=client, url=url, file_path=file_path))
+
+
+async def load_search_capabilities_async(client: httpx.AsyncClient, url: str | None = None, file_path: str | None = None) -> tuple[list[SupportedSearchParams], SearchParamIndex, bool]:
+    """Async version of load_search_capabilities"""
+
+    if file_path and not url:
+        resolved_path: str = resolve_capability_statement_path(file_path)
+        return load_file_search_capabilities(resolved_path, os.path.getmtime(resolved_path))
+    return get_search_capabilities(await load_capability_statement_async(client=client, url=url, file_path=file_path))
+
+
+@lru_cache(maxsize=16)
+def load_file_search_capabilities(file_path: str, modified_time: float) -> tuple[list[SupportedSearchParams], SearchParamIndex, bool]:
+    """Function to load and compile a CapabilityStatement file, cached by its path and modification time"""
+
+    return get_search_capabilities(load_capability_statement_file(file_path))
+
+
+def get_search_capabilities(cs: CapabilityStatement) -> tuple[list[SupportedSearchParams], SearchParamIndex, bool]:
+    supported_search_params: list[SupportedSearchParams] = get_supported_search_params(cs)
+    return supported_search_params, compile_search_param_index(supported_search_params), supports_batch(cs)
+
+
 def get_supported_search_params(cs: CapabilityStatement) -> list[SupportedSearchParams]:
     """Function to pull out supported search parameters from a capability statement"""
 
-    return [SupportedSearchParams(resourceType=resource.type, searchParams=resource.searchParam) for resource in cs.rest[0].resource if resource.searchParam]  # type: ignore
+    return [
+        SupportedSearchParams(resourceType=resource.type, searchParams=resource.searchParam, searchInclude=resource.searchInclude or [])  # type: ignore
+        for resource in cs.rest[0].resource  # type: ignore
+        if resource.searchParam
+    ]
+
+
+def supports_batch(cs: CapabilityStatement) -> bool:
+    """Function to check whether the server accepts batch Bundles, from the system interactions of the CapabilityStatement"""
+
+    return any([interaction.code == "batch" for rest in cs.rest or [] for interaction in rest.interaction or []])
+
+
+def supports_search_include(supported_search_params: list[SupportedSearchParams], resource_type: str, include: str) -> bool:
+    """Function to check whether the server accepts the _include value include (e.g. MedicationRequest:medication) when searching resource_type"""
+
+    for resource_params in supported_search_params:
+        if resource_params.resourceType == resource_type:
+            return include in resource_params.searchInclude or "*" in resource_params.searchInclude
+    return False
@@ -0,0 +1,164 @@
+"""File to compile CapabilityStatements into compact artifacts holding only what the search pipeline reads, and to look them up by base url"""
+
+from __future__ import annotations
+
+import argparse
+import logging
+import sys
+import threading
+from pathlib import Path
+from typing import TYPE_CHECKING
+
+import httpx
+
+from ..models.models import CompiledCapabilityStatement, CompiledResourceSearchParams, SearchParamIndex, SupportedSearchParams
+from .capabilitystatement import get_supported_search_params, load_capability_statement, supports_batch
+from .gapanalysis import compile_search_param_index
+from .ratelimit import create_transport
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatement
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.compiledcapabilitystatement")
+
+# Bumped whenever the artifact layout changes, so stale artifacts are rejected instead of misread
+COMPILED_FORMAT_VERSION: int = 1
+
+
+def compile_capability_statement(cs: CapabilityStatement, source: str | None = None) -> CompiledCapabilityStatement:
+    """
+    Function to reduce a CapabilityStatement to the search parameter names, parsed true-when conditions, _include values, and batch support of each
+    searchable resource type
+
+    The full CapabilityStatement is validated once here, so loading the artifact later skips both the validation and the true-when parsing.
+    """
+
+    supported_search_params: list[SupportedSearchParams] = get_supported_search_params(cs)
+    search_param_index: SearchParamIndex = compile_search_param_index(supported_search_params)
+
+    resources: dict[str, CompiledResourceSearchParams] = {}
+    for resource_params in supported_search_params:
+        compiled_resource: CompiledResourceSearchParams = resources.setdefault(
+            resource_params.resourceType, CompiledResourceSearchParams(searchParamIndex=search_param_index[resource_params.resourceType])
+        )
+        compiled_resource.searchParams.extend([item.name for item in resource_params.searchParams if item.name])
+        compiled_resource.searchInclude.extend(resource_params.searchInclude)
+
+    return CompiledCapabilityStatement(formatVersion=COMPILED_FORMAT_VERSION, source=source, resources=resources, batch=supports_batch(cs))
+
+
+def save_compiled_capability_statement(compiled_cs: CompiledCapabilityStatement, file_path: str | Path) -> None:
+    with open(file_path, "w") as fopen:
+        fopen.write(compiled_cs.model_dump_json(exclude_none=True))
+
+
+def load_compiled_capability_statement(file_path: str | Path) -> CompiledCapabilityStatement:
+    """Function to load an artifact written by save_compiled_capability_statement, raising a ValueError if it was compiled for another format version"""
+
+    with open(file_path, "rb") as fopen:
+        compiled_cs: CompiledCapabilityStatement = CompiledCapabilityStatement.model_validate_json(fopen.read())
+    if compiled_cs.formatVersion != COMPILED_FORMAT_VERSION:
+        raise ValueError(f"{file_path} was compiled with format version {compiled_cs.formatVersion}, recompile it for format version {COMPILED_FORMAT_VERSION}")
+    return compiled_cs
+
+
+def get_compiled_supported_search_params(compiled_cs: CompiledCapabilityStatement) -> list[SupportedSearchParams]:
+    """Function to rebuild the SupportedSearchParams of a compiled CapabilityStatement, holding only the search parameter names, without validating them again"""
+
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatementRestResourceSearchParam
+
+    return [
+        SupportedSearchParams.model_construct(
+            resourceType=resource_type,
+            searchParams=[CapabilityStatementRestResourceSearchParam.model_construct(name=name) for name in compiled_resource.searchParams],
+            searchInclude=compiled_resource.searchInclude,
+        )
+        for resource_type, compiled_resource in compiled_cs.resources.items()
+    ]
+
+
+def get_compiled_search_param_index(compiled_cs: CompiledCapabilityStatement) -> SearchParamIndex:
+    return {resource_type: compiled_resource.searchParamIndex for resource_type, compiled_resource in compiled_cs.resources.items()}
+
+
+class CapabilityStatementRegistry:
+    """
+    Thread-safe map of FHIR base urls to compiled CapabilityStatements.
+
+    Artifacts registered by path are loaded the first time their base url is looked up, and kept for the life of the registry (and so of the process, for
+    the shared capability_statement_registry).
+
+    Parameters:
+    - artifacts (dict, optional): Base urls mapped to artifact paths (from save_compiled_capability_statement) or to already compiled CapabilityStatements.
+    """
+
+    def __init__(self, artifacts: dict[str, str | Path | CompiledCapabilityStatement] | None = None) -> None:
+        self.artifact_paths: dict[str, Path] = {}
+        self.loaded: dict[str, CompiledCapabilityStatement] = {}
+        self._lock: threading.Lock = threading.Lock()
+        for base_url, artifact in (artifacts or {}).items():
+            self.register(base_url, artifact)
+
+    def register(self, base_url: str, artifact: str | Path | CompiledCapabilityStatement) -> None:
+        key: str = base_url.rstrip("/")
+        with self._lock:
+            if isinstance(artifact, CompiledCapabilityStatement):
+                self.loaded[key] = artifact
+            else:
+                self.artifact_paths[key] = Path(artifact)
+                self.loaded.pop(key, None)
+
+    def get(self, base_url: str) -> CompiledCapabilityStatement | None:
+        """Function to get the compiled CapabilityStatement registered for base_url, loading its artifact on first use, or None if none is registered"""
+
+        key: str = base_url.rstrip("/")
+        compiled_cs: CompiledCapabilityStatement | None = self.loaded.get(key)
+        if compiled_cs or key not in self.artifact_paths:
+            return compiled_cs
+        with self._lock:
+            if key not in self.loaded:
+                logger.debug(f"Loading the compiled CapabilityStatement for {key} from {self.artifact_paths[key]}")
+                self.loaded[key] = load_compiled_capability_statement(self.artifact_paths[key])
+            return self.loaded[key]
+
+    def __contains__(self, base_url: str) -> bool:
+        key: str = base_url.rstrip("/")
+        return key in self.loaded or key in self.artifact_paths
+
+
+# The registry run_fhir_query checks when it is not given a CapabilityStatement file or url
+capability_statement_registry: CapabilityStatementRegistry = CapabilityStatementRegistry()
+
+
+def configure_capability_statement_registry(
+    registry: CapabilityStatementRegistry | None = None, artifacts: dict[str, str | Path | CompiledCapabilityStatement] | None = None
+) -> CapabilityStatementRegistry:
+    """Function to replace the shared CapabilityStatement registry, either with registry or with a new one built from artifacts, and return it"""
+
+    global capability_statement_registry
+    capability_statement_registry = registry or CapabilityStatementRegistry(artifacts)
+    return capability_statement_registry
+
+
+def main(argv: list[str] | None = None) -> None:
+    """
+    Entry point of the fhirsearchhelper-compile-capability-statement console script, which exits with the return value, so it returns None for success.
+    Use compile_capability_statement and save_compiled_capability_statement to get the artifact in code.
+    """
+
+    parser: argparse.ArgumentParser = argparse.ArgumentParser(description="Compile a CapabilityStatement into an artifact for CapabilityStatementRegistry")
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--url", help="The url to retrieve the CapabilityStatement from, such as <base_url>/metadata")
+    source_group.add_argument("--file", help="A file name in the packaged CapabilityStatements folder or a path to a CapabilityStatement file")
+    parser.add_argument("--output", required=True, help="Write the compiled artifact to this file")
+    args: argparse.Namespace = parser.parse_args(argv)
+
+    with httpx.Client(transport=create_transport()) as client:
+        cs: CapabilityStatement = load_capability_statement(client=client, url=args.url, file_path=args.file)
+    compiled_cs: CompiledCapabilityStatement = compile_capability_statement(cs, source=args.url or args.file)
+    save_compiled_capability_statement(compiled_cs, args.output)
+    print(f"Compiled {len(compiled_cs.resources)} resource types to {args.output}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
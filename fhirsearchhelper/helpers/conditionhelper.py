@@ -1,47 +1,49 @@
 """File to handle all operations around Condition Resources"""
 
+from __future__ import annotations
+
+import asyncio
 import logging
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from copy import deepcopy
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
 
 import httpx
-from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
+from .cache import LRUCache, ReferenceCache
+from .metrics import count, count_response
 from .operationoutcomehelper import handle_operation_outcomes
+from .ratelimit import RateLimitedTransport, create_transport
+from .referenceresolver import get_reference_lookup, get_unresolved_references, resolve_references_in_batches, schedule_batched_lookups
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.conditionhelper")
 
-cached_encounter_resources: dict = {}
+# See cache.configure_reference_caches to swap in a different cache
+cached_encounter_resources: ReferenceCache = LRUCache(max_entries=10000, ttl=60 * 60)
+encounter_lookups: SingleFlight = SingleFlight()
+
+ONSET_KEYS: list[str] = ["onsetAge", "onsetDateTime", "onsetPeriod", "onsetRange", "onsetString", "recordedDate"]
 
 
-def expand_single_condition_onset(resource: dict, base_url: str, query_headers: dict):
+def expand_single_condition_onset(resource: dict, base_url: str, query_headers: dict, client: httpx.Client | None = None):
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
         return None
 
-    transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
-    client: httpx.Client = httpx.Client(transport=transport)
+    if not client:
+        transport: RateLimitedTransport = create_transport()
+        client = httpx.Client(transport=transport)
 
-    if any(onset_key in resource for onset_key in ["onsetAge", "onsetDateTime", "onsetPeriod", "onsetRange", "onsetString", "recordedDate"]):
+    if any(onset_key in resource for onset_key in ONSET_KEYS):
         return resource
     if "encounter" in resource and "reference" in resource["encounter"]:
         encounter_ref: str = resource["encounter"]["reference"]
-        if base_url + "/" + encounter_ref in cached_encounter_resources:
-            logger.debug("Found Encounter in cached resources")
-            encounter_json: dict = cached_encounter_resources[base_url + "/" + encounter_ref]
-        else:
-            logger.debug(f"Did not find Encounter in cached resources, querying {base_url + '/' + encounter_ref}")
-            encounter_lookup: httpx.Response = client.get(f"{base_url}/{encounter_ref}", headers=query_headers)
-            if encounter_lookup.status_code != 200:
-                logger.error(f"The Condition Encounter query responded with a status code of {encounter_lookup.status_code}")
-                if encounter_lookup.status_code == 403:
-                    logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Encounter.Read.")
-                    if "WWW-Authenticate" in encounter_lookup.headers:
-                        logger.error(encounter_lookup.headers["WWW-Authenticate"])
-                return None
-            encounter_json = encounter_lookup.json()
-            cached_encounter_resources[base_url + "/" + encounter_ref] = encounter_json
+        encounter_json: dict | None = lookup_encounter(client=client, encounter_url=base_url + "/" + encounter_ref, query_headers=query_headers)
+        if encounter_json is None:
+            return None
         if "period" in encounter_json and "start" in encounter_json["period"]:
             resource["onsetDateTime"] = encounter_json["period"]["start"]
         else:
@@ -52,7 +54,46 @@ def expand_single_condition_onset(resource: dict, base_url: str, query_headers:
     return resource
 
 
-def expand_condition_onset(entry_resource: BundleEntry) -> dict[str, Any] | None:
+def lookup_encounter(client: httpx.Client, encounter_url: str, query_headers: dict) -> dict | None:
+    """
+    Retrieve an Encounter, first from the Encounter cache and otherwise from the server.
+
+    Concurrent lookups of the same Encounter from different threads share a single request and its parsed result. Returns None if the Encounter could
+    not be retrieved.
+    """
+
+    cached_encounter: dict | None = cached_encounter_resources.get(encounter_url)
+    if cached_encounter:
+        logger.debug("Found Encounter in cached resources")
+        count("cache_hits", reference="Encounter")
+        return cached_encounter
+    count("cache_misses", reference="Encounter")
+
+    def fetch_encounter() -> dict | None:
+        logger.debug(f"Did not find Encounter in cached resources, querying {encounter_url}")
+        encounter_lookup: httpx.Response = client.get(encounter_url, headers=query_headers)
+        count_response(encounter_lookup, kind="Encounter")
+        if encounter_lookup.status_code != 200:
+            log_encounter_lookup_error(encounter_lookup)
+            return None
+        encounter_json: dict = encounter_lookup.json()
+        cached_encounter_resources.set(encounter_url, encounter_json)
+        return encounter_json
+
+    return encounter_lookups.do(encounter_url, fetch_encounter)
+
+
+def log_encounter_lookup_error(encounter_lookup: httpx.Response) -> None:
+    """Function to log why an Encounter lookup failed"""
+
+    logger.error(f"The Condition Encounter query responded with a status code of {encounter_lookup.status_code}")
+    if encounter_lookup.status_code == 403:
+        logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Encounter.Read.")
+        if "WWW-Authenticate" in encounter_lookup.headers:
+            logger.error(encounter_lookup.headers["WWW-Authenticate"])
+
+
+def expand_condition_onset(entry_resource: BundleEntry, client: httpx.Client | None = None, base_url: str | None = None, query_headers: dict | None = None) -> dict[str, Any] | None:
     """
     Add condition onset date and time information using an Encounter reference.
 
@@ -60,6 +101,7 @@ def expand_condition_onset(entry_resource: BundleEntry) -> dict[str, Any] | None
 
     Parameters:
     - entry_resource (dict): A Bundle.entry where resourceType is Condition as a dictionary.
+    - client, base_url, query_headers (optional): The client, base URL, and headers used to resolve the reference. Default to the ones passed to the last call of expand_condition_onset_in_bundle.
 
     Returns:
     - dict[str, Any] or None: A Bundle.entry with a modified 'Condition' resource dictionary with the 'onsetDateTime' field added or None if an error occurs during the retrieval of the referenced Encounter.
@@ -73,31 +115,32 @@ def expand_condition_onset(entry_resource: BundleEntry) -> dict[str, Any] | None
     - If the HTTP response contains 'WWW-Authenticate' headers, they are logged to provide additional diagnostic information.
     """
 
-    entry: dict = entry_resource.model_dump(exclude_none=True)
+    client = client or g_client
+    base_url = base_url or g_base_url
+    query_headers = query_headers if query_headers is not None else g_query_headers
+
+    return expand_condition_onset_json(entry=entry_resource.model_dump(exclude_none=True), client=client, base_url=base_url, query_headers=query_headers)
+
+
+def expand_condition_onset_json(entry: dict[str, Any], client: httpx.Client, base_url: str, query_headers: dict, prefetched_encounters: dict[str, dict] | None = None) -> dict[str, Any] | None:
+    """
+    Function to add Condition.onsetDateTime to a raw Bundle.entry dictionary in place, returning the entry or None if the Encounter could not be retrieved
+
+    Encounters in prefetched_encounters (read in a batch) are used as is, and any other Encounter is looked up.
+    """
+
     resource: dict = entry["resource"]
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
         return None
 
-    if any(onset_key in resource for onset_key in ["onsetAge", "onsetDateTime", "onsetPeriod", "onsetRange", "onsetString", "recordedDate"]):
+    if any(onset_key in resource for onset_key in ONSET_KEYS):
         return entry
     if "encounter" in resource and "reference" in resource["encounter"]:
-        encounter_ref: str = resource["encounter"]["reference"]
-        if g_base_url + "/" + encounter_ref in cached_encounter_resources:
-            logger.debug("Found Encounter in cached resources")
-            encounter_json: dict = cached_encounter_resources[g_base_url + "/" + encounter_ref]
-        else:
-            logger.debug(f"Did not find Encounter in cached resources, querying {g_base_url + '/' + encounter_ref}")
-            encounter_lookup: httpx.Response = g_client.get(f"{g_base_url}/{encounter_ref}", headers=g_query_headers)
-            if encounter_lookup.status_code != 200:
-                logger.error(f"The Condition Encounter query responded with a status code of {encounter_lookup.status_code}")
-                if encounter_lookup.status_code == 403:
-                    logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Encounter.Read.")
-                    if "WWW-Authenticate" in encounter_lookup.headers:
-                        logger.error(encounter_lookup.headers["WWW-Authenticate"])
-                return None
-            encounter_json = encounter_lookup.json()
-            cached_encounter_resources[g_base_url + "/" + encounter_ref] = encounter_json
+        encounter_url: str = base_url + "/" + resource["encounter"]["reference"]
+        encounter_json: dict | None = get_prefetched_encounter(prefetched_encounters, encounter_url) or lookup_encounter(client=client, encounter_url=encounter_url, query_headers=query_headers)
+        if encounter_json is None:
+            return None
         if "period" in encounter_json and "start" in encounter_json["period"]:
             resource["onsetDateTime"] = encounter_json["period"]["start"]
         else:
@@ -105,11 +148,27 @@ def expand_condition_onset(entry_resource: BundleEntry) -> dict[str, Any] | None
     else:
         resource["onsetDateTime"] = "9999-12-31"
 
-    entry["resource"] = resource
     return entry
 
 
-def expand_condition_onset_in_bundle(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}) -> Bundle:
+def get_prefetched_encounter(prefetched_encounters: dict[str, dict] | None, encounter_url: str) -> dict | None:
+    if not prefetched_encounters or encounter_url not in prefetched_encounters:
+        return None
+    count("prefetched_references", reference="Encounter")
+    return prefetched_encounters[encounter_url]
+
+
+def get_encounter_urls(entries: list[dict[str, Any]], base_url: str) -> list[str]:
+    """Function to list the url of the Encounter referenced by each Condition entry that needs its onset from the Encounter"""
+
+    return [
+        f"{base_url}/{entry['resource']['encounter']['reference']}"
+        for entry in entries
+        if not any(onset_key in entry["resource"] for onset_key in ONSET_KEYS) and "reference" in entry["resource"].get("encounter", {})
+    ]
+
+
+def expand_condition_onset_in_bundle(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}, batch_size: int = 0) -> Bundle:
     """
     Expand and modify resources within a FHIR Bundle by adding Condition.onsetDateTime using referenced Encounter in Condition.encounter.
 
@@ -120,31 +179,161 @@ def expand_condition_onset_in_bundle(client: httpx.Client, input_bundle: Bundle,
     - input_bundle (Bundle): The input FHIR Bundle containing resources to be processed.
     - base_url (str): The base URL to be used for resolving references within the resources.
     - query_headers (dict, optional): Additional headers to include in HTTP requests when resolving references, such as a previously received Bearer token in an OAuth 2.0 workflow (default: {}).
+    - batch_size (int, optional): When greater than 0, Encounters are read with batch Bundles of up to this many GETs instead of one request each. Only use
+      this with servers whose CapabilityStatement supports the batch interaction (default: 0).
 
     Returns:
     - Bundle: A modified FHIR Bundle with resources expanded to include Condition.onsetDateTime, or the original input Bundle if any errors occurred when trying to GET the Encounters.
     """
-    global cached_encounter_resources, g_client, g_base_url, g_query_headers
-    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+    from fhir.resources.R4B.bundle import Bundle
 
-    returned_resources: list[BundleEntry] | None = input_bundle.entry
-    if not returned_resources:
+    if not input_bundle.entry:
         return input_bundle
-    output_bundle: dict = deepcopy(input_bundle).model_dump(exclude_none=True)
+
+    return Bundle.model_validate(
+        expand_condition_onset_in_bundle_json(client=client, bundle_json=input_bundle.model_dump(exclude_none=True), base_url=base_url, query_headers=query_headers, batch_size=batch_size)
+    )
+
+
+def expand_condition_onset_in_bundle_json(client: httpx.Client, bundle_json: dict[str, Any], base_url: str, query_headers: dict = {}, batch_size: int = 0) -> dict[str, Any]:
+    """
+    Raw JSON version of expand_condition_onset_in_bundle that expands the entries of a Bundle dictionary in place and returns it.
+
+    The search pipeline uses this so each page is only validated into a Bundle once, after it has been filtered and expanded. Entries keep their original
+    order.
+    """
+
+    global g_client, g_base_url, g_query_headers
+    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+    prefetched_encounters: dict[str, dict] = {}
+    if batch_size:
+        unresolved_urls: list[str] = get_unresolved_references(get_encounter_urls(entries, base_url), cached_encounter_resources)
+        prefetched_encounters = resolve_references_in_batches(client, base_url, unresolved_urls, query_headers, batch_size, cached_encounter_resources, "Encounter")
+    saved_calls_before: int = encounter_lookups.saved_calls
 
     with ThreadPoolExecutor() as executor:
-        future_to_entry: dict[Future[dict[str, Any] | None], BundleEntry] = {executor.submit(expand_condition_onset, entry): entry for entry in returned_resources}
+        expanded_entries: list[dict[str, Any] | None] = list(executor.map(lambda entry: expand_condition_onset_json(entry, client, base_url, query_headers, prefetched_encounters), entries))
+
+    logger.debug(f"{encounter_lookups.saved_calls - saved_calls_before} Encounter lookups were shared with an identical lookup already in flight")
+
+    bundle_json["entry"] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(bundle_json["entry"]), reason="expansion", resource_type="Condition")
+    return bundle_json
+
+
+async def expand_condition_onset_in_bundle_async(
+    client: httpx.AsyncClient,
+    input_bundle: Bundle,
+    base_url: str,
+    query_headers: dict = {},
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    batch_size: int = 0,
+) -> Bundle:
+    """
+    Async version of expand_condition_onset_in_bundle that shares the caller's httpx.AsyncClient.
+
+    Parameters:
+    - client (httpx.AsyncClient): The client used for all Encounter lookups.
+    - input_bundle (Bundle): The input FHIR Bundle containing resources to be processed.
+    - base_url (str): The base URL to be used for resolving references within the resources.
+    - query_headers (dict, optional): Additional headers to include in HTTP requests when resolving references (default: {}).
+    - max_concurrency (int, optional): The maximum number of Encounter lookups in flight at once (default: 10).
+    - reference_lookups (dict, optional): A dictionary of in-flight or finished lookups keyed by url, shared between calls so each Encounter is only requested once across them.
+    - batch_size (int, optional): When greater than 0, Encounters are read with batch Bundles of up to this many GETs, see expand_condition_onset_in_bundle (default: 0).
+
+    Returns:
+    - Bundle: A modified FHIR Bundle with resources expanded to include Condition.onsetDateTime. Entries keep their original order.
 
-        expanded_entries: list[dict[str, Any] | None] = []
-        for future in as_completed(future_to_entry):
-            entry: dict[str, Any] | None = future.result()
-            if entry:
-                expanded_entries.append(entry)
+    Each distinct Encounter is only requested once, even when many Conditions reference it at the same time.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if not input_bundle.entry:
+        return input_bundle
+
+    return Bundle.model_validate(
+        await expand_condition_onset_in_bundle_json_async(
+            client=client,
+            bundle_json=input_bundle.model_dump(exclude_none=True),
+            base_url=base_url,
+            query_headers=query_headers,
+            max_concurrency=max_concurrency,
+            reference_lookups=reference_lookups,
+            batch_size=batch_size,
+        )
+    )
+
+
+async def expand_condition_onset_in_bundle_json_async(
+    client: httpx.AsyncClient,
+    bundle_json: dict[str, Any],
+    base_url: str,
+    query_headers: dict = {},
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    batch_size: int = 0,
+) -> dict[str, Any]:
+    """Async version of expand_condition_onset_in_bundle_json, see expand_condition_onset_in_bundle_async for the parameters"""
+
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+    encounter_lookups: dict[str, asyncio.Task] = reference_lookups if reference_lookups is not None else {}
 
-    expanded_entries_clean: list[dict[str, Any]] = [entry for entry in expanded_entries if entry]
+    async def lookup_encounter(encounter_url: str) -> dict | None:
+        cached_encounter: dict | None = cached_encounter_resources.get(encounter_url)
+        if cached_encounter:
+            logger.debug("Found Encounter in cached resources")
+            count("cache_hits", reference="Encounter")
+            return cached_encounter
+        count("cache_misses", reference="Encounter")
+        async with semaphore:
+            logger.debug(f"Querying {encounter_url}")
+            encounter_lookup: httpx.Response = await client.get(encounter_url, headers=query_headers)
+        count_response(encounter_lookup, kind="Encounter")
+        if encounter_lookup.status_code != 200:
+            log_encounter_lookup_error(encounter_lookup)
+            return None
+        encounter_json: dict = encounter_lookup.json()
+        cached_encounter_resources.set(encounter_url, encounter_json)
+        return encounter_json
+
+    if batch_size:
+        unresolved_urls: list[str] = get_unresolved_references(get_encounter_urls(entries, base_url), cached_encounter_resources, encounter_lookups)
+        schedule_batched_lookups(client, base_url, unresolved_urls, query_headers, batch_size, cached_encounter_resources, "Encounter", encounter_lookups, lookup_encounter, semaphore)
+
+    async def expand_entry(entry: dict[str, Any]) -> dict[str, Any] | None:
+        resource: dict[str, Any] = entry["resource"]
+        if resource["resourceType"] == "OperationOutcome":
+            handle_operation_outcomes(resource=resource)
+            return None
+
+        if any(onset_key in resource for onset_key in ONSET_KEYS):
+            return entry
+        if "encounter" in resource and "reference" in resource["encounter"]:
+            encounter_url: str = f"{base_url}/{resource['encounter']['reference']}"
+            encounter_json: dict | None = await get_reference_lookup(encounter_lookups, encounter_url, lookup_encounter)
+            if encounter_json is None:
+                return None
+            if "period" in encounter_json and "start" in encounter_json["period"]:
+                resource["onsetDateTime"] = encounter_json["period"]["start"]
+            else:
+                resource["onsetDateTime"] = "9999-12-31"
+        else:
+            resource["onsetDateTime"] = "9999-12-31"
+
+        return entry
 
-    if len(cached_encounter_resources.keys()) != 0:
-        cached_encounter_resources = {}
+    expanded_entries: list[dict[str, Any] | None] = await asyncio.gather(*[expand_entry(entry) for entry in entries])
 
-    output_bundle["entry"] = expanded_entries_clean
-    return Bundle.model_validate(output_bundle)
+    bundle_json["entry"] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(bundle_json["entry"]), reason="expansion", resource_type="Condition")
+    return bundle_json
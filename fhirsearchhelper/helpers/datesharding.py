@@ -0,0 +1,190 @@
+"""File to split a search into date windows that are searched in parallel, sizing each window by how dense the windows before it were"""
+
+from __future__ import annotations
+
+import logging
+from datetime import date, timedelta
+from typing import TYPE_CHECKING, Any
+
+from ..models.models import QuerySearchParams, SearchParamIndex, SupportedSearchParams
+from .gapanalysis import run_gap_analysis
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.datesharding")
+
+# (start, end) searched as date=ge<start>&date=lt<end>, where None leaves that side open
+DateWindow = tuple[date | None, date | None]
+# The window of the resources without a date, searched as date:missing=true
+MISSING_DATE_WINDOW: DateWindow = (None, None)
+
+
+class DateSharding:
+    """
+    Options for running a search as disjoint date windows searched in parallel, see the date_sharding argument of run_fhir_query.
+
+    Parameters:
+    - start (date or str): The start of the sharded range, as a date or YYYY-MM-DD. Anything dated before it is searched in one window (date=lt<start>).
+    - end (date or str, optional): The end of the sharded range. Anything dated on or after it is searched in one window (date=ge<end>) (default: tomorrow).
+    - concurrency (int, optional): The number of windows searched at once (default: 4).
+    - initial_window_days (int, optional): The length of the first windows, before any have finished (default: 365).
+    - target_window_size (int, optional): The number of entries each window should return. Once windows finish, new windows are sized from the number of
+      entries per day seen so far to return about this many (default: 500).
+    - min_window_days, max_window_days (int, optional): The bounds of the window length (default: 1, 3650).
+    - missing_modifier (bool, optional): Whether the server supports date:missing=true, which CapabilityStatements cannot express. Resources without a date
+      are not matched by any window, so they are searched in one more window with date:missing=true, and searches are only sharded when this is set
+      (default: False).
+    """
+
+    def __init__(
+        self,
+        start: date | str,
+        end: date | str | None = None,
+        concurrency: int = 4,
+        initial_window_days: int = 365,
+        target_window_size: int = 500,
+        min_window_days: int = 1,
+        max_window_days: int = 3650,
+        missing_modifier: bool = False,
+    ) -> None:
+        self.start: date = date.fromisoformat(start) if isinstance(start, str) else start
+        self.end: date = (date.fromisoformat(end) if isinstance(end, str) else end) if end else date.today() + timedelta(days=1)
+        if self.end <= self.start:
+            raise ValueError(f"The end of the sharded range ({self.end}) must be after its start ({self.start})")
+        self.concurrency: int = concurrency
+        self.initial_window_days: int = initial_window_days
+        self.target_window_size: int = target_window_size
+        self.min_window_days: int = min_window_days
+        self.max_window_days: int = max_window_days
+        self.missing_modifier: bool = missing_modifier
+
+
+class DateWindowPlanner:
+    """
+    Hands out the windows of one sharded search in order: the open window before start, windows covering start to end, the open window after end, then
+    MISSING_DATE_WINDOW when the server supports date:missing.
+
+    Each window covering the range is sized from the entries per day of the windows recorded so far, so sparse years are searched in a few wide windows and
+    dense months in many narrow ones. Not thread-safe, it is only used by the loop scheduling the windows.
+    """
+
+    def __init__(self, date_sharding: DateSharding) -> None:
+        self.date_sharding: DateSharding = date_sharding
+        self.cursor: date = date_sharding.start
+        self.window_days: int = date_sharding.initial_window_days
+        self.recorded_entries: int = 0
+        self.recorded_days: int = 0
+        self.started: bool = False
+        self.finished: bool = False
+        self.missing_searched: bool = False
+
+    def next_window(self) -> DateWindow | None:
+        if not self.started:
+            self.started = True
+            return (None, self.date_sharding.start)
+        if self.cursor < self.date_sharding.end:
+            window_start: date = self.cursor
+            self.cursor = min(self.cursor + timedelta(days=self.window_days), self.date_sharding.end)
+            return (window_start, self.cursor)
+        if not self.finished:
+            self.finished = True
+            return (self.date_sharding.end, None)
+        if self.date_sharding.missing_modifier and not self.missing_searched:
+            self.missing_searched = True
+            return MISSING_DATE_WINDOW
+        return None
+
+    def record(self, window: DateWindow, entry_count: int) -> None:
+        """Function to add the entries a finished window returned to the density estimate, and resize the windows handed out next"""
+
+        window_start, window_end = window
+        if window_start is None or window_end is None:
+            return
+        self.recorded_entries += entry_count
+        self.recorded_days += (window_end - window_start).days
+        if self.recorded_entries:
+            window_days: int = round(self.date_sharding.target_window_size * self.recorded_days / self.recorded_entries)
+        else:
+            window_days = self.window_days * 2
+        self.window_days = max(self.date_sharding.min_window_days, min(self.date_sharding.max_window_days, window_days))
+        logger.debug(f"Window {window_start} to {window_end} returned {entry_count} entries, the next windows will be {self.window_days} days long")
+
+
+def can_shard_by_date(date_sharding: DateSharding, supported_search_params: list[SupportedSearchParams], search_params: QuerySearchParams, search_param_index: SearchParamIndex | None = None) -> bool:
+    """
+    Function to check whether a search can be sharded, which needs the server to support date for the resource type and date:missing (so the sharded
+    search returns the same resources as the search as is), and the query to not already use date
+    """
+
+    if not date_sharding.missing_modifier:
+        logger.info("The server is not known to support date:missing, so resources without a date could not be searched and the query is not sharded")
+        return False
+    if "date" in search_params.searchParams:
+        logger.info("The query already searches by date, so it is not sharded")
+        return False
+    date_search_params: QuerySearchParams = QuerySearchParams(resourceType=search_params.resourceType, searchParams={**search_params.searchParams, "date": "ge1900-01-01"})
+    if "date" in run_gap_analysis(supported_search_params=supported_search_params, query_search_params=date_search_params, search_param_index=search_param_index):
+        logger.info(f"The server does not support searching {search_params.resourceType} by date, so the query is not sharded")
+        return False
+    return True
+
+
+def add_date_window(query_string: str, date_window: DateWindow | None) -> str:
+    if not date_window:
+        return query_string
+    if date_window == MISSING_DATE_WINDOW:
+        return f"{query_string}{'&' if '?' in query_string else '?'}date:missing=true"
+    window_params: list[str] = [f"date={prefix}{bound.isoformat()}" for prefix, bound in zip(["ge", "lt"], date_window) if bound]
+    return f"{query_string}{'&' if '?' in query_string else '?'}{'&'.join(window_params)}"
+
+
+def count_page_entries(page: Bundle | OperationOutcome | dict | None) -> int:
+    if isinstance(page, dict):
+        return len(page.get("entry", [])) if page.get("resourceType") == "Bundle" else 0
+    return len(getattr(page, "entry", None) or [])
+
+
+def remove_seen_entries(page: Bundle | OperationOutcome | dict | None, seen: set[str]) -> Bundle | OperationOutcome | dict | None:
+    """
+    Function to remove the entries of a page whose resource was already returned by another window, adding the rest to seen
+
+    Resources with more than one date (e.g. a period) can match neighbouring windows. Entries without a resource id are always kept. Bundle.total is set
+    to the number of entries kept.
+    """
+
+    is_raw_bundle: bool = isinstance(page, dict) and page.get("resourceType") == "Bundle"
+    page_entries: list | None = page.get("entry") if is_raw_bundle else getattr(page, "entry", None)  # type: ignore
+    if not page_entries:
+        return page
+
+    kept_entries: list = []
+    for entry in page_entries:
+        entry_key: str | None = get_entry_key(entry)
+        if entry_key and entry_key in seen:
+            continue
+        if entry_key:
+            seen.add(entry_key)
+        kept_entries.append(entry)
+
+    if len(kept_entries) < len(page_entries):
+        logger.debug(f"Removed {len(page_entries) - len(kept_entries)} entries already returned by another window")
+        if is_raw_bundle:
+            page["entry"] = kept_entries  # type: ignore
+            page["total"] = len(kept_entries)  # type: ignore
+        else:
+            page.entry = kept_entries  # type: ignore
+            page.total = len(kept_entries)  # type: ignore
+    return page
+
+
+def get_entry_key(entry: Any) -> str | None:
+    resource: Any = entry.get("resource") if isinstance(entry, dict) else entry.resource
+    if not resource:
+        return None
+    if isinstance(resource, dict):
+        resource_type, resource_id = resource.get("resourceType"), resource.get("id")
+    else:
+        resource_type, resource_id = resource.__resource_type__, resource.id
+    return f"{resource_type}/{resource_id}" if resource_id else None
@@ -1,64 +1,63 @@
 """File to handle all operations around Medication-related Resources"""
 
+from __future__ import annotations
+
+import asyncio
 import base64
 import json
 import logging
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from copy import deepcopy
-from typing import Any
+import threading
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any, Iterator
 
-import html2text
 import httpx
-from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
+from .binaryspill import BinarySpillWriter, get_spill_path, get_spilled_attachment_elements, remove_spilled_attachment
+from .cache import ReferenceCache
+from .metrics import count, count_response
 from .operationoutcomehelper import handle_operation_outcomes
+from .ratelimit import RateLimitedTransport, create_transport
+from .referenceresolver import get_reference_lookup
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    import html2text
+    from fhir.resources.R4B.bundle import Bundle, BundleEntry
+    from fhir.resources.R4B.documentreference import DocumentReference
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.documenthelper")
 
-cached_binary_resources: dict = {}
+# Binary content is only kept between expansions once a cache is set with cache.configure_reference_caches, since it can be large and is only readable by
+# callers whose scope includes Binary.Read
+cached_binary_resources: ReferenceCache | None = None
+binary_lookups: SingleFlight = SingleFlight()
+
+# See configure_html_conversion. html_converters holds the HTML2Text converter of each thread, see get_html_converter.
+html_conversion_executor: Executor | None = None
+html_offload_threshold: int = 32 * 1024
+html_converters: threading.local = threading.local()
 
+# See configure_binary_spill
+binary_spill_dir: str | None = None
+binary_spill_threshold: int = 1024 * 1024
 
-def expand_single_document_reference_content(resource: dict, base_url: str, query_headers: dict):
+
+def expand_single_document_reference_content(resource: dict, base_url: str, query_headers: dict, client: httpx.Client | None = None):
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
         return resource
 
-    transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
-    client: httpx.Client = httpx.Client(transport=transport)
+    if not client:
+        transport: RateLimitedTransport = create_transport()
+        client = httpx.Client(transport=transport)
 
     for i, content in enumerate(resource["content"]):
         if "url" in content["attachment"]:
             binary_url: str = content["attachment"]["url"]
-            if base_url + "/" + binary_url in cached_binary_resources:
-                logger.debug("Found Binary in cached resources")
-                content_data: str = cached_binary_resources[base_url + "/" + binary_url]
-            else:
-                logger.debug(f"Did not find Binary in cached resources, querying {base_url + '/' + binary_url}")
-                binary_url_lookup: httpx.Response = client.get(f"{base_url}/{binary_url}", headers=query_headers)
-
-                if binary_url_lookup.status_code != 200:
-                    logger.error(f"The query responded with a status code of {binary_url_lookup.status_code}")
-                    if binary_url_lookup.status_code == 403:
-                        logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Binary.Read.")
-                        if "WWW-Authenticate" in binary_url_lookup.headers:
-                            logger.error(binary_url_lookup.headers["WWW-Authenticate"])
-                    if binary_url_lookup.status_code == 400 and "json" in binary_url_lookup.headers["content-type"]:
-                        logger.error(binary_url_lookup.json())
-                try:
-                    if binary_url_lookup.status_code == 200 and "json" in binary_url_lookup.headers["content-type"]:
-                        content_data = binary_url_lookup.json()["data"]
-                    elif binary_url_lookup.status_code == 200:
-                        content_data = binary_url_lookup.text
-                    else:
-                        logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
-                        return None
-                except json.JSONDecodeError:
-                    logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
-                    logger.warning(f"Response code: {binary_url_lookup.status_code}")
-                    logger.warning(f"Response text: {binary_url_lookup.content}")
-                    logger.warning(f"Response headers: {binary_url_lookup.headers}")
-                    return None
-                cached_binary_resources[base_url + "/" + binary_url] = content_data
+            content_data: str | None = lookup_binary(client=client, binary_url=base_url + "/" + binary_url, query_headers=query_headers)
+            if content_data is None:
+                return None
 
             resource["content"][i]["attachment"]["data"] = content_data
             del resource["content"][i]["attachment"]["url"]
@@ -71,14 +70,9 @@ def expand_single_document_reference_content(resource: dict, base_url: str, quer
     if not html_contents:
         return None
 
-    for content in html_contents:
-        html_blurb: str = content["attachment"]["data"]
-        text_maker = html2text.HTML2Text()
-        text_maker.ignore_images = True
-        text_blurb: str = text_maker.handle(html_blurb)
-        text_blurb_bytes: bytes = text_blurb.encode("utf-8")
-        base64_text: str = base64.b64encode(text_blurb_bytes).decode("utf-8")
-        converted_htmls.append({"attachment": {"contentType": "text/plain", "data": base64_text}})
+    conversions: list[Future[str]] = [submit_attachment_conversion(content["attachment"]) for content in html_contents]
+    for conversion in conversions:
+        converted_htmls.append({"attachment": {"contentType": "text/plain", "data": conversion.result()}})
 
     resource["content"].extend(converted_htmls)
 
@@ -91,7 +85,111 @@ def expand_single_document_reference_content(resource: dict, base_url: str, quer
     return resource
 
 
-def expand_document_reference_content(entry_resource: BundleEntry) -> dict | None:
+def lookup_binary(client: httpx.Client, binary_url: str, query_headers: dict) -> str | None:
+    """
+    Retrieve the content of a Binary, first from the Binary cache and otherwise from the server.
+
+    Concurrent lookups of the same Binary from different threads share a single request and its content. Returns None if the Binary could not be
+    retrieved.
+    """
+
+    cached_content_data: str | None = get_cached_binary(binary_url)
+    if cached_content_data is not None:
+        return cached_content_data
+
+    def fetch_binary() -> str | None:
+        logger.debug(f"Did not find Binary in cached resources, querying {binary_url}")
+        binary_url_lookup: httpx.Response = client.get(binary_url, headers=query_headers)
+        count_response(binary_url_lookup, kind="Binary")
+        content_data: str | None = parse_binary_response(binary_url_lookup)
+        if content_data is not None:
+            set_cached_binary(binary_url, content_data)
+        return content_data
+
+    return binary_lookups.do(binary_url, fetch_binary)
+
+
+def get_cached_binary(binary_url: str) -> str | None:
+    """Function to get the content of a Binary from the Binary cache, or None if it is not cached or there is no Binary cache"""
+
+    if cached_binary_resources is None:
+        return None
+    cached_content_data: str | None = cached_binary_resources.get(binary_url)
+    if cached_content_data is not None:
+        logger.debug("Found Binary in cached resources")
+        count("cache_hits", reference="Binary")
+        return cached_content_data
+    count("cache_misses", reference="Binary")
+    return None
+
+
+def set_cached_binary(binary_url: str, content_data: str) -> None:
+    if cached_binary_resources is not None:
+        cached_binary_resources.set(binary_url, content_data)
+
+
+def lookup_binary_attachment(client: httpx.Client, binary_url: str, query_headers: dict) -> dict[str, Any] | None:
+    """
+    Retrieve the content of a Binary as the attachment elements that should hold it.
+
+    Without a spill directory this is {"data": <content>} from lookup_binary. With one set by configure_binary_spill, the response is streamed and content
+    larger than the spill threshold is written to a file in the spill directory instead of memory, giving the size and spill file extension from
+    binaryspill.get_spilled_attachment_elements. Returns None if the Binary could not be retrieved.
+    """
+
+    if binary_spill_dir is None:
+        content_data: str | None = lookup_binary(client=client, binary_url=binary_url, query_headers=query_headers)
+        return None if content_data is None else {"data": content_data}
+
+    cached_attachment: dict[str, Any] | None = get_cached_binary_attachment(binary_url)
+    if cached_attachment is not None:
+        return cached_attachment
+
+    def fetch_binary() -> dict[str, Any] | None:
+        logger.debug(f"Did not find Binary in cached resources, streaming {binary_url}")
+        with client.stream("GET", binary_url, headers=query_headers) as binary_url_lookup:
+            if binary_url_lookup.status_code != 200:
+                binary_url_lookup.read()
+                count_response(binary_url_lookup, kind="Binary")
+                parse_binary_response(binary_url_lookup)
+                return None
+            writer: BinarySpillWriter = BinarySpillWriter(spill_dir=binary_spill_dir, threshold=binary_spill_threshold)  # type: ignore
+            try:
+                for chunk in binary_url_lookup.iter_bytes():
+                    writer.write(chunk)
+            except BaseException:
+                writer.discard()
+                raise
+            count_response(binary_url_lookup, kind="Binary")
+        return finish_binary_attachment(binary_url, writer, binary_url_lookup)
+
+    return binary_lookups.do(binary_url, fetch_binary)
+
+
+def get_cached_binary_attachment(binary_url: str) -> dict[str, Any] | None:
+    """Function to get the attachment elements of a Binary that is already in the Binary cache. Spilled Binaries are not cached, see configure_binary_spill."""
+
+    cached_content_data: str | None = get_cached_binary(binary_url)
+    return None if cached_content_data is None else {"data": cached_content_data}
+
+
+def finish_binary_attachment(binary_url: str, writer: BinarySpillWriter, binary_url_lookup: httpx.Response) -> dict[str, Any] | None:
+    """Function to turn a fully streamed Binary response into attachment elements, keeping small content in memory (and the Binary cache) and large content on disk"""
+
+    is_json: bool = "json" in binary_url_lookup.headers.get("content-type", "")
+    try:
+        if writer.spilled:
+            return get_spilled_attachment_elements(writer.finish(is_json=is_json), writer.content_size)
+        content_data: str = json.loads(writer.buffer)["data"] if is_json else writer.buffer.decode(binary_url_lookup.encoding or "utf-8")
+    except (ValueError, KeyError):
+        logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
+        logger.warning(f"Response headers: {binary_url_lookup.headers}")
+        return None
+    set_cached_binary(binary_url, content_data)
+    return {"data": content_data}
+
+
+def expand_document_reference_content(entry_resource: BundleEntry, client: httpx.Client | None = None, base_url: str | None = None, query_headers: dict | None = None) -> dict | None:
     """
     Expand content attachments of a DocumentReference resource into data fields.
 
@@ -100,6 +198,7 @@ def expand_document_reference_content(entry_resource: BundleEntry) -> dict | Non
 
     Parameters:
     - entry_resource (dict): A Bundle.entry where resourceType is DocumentReference resource as a dictionary.
+    - client, base_url, query_headers (optional): The client, base URL, and headers used to resolve the attachments. Default to the ones passed to the last call of expand_document_references_in_bundle.
 
     Returns:
     - dict: The expanded DocumentReference resource with content data fields.
@@ -112,69 +211,141 @@ def expand_document_reference_content(entry_resource: BundleEntry) -> dict | Non
     This function handles HTML attachments by converting them to plain text if necessary.
     """
 
-    entry: dict[str, Any] = entry_resource.model_dump(exclude_none=True)
+    client = client or g_client
+    base_url = base_url or g_base_url
+    query_headers = query_headers if query_headers is not None else g_query_headers
+
+    return expand_document_reference_json(entry=entry_resource.model_dump(exclude_none=True), client=client, base_url=base_url, query_headers=query_headers)
+
+
+def expand_document_reference_json(entry: dict[str, Any], client: httpx.Client, base_url: str, query_headers: dict) -> dict[str, Any] | None:
+    """Function to expand the content attachments of a raw Bundle.entry dictionary in place, returning the entry or None if it should be removed from the Bundle"""
+
     resource: dict[str, Any] = entry["resource"]
 
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
-        return resource
+        return entry
 
-    for i, content in enumerate(resource["content"]):
+    for content in resource["content"]:
         if "url" in content["attachment"]:
             binary_url: str = content["attachment"]["url"]
-            if g_base_url + "/" + binary_url in cached_binary_resources:
-                logger.debug("Found Binary in cached resources")
-                content_data: str = cached_binary_resources[g_base_url + "/" + binary_url]
-            else:
-                logger.debug(f"Did not find Binary in cached resources, querying {g_base_url + '/' + binary_url}")
-                binary_url_lookup: httpx.Response = g_client.get(f"{g_base_url}/{binary_url}", headers=g_query_headers)
-
-                if binary_url_lookup.status_code != 200:
-                    logger.error(f"The query responded with a status code of {binary_url_lookup.status_code}")
-                    if binary_url_lookup.status_code == 403:
-                        logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Binary.Read.")
-                        if "WWW-Authenticate" in binary_url_lookup.headers:
-                            logger.error(binary_url_lookup.headers["WWW-Authenticate"])
-                    if binary_url_lookup.status_code == 400 and "json" in binary_url_lookup.headers["content-type"]:
-                        logger.error(binary_url_lookup.json())
-                try:
-                    if binary_url_lookup.status_code == 200 and "json" in binary_url_lookup.headers["content-type"]:
-                        content_data = binary_url_lookup.json()["data"]
-                    elif binary_url_lookup.status_code == 200:
-                        content_data = binary_url_lookup.text
-                    else:
-                        logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
-                        return None
-                except json.JSONDecodeError:
-                    logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
-                    logger.warning(f"Response code: {binary_url_lookup.status_code}")
-                    logger.warning(f"Response text: {binary_url_lookup.content}")
-                    logger.warning(f"Response headers: {binary_url_lookup.headers}")
-                    return None
-                cached_binary_resources[g_base_url + "/" + binary_url] = content_data
+            attachment_content: dict[str, Any] | None = lookup_binary_attachment(client=client, binary_url=base_url + "/" + binary_url, query_headers=query_headers)
+            if attachment_content is None:
+                remove_spilled_contents(resource)
+                return None
+            add_attachment_content(content["attachment"], attachment_content)
+
+    converted_resource: dict[str, Any] | None = convert_html_contents(resource)
+    if converted_resource is None:
+        remove_spilled_contents(resource)
+        return None
 
-            resource["content"][i]["attachment"]["data"] = content_data
-            del resource["content"][i]["attachment"]["url"]
+    entry["resource"] = converted_resource
+
+    return entry
+
+
+def add_attachment_content(attachment: dict[str, Any], attachment_content: dict[str, Any]) -> None:
+    """Function to add the content of a Binary to the attachment that referenced it, replacing Attachment.url unless the content was spilled to disk"""
+
+    if "data" in attachment_content:
+        del attachment["url"]
+    attachment.update(attachment_content)
+
+
+def remove_spilled_contents(resource: dict[str, Any]) -> None:
+    """Function to delete the spill files of a DocumentReference that is removed from the Bundle, since no caller will see them"""
+
+    for content in resource.get("content", []):
+        remove_spilled_attachment(content["attachment"])
+
+
+def parse_binary_response(binary_url_lookup: httpx.Response) -> str | None:
+    """Function to pull the content out of a Binary response, returning None and logging why if the Binary could not be retrieved"""
+
+    if binary_url_lookup.status_code != 200:
+        logger.error(f"The query responded with a status code of {binary_url_lookup.status_code}")
+        if binary_url_lookup.status_code == 403:
+            logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Binary.Read.")
+            if "WWW-Authenticate" in binary_url_lookup.headers:
+                logger.error(binary_url_lookup.headers["WWW-Authenticate"])
+        if binary_url_lookup.status_code == 400 and "json" in binary_url_lookup.headers["content-type"]:
+            logger.error(binary_url_lookup.json())
+    try:
+        if binary_url_lookup.status_code == 200 and "json" in binary_url_lookup.headers["content-type"]:
+            return binary_url_lookup.json()["data"]
+        elif binary_url_lookup.status_code == 200:
+            return binary_url_lookup.text
+        else:
+            logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
+            return None
+    except json.JSONDecodeError:
+        logger.warning("Skipping DocumentReference since Binary resource could not be retrieved")
+        logger.warning(f"Response code: {binary_url_lookup.status_code}")
+        logger.warning(f"Response text: {binary_url_lookup.content}")
+        logger.warning(f"Response headers: {binary_url_lookup.headers}")
+        return None
+
+
+def convert_html_contents(resource: dict[str, Any]) -> dict[str, Any] | None:
+    """
+    Convert the text/html attachments of an expanded DocumentReference into base64-encoded text/plain attachments.
+
+    The converted attachments are appended to DocumentReference.content and the first text/plain attachment is moved to the front. Returns None when the
+    DocumentReference has neither text/html nor text/plain content, meaning it should be removed from the returned Bundle. Large attachments are converted
+    on the executor set with configure_html_conversion.
+    """
+
+    html_contents: list[dict[str, Any]] | None = get_html_contents(resource)
+    if html_contents is None:
+        return None
+
+    conversions: list[Future[str]] = [submit_attachment_conversion(content["attachment"]) for content in html_contents]
+
+    return add_converted_contents(resource, [conversion.result() for conversion in conversions])
+
+
+async def convert_html_contents_async(resource: dict[str, Any]) -> dict[str, Any] | None:
+    """
+    Async version of convert_html_contents that never converts on the event loop
+
+    Attachments that convert_html_contents would send to the configured executor are sent there, and the rest are converted on the event loop's default
+    thread pool instead of the calling thread.
+    """
+
+    html_contents: list[dict[str, Any]] | None = get_html_contents(resource)
+    if html_contents is None:
+        return None
+
+    loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+    conversions: list[asyncio.Future[str]] = [
+        asyncio.wrap_future(submit_attachment_conversion(content["attachment"]))
+        if get_conversion_executor(get_attachment_size(content["attachment"])) is not None
+        else loop.run_in_executor(None, attachment_to_base64_text, content["attachment"])
+        for content in html_contents
+    ]
+
+    return add_converted_contents(resource, list(await asyncio.gather(*conversions)))
+
+
+def get_html_contents(resource: dict[str, Any]) -> list[dict[str, Any]] | None:
+    """Function to get the text/html contents of a DocumentReference, or None if it has neither text/html nor text/plain content"""
 
-    # Convert HTML to plain text
     html_contents = list(filter(lambda x: x["attachment"]["contentType"] == "text/html", resource["content"]))
     pt_contents = list(filter(lambda x: x["attachment"]["contentType"] == "text/plain", resource["content"]))
-    converted_htmls: list = []
 
     # This means the resource only has incompatible formats and needs to be removed from the returned Bundle
     if not html_contents and not pt_contents:
         return None
 
-    for content in html_contents:
-        html_blurb: str = content["attachment"]["data"]
-        text_maker = html2text.HTML2Text()
-        text_maker.ignore_images = True
-        text_blurb: str = text_maker.handle(html_blurb)
-        text_blurb_bytes: bytes = text_blurb.encode("utf-8")
-        base64_text: str = base64.b64encode(text_blurb_bytes).decode("utf-8")
-        converted_htmls.append({"attachment": {"contentType": "text/plain", "data": base64_text}})
+    return html_contents
 
-    resource["content"].extend(converted_htmls)
+
+def add_converted_contents(resource: dict[str, Any], base64_texts: list[str]) -> dict[str, Any]:
+    """Function to append converted text/plain attachments to a DocumentReference and move the first text/plain attachment to the front"""
+
+    resource["content"].extend({"attachment": {"contentType": "text/plain", "data": base64_text}} for base64_text in base64_texts)
 
     plain_text_content: list[tuple[int, Any]] = [(idx, content) for idx, content in enumerate(resource["content"]) if content["attachment"]["contentType"] == "text/plain"]
 
@@ -182,9 +353,129 @@ def expand_document_reference_content(entry_resource: BundleEntry) -> dict | Non
 
     resource["content"][0], resource["content"][plain_text_content[0][0]] = swap_contents
 
-    entry["resource"] = resource
+    return resource
 
-    return entry
+
+def configure_html_conversion(executor: Executor | None = None, offload_threshold: int | None = None) -> None:
+    """
+    Function to set where the HTML to plain text conversion of DocumentReference attachments runs
+
+    Converting HTML is CPU bound, so passing a ProcessPoolExecutor lets large notes convert on all cores instead of contending for the GIL in the thread
+    pool that retrieves them. Only attachments of at least offload_threshold characters are sent to the executor, since smaller ones convert faster than
+    they can be sent to another process. Passing no executor converts everything in the calling thread again.
+    """
+
+    global html_conversion_executor, html_offload_threshold
+    html_conversion_executor = executor
+    if offload_threshold is not None:
+        html_offload_threshold = offload_threshold
+
+
+def get_conversion_executor(size: int) -> Executor | None:
+    """Function to get the executor an HTML attachment of size characters (or bytes, once spilled) is converted on, or None to convert it in the caller"""
+
+    executor: Executor | None = html_conversion_executor
+    return executor if executor is not None and size >= html_offload_threshold else None
+
+
+def get_attachment_size(attachment: dict[str, Any]) -> int:
+    return attachment.get("size", 0) if get_spill_path(attachment) is not None else len(attachment["data"])
+
+
+def submit_html_conversion(html_blurb: str) -> Future[str]:
+    """Function to start converting an HTML attachment, on the configured executor if it is large enough and in the calling thread otherwise"""
+
+    executor: Executor | None = get_conversion_executor(len(html_blurb))
+    if executor is not None:
+        return executor.submit(html_to_base64_text, html_blurb)
+
+    conversion: Future[str] = Future()
+    try:
+        conversion.set_result(html_to_base64_text(html_blurb))
+    except Exception as exc:
+        conversion.set_exception(exc)
+    return conversion
+
+
+def submit_attachment_conversion(attachment: dict[str, Any]) -> Future[str]:
+    """Function to start converting an expanded text/html attachment, reading it from its spill file if its content was spilled to disk"""
+
+    spill_path: str | None = get_spill_path(attachment)
+    if spill_path is None:
+        return submit_html_conversion(attachment["data"])
+
+    executor: Executor | None = get_conversion_executor(get_attachment_size(attachment))
+    if executor is not None:
+        return executor.submit(spilled_html_to_base64_text, spill_path)
+
+    conversion: Future[str] = Future()
+    try:
+        conversion.set_result(spilled_html_to_base64_text(spill_path))
+    except Exception as exc:
+        conversion.set_exception(exc)
+    return conversion
+
+
+def attachment_to_base64_text(attachment: dict[str, Any]) -> str:
+    """Function to convert an expanded text/html attachment in the calling thread, reading it from its spill file if its content was spilled to disk"""
+
+    spill_path: str | None = get_spill_path(attachment)
+    return html_to_base64_text(attachment["data"]) if spill_path is None else spilled_html_to_base64_text(spill_path)
+
+
+def spilled_html_to_base64_text(spill_path: str) -> str:
+    """Function to convert a spilled HTML attachment to base64-encoded plain text, reading the file in the worker so only the path is sent to it"""
+
+    with open(spill_path, "rb") as spill_file:
+        return html_to_base64_text(spill_file.read().decode("utf-8", errors="replace"))
+
+
+def configure_binary_spill(spill_dir: str | None = None, threshold: int | None = None) -> None:
+    """
+    Function to set where large Binary content retrieved for DocumentReferences is kept
+
+    With a spill_dir, Binary responses are streamed and any larger than threshold bytes (default: 1 MiB) are written to a file in spill_dir instead of
+    being held in memory. The file holds what Attachment.data would have, so the base64 data of a JSON Binary. Instead of Attachment.data, the expanded
+    attachment keeps its Attachment.url and gets the content size in Attachment.size and the file URI in a binaryspill.SPILL_EXTENSION_URL extension.
+    Its content can be read with binaryspill.open_spilled_attachment.
+
+    Spill files belong to the caller, who should delete each with binaryspill.remove_spilled_attachment once it is read. Only the spill files of
+    DocumentReferences removed from the Bundle are deleted by this package. Passing no spill_dir keeps all Binary content in memory again.
+    """
+
+    global binary_spill_dir, binary_spill_threshold
+    binary_spill_dir = spill_dir
+    if threshold is not None:
+        binary_spill_threshold = threshold
+
+
+def get_html_converter() -> html2text.HTML2Text:
+    """
+    Function to get the HTML2Text converter of the calling thread, reset to the state it was created in
+
+    HTML2Text keeps parsing state between calls to handle, which would change the output of the next document, so the attributes it had when it was
+    created are restored before each use. Every list and dictionary among them starts out empty, so they are replaced by new empty ones.
+    """
+
+    text_maker: html2text.HTML2Text | None = getattr(html_converters, "text_maker", None)
+    if text_maker is None:
+        import html2text
+
+        text_maker = html2text.HTML2Text()
+        text_maker.ignore_images = True
+        html_converters.text_maker = text_maker
+        html_converters.initial_state = dict(text_maker.__dict__)
+    else:
+        text_maker.__dict__.update({name: type(value)() if isinstance(value, (list, dict)) else value for name, value in html_converters.initial_state.items()})
+    return text_maker
+
+
+def html_to_base64_text(html_blurb: str) -> str:
+    """Function to convert HTML to plain text and base64 encode it, defined at module level so it can run in a ProcessPoolExecutor worker"""
+
+    text_blurb: str = get_html_converter().handle(html_blurb)
+    text_blurb_bytes: bytes = text_blurb.encode("utf-8")
+    return base64.b64encode(text_blurb_bytes).decode("utf-8")
 
 
 def expand_document_references_in_bundle(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}) -> Bundle:
@@ -202,26 +493,230 @@ def expand_document_references_in_bundle(client: httpx.Client, input_bundle: Bun
     - Bundle: A modified FHIR Bundle with expanded content data or the original input Bundle if an error occurs.
     """
 
-    global cached_binary_resources, g_client, g_base_url, g_query_headers
-    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+    from fhir.resources.R4B.bundle import Bundle
 
-    returned_resources: list[BundleEntry] | None = input_bundle.entry
-    if not returned_resources:
+    if not input_bundle.entry:
         return input_bundle
-    output_bundle: dict = deepcopy(input_bundle).model_dump(exclude_none=True)
 
-    with ThreadPoolExecutor() as executor:
-        future_to_entry: dict[Future[dict[str, Any] | None], BundleEntry] = {executor.submit(expand_document_reference_content, entry): entry for entry in returned_resources}
+    return Bundle.model_validate(expand_document_references_in_bundle_json(client=client, bundle_json=input_bundle.model_dump(exclude_none=True), base_url=base_url, query_headers=query_headers))
+
+
+def expand_document_references_in_bundle_json(client: httpx.Client, bundle_json: dict[str, Any], base_url: str, query_headers: dict = {}) -> dict[str, Any]:
+    """
+    Raw JSON version of expand_document_references_in_bundle that expands the entries of a Bundle dictionary in place and returns it.
+
+    The search pipeline uses this so each page is only validated into a Bundle once, after it has been filtered and expanded. Entries keep their original
+    order.
+    """
+
+    global g_client, g_base_url, g_query_headers
+    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+    saved_calls_before: int = binary_lookups.saved_calls
 
-        expanded_entries: list = []
-        for future in as_completed(future_to_entry):
-            entry: dict[str, Any] | None = future.result()
-            if entry:
-                expanded_entries.append(entry)
+    with ThreadPoolExecutor() as executor:
+        expanded_entries: list[dict[str, Any] | None] = list(executor.map(lambda entry: expand_document_reference_json(entry, client, base_url, query_headers), entries))
     expanded_entries_clean: list[dict[str, Any]] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(expanded_entries_clean), reason="expansion", resource_type="DocumentReference")
+
+    logger.debug(f"{binary_lookups.saved_calls - saved_calls_before} Binary lookups were shared with an identical lookup already in flight")
+
+    bundle_json["entry"] = expanded_entries_clean
+    bundle_json["total"] = len(expanded_entries_clean)
+    return bundle_json
+
+
+def iter_expanded_document_references(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}, prefetch: int = 4) -> Iterator[BundleEntry]:
+    """
+    Expand the DocumentReference entries of a Bundle one at a time, yielding each expanded entry in the original order.
+
+    Unlike expand_document_references_in_bundle, only the documents being expanded (at most prefetch at once) and the one just yielded are held in memory,
+    and nothing is retrieved for documents the caller stops iterating before. DocumentReferences without usable text content are skipped.
+
+    Parameters:
+    - input_bundle (Bundle): A Bundle of DocumentReferences, for example from run_fhir_query with expand_documents=False.
+    - base_url (str): The base URL used for making HTTP requests to resolve content URLs.
+    - query_headers (dict, optional): Additional headers for the HTTP requests (default: {}).
+    - prefetch (int, optional): The number of documents expanded ahead of the one being yielded (default: 4).
+    """
+
+    from fhir.resources.R4B.bundle import BundleEntry
+
+    returned_resources: list[BundleEntry] = input_bundle.entry or []
+    pending: deque[Future[dict[str, Any] | None]] = deque()
+
+    with ThreadPoolExecutor(max_workers=max(prefetch, 1)) as executor:
+        try:
+            for entry in returned_resources:
+                pending.append(executor.submit(expand_document_reference_content, entry, client, base_url, query_headers))
+                if len(pending) >= max(prefetch, 1):
+                    expanded_entry: dict[str, Any] | None = pending.popleft().result()
+                    if expanded_entry:
+                        yield BundleEntry.model_validate(expanded_entry)
+            while pending:
+                expanded_entry = pending.popleft().result()
+                if expanded_entry:
+                    yield BundleEntry.model_validate(expanded_entry)
+        finally:
+            for future in pending:
+                future.cancel()
+
+
+class BinaryHandle:
+    """
+    Handle to the Binary content of a DocumentReference attachment that is only retrieved when it is accessed.
+
+    Retrieved content goes through the Binary cache and single-flight lookups shared with the eager expansion, so a handle does not hold the content itself.
+    """
+
+    def __init__(self, client: httpx.Client, base_url: str, attachment: dict[str, Any], query_headers: dict) -> None:
+        self.client: httpx.Client = client
+        self.url: str = f"{base_url}/{attachment['url']}"
+        self.content_type: str | None = attachment.get("contentType")
+        self.query_headers: dict = query_headers
+
+    def get_data(self) -> str | None:
+        """Retrieve the content of the Binary, or None if it could not be retrieved"""
+
+        return lookup_binary(client=self.client, binary_url=self.url, query_headers=self.query_headers)
+
+    def get_plain_text_data(self) -> str | None:
+        """Retrieve the content of the Binary as base64-encoded plain text, converting it from HTML the same way the expansion does"""
+
+        content_data: str | None = self.get_data()
+        if content_data is None or self.content_type != "text/html":
+            return content_data
+        return submit_html_conversion(content_data).result()
+
+    def __repr__(self) -> str:
+        return f"BinaryHandle(url={self.url!r}, content_type={self.content_type!r})"
+
+
+def get_binary_handles(client: httpx.Client, document_reference: DocumentReference | dict[str, Any], base_url: str, query_headers: dict = {}) -> list[BinaryHandle]:
+    """
+    Function to get a BinaryHandle for every attachment of a DocumentReference that references its content by URL
+
+    Use with run_fhir_query(..., expand_documents=False) to look at DocumentReference metadata first and only retrieve the notes that are needed.
+    """
+
+    resource: dict[str, Any] = document_reference if isinstance(document_reference, dict) else document_reference.model_dump(exclude_none=True)
+    return [BinaryHandle(client=client, base_url=base_url, attachment=content["attachment"], query_headers=query_headers) for content in resource.get("content", []) if "url" in content["attachment"]]
 
-    if len(cached_binary_resources.keys()) != 0:
-        cached_binary_resources = {}
-    output_bundle["entry"] = expanded_entries_clean
-    output_bundle["total"] = len(expanded_entries_clean)
-    return Bundle.model_validate(output_bundle)
+
+async def expand_document_references_in_bundle_async(
+    client: httpx.AsyncClient, input_bundle: Bundle, base_url: str, query_headers: dict = {}, max_concurrency: int = 10, reference_lookups: dict[str, asyncio.Task] | None = None
+) -> Bundle:
+    """
+    Async version of expand_document_references_in_bundle that shares the caller's httpx.AsyncClient.
+
+    Parameters:
+    - client (httpx.AsyncClient): The client used for all Binary lookups.
+    - input_bundle (Bundle): The input FHIR Bundle containing DocumentReference entries to be processed.
+    - base_url (str): The base URL used for making HTTP requests to resolve content URLs.
+    - query_headers (dict, optional): Additional headers for the HTTP requests (default: {}).
+    - max_concurrency (int, optional): The maximum number of Binary lookups in flight at once (default: 10).
+    - reference_lookups (dict, optional): A dictionary of in-flight lookups keyed by url, shared between concurrent calls so each Binary is only requested once across them.
+      The lookups of this Bundle are removed from it once the Bundle is expanded.
+
+    Returns:
+    - Bundle: A modified FHIR Bundle with expanded content data. Entries keep their original order.
+
+    Each distinct Binary is only requested once, even when several DocumentReferences point to it at the same time.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if not input_bundle.entry:
+        return input_bundle
+
+    return Bundle.model_validate(
+        await expand_document_references_in_bundle_json_async(
+            client=client,
+            bundle_json=input_bundle.model_dump(exclude_none=True),
+            base_url=base_url,
+            query_headers=query_headers,
+            max_concurrency=max_concurrency,
+            reference_lookups=reference_lookups,
+        )
+    )
+
+
+async def expand_document_references_in_bundle_json_async(
+    client: httpx.AsyncClient, bundle_json: dict[str, Any], base_url: str, query_headers: dict = {}, max_concurrency: int = 10, reference_lookups: dict[str, asyncio.Task] | None = None
+) -> dict[str, Any]:
+    """Async version of expand_document_references_in_bundle_json, see expand_document_references_in_bundle_async for the parameters"""
+
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+    binary_lookups: dict[str, asyncio.Task] = reference_lookups if reference_lookups is not None else {}
+    requested_binary_urls: set[str] = set()
+
+    async def lookup_binary(binary_url: str) -> dict[str, Any] | None:
+        cached_attachment: dict[str, Any] | None = get_cached_binary_attachment(binary_url)
+        if cached_attachment is not None:
+            return cached_attachment
+        async with semaphore:
+            logger.debug(f"Querying {binary_url}")
+            if binary_spill_dir is None:
+                binary_url_lookup: httpx.Response = await client.get(binary_url, headers=query_headers)
+                count_response(binary_url_lookup, kind="Binary")
+            else:
+                async with client.stream("GET", binary_url, headers=query_headers) as binary_url_lookup:
+                    if binary_url_lookup.status_code != 200:
+                        await binary_url_lookup.aread()
+                        count_response(binary_url_lookup, kind="Binary")
+                    else:
+                        writer: BinarySpillWriter = BinarySpillWriter(spill_dir=binary_spill_dir, threshold=binary_spill_threshold)
+                        try:
+                            async for chunk in binary_url_lookup.aiter_bytes():
+                                writer.write(chunk)
+                        except BaseException:
+                            writer.discard()
+                            raise
+                        count_response(binary_url_lookup, kind="Binary")
+                        return finish_binary_attachment(binary_url, writer, binary_url_lookup)
+        content_data: str | None = parse_binary_response(binary_url_lookup)
+        if content_data is None:
+            return None
+        set_cached_binary(binary_url, content_data)
+        return {"data": content_data}
+
+    async def expand_entry(entry: dict[str, Any]) -> dict[str, Any] | None:
+        resource: dict[str, Any] = entry["resource"]
+        if resource["resourceType"] == "OperationOutcome":
+            handle_operation_outcomes(resource=resource)
+            return entry
+
+        for content in resource["content"]:
+            if "url" in content["attachment"]:
+                binary_url: str = f"{base_url}/{content['attachment']['url']}"
+                requested_binary_urls.add(binary_url)
+                attachment_content: dict[str, Any] | None = await get_reference_lookup(binary_lookups, binary_url, lookup_binary)
+                if attachment_content is None:
+                    remove_spilled_contents(resource)
+                    return None
+                add_attachment_content(content["attachment"], attachment_content)
+
+        converted_resource: dict[str, Any] | None = await convert_html_contents_async(resource)
+        if converted_resource is None:
+            remove_spilled_contents(resource)
+            return None
+        entry["resource"] = converted_resource
+        return entry
+
+    expanded_entries: list[dict[str, Any] | None] = await asyncio.gather(*[expand_entry(entry) for entry in entries])
+    # Binary content can be large, so unlike Medications and Encounters it is not held in the shared lookups for the rest of a batch once consumed
+    for binary_url in requested_binary_urls:
+        binary_lookups.pop(binary_url, None)
+
+    expanded_entries_clean: list[dict[str, Any]] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(expanded_entries_clean), reason="expansion", resource_type="DocumentReference")
+    bundle_json["entry"] = expanded_entries_clean
+    bundle_json["total"] = len(expanded_entries_clean)
+    return bundle_json
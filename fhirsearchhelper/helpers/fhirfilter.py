@@ -1,21 +1,35 @@
 """File to perform filtering of returned FHIR resources using output from gap analysis"""
 
+from __future__ import annotations
+
 import json
 import logging
-from copy import deepcopy
+import re
+from functools import lru_cache
 from pathlib import Path
-
-import fhirpathpy
-from fhir.resources.R4B.bundle import Bundle, BundleEntry
+from typing import TYPE_CHECKING, Any, Callable
+from urllib.parse import unquote
 
 from ..models.models import QuerySearchParams
+from .metrics import count
+from .searchmatching import SearchValue, element_matches
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.fhirfilter")
 
+RESOLVE_PATTERN: re.Pattern = re.compile(r"\.where\(resolve\(\) is (\w+)\)")
+
+
+EntryPredicate = Callable[[dict[str, Any]], bool]
+
 
 def filter_bundle(input_bundle: Bundle, search_params: QuerySearchParams, gap_analysis_output: list[str]) -> Bundle:
     """Function that takes an input bundle, the original search params, and the output from the gap analysis to filter a Bundle"""
 
+    from fhir.resources.R4B.bundle import Bundle
+
     logger.debug("Filtering Bundle using gap analysis output...")
 
     if not gap_analysis_output:
@@ -24,90 +38,153 @@ def filter_bundle(input_bundle: Bundle, search_params: QuerySearchParams, gap_an
     returned_resources: list[BundleEntry] | None = input_bundle.entry
     if not returned_resources:
         return input_bundle
-    filtered_entries: list[BundleEntry] = []
-    output_bundle: Bundle = deepcopy(input_bundle)
 
+    # The Bundle is dumped once and only the entries that survive filtering are validated again
+    output_bundle_json: dict[str, Any] = filter_bundle_json(input_bundle.model_dump(mode="json", exclude_none=True), search_params, gap_analysis_output)
+
+    return Bundle.model_validate(output_bundle_json)
+
+
+def filter_bundle_json(bundle_json: dict[str, Any], search_params: QuerySearchParams, gap_analysis_output: list[str]) -> dict[str, Any]:
+    """
+    Filter a searchset Bundle in its raw JSON form using the output from the gap analysis.
+
+    Each search parameter in gap_analysis_output is compiled once into a predicate over a raw entry dictionary, so filtering needs neither a copy of the
+    Bundle nor a pydantic model per entry. Resources are kept when they match every search parameter and any of the comma separated values of each. Entries whose resource is not of the searched resource type (such as OperationOutcomes) are kept so they can
+    be handled during validation. Returns a shallow copy of bundle_json with the filtered entries and Bundle.total set to the number of matching
+    resources.
+    """
+
+    if not gap_analysis_output:
+        return bundle_json
+
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+
+    search_resource_type: str = search_params.resourceType
+    predicates: list[EntryPredicate] = []
     for filter_sp in gap_analysis_output:
-        filter_sp_value: str | int = search_params.searchParams[filter_sp]
-        if "-" in filter_sp:
-            filter_sp = filter_sp[0].lower() + "".join(x.capitalize() for x in filter_sp.lower().split("-"))[1:]
-        logger.debug(f"Working on filtering for search parameter {filter_sp}")
-        match filter_sp:
-            case "code":
-                code_sp_multiple_codes = filter_sp_value.split("%2C")
-                if len(code_sp_multiple_codes) > 1:
-                    logger.debug(f"There are a total of {len(code_sp_multiple_codes)} codes in the search parameter")
-                for code_sp_single_code in code_sp_multiple_codes:
-                    code_sp_split: list[str] = code_sp_single_code.split("%7C")
-                    if len(code_sp_split) == 2:  # Case when there is a | separator
-                        code_sp_system: str = code_sp_split[0]
-                        code_sp_code: str = code_sp_split[1]
-                    else:
-                        code_sp_system = ""
-                        code_sp_code = code_sp_split[0]
-                    for entry in returned_resources:
-                        if not entry.resource:
-                            continue
-                        if entry.resource.__resource_type__ == "MedicationRequest":
-                            if "coding" not in entry.resource.medicationCodeableConcept.dict():
-                                logger.debug("Code does not have a coding, this MedicationRequest resource does not match")
-                                continue
-                            if code_sp_system and list(filter(lambda x: x.system == code_sp_system and x.code == code_sp_code, entry.resource.medicationCodeableConcept.coding)):
-                                logger.debug("Found MedicationRequest that matched both system and code for code element")
-                                filtered_list = [(idx, med) for idx, med in enumerate(entry.resource.medicationCodeableConcept.coding) if med.system == code_sp_system and med.code == code_sp_code]
-                                swap_entries = entry.resource.medicationCodeableConcept.coding[filtered_list[0][0]], entry.resource.medicationCodeableConcept.coding[0]
-                                entry.resource.medicationCodeableConcept.coding[0], entry.resource.medicationCodeableConcept.coding[filtered_list[0][0]] = swap_entries
-                                filtered_entries.append(entry)
-                            elif any([coding.code == code_sp_code for coding in entry.resource.medicationCodeableConcept.coding]):
-                                logger.debug("Found MedicationRequest that matches code (system was not provided in original query)")
-                                filtered_list = [(idx, med) for idx, med in enumerate(entry.resource.medicationCodeableConcept.coding) if med.code == code_sp_code]
-                                swap_entries = entry.resource.medicationCodeableConcept.coding[filtered_list[0][0]], entry.resource.medicationCodeableConcept.coding[0]
-                                entry.resource.medicationCodeableConcept.coding[0], entry.resource.medicationCodeableConcept.coding[filtered_list[0][0]] = swap_entries
-                                filtered_entries.append(entry)
-                        else:
-                            if "coding" not in entry.resource.code.dict():
-                                logger.debug(f"Code does not have a coding, this {entry.resource.__resource_type__} resource does not match")
-                                continue
-                            if code_sp_system and list(filter(lambda x: x.system == code_sp_system and x.code == code_sp_code, entry.resource.code.coding)):
-                                logger.debug("Found resource that matched both system and code for code element")
-                                filtered_entries.append(entry)
-                            elif any([coding.code == code_sp_code for coding in entry.resource.code.coding]):
-                                logger.debug("Found resource that matches code (system was not provided in original query)")
-                                filtered_entries.append(entry)
-            case "category":
-                category_sp_split: list[str] = filter_sp_value.split("|")
-                if len(category_sp_split) == 2:  # Case when there is a | separator
-                    category_sp_system: str = category_sp_split[0]
-                    category_sp_code: str = category_sp_split[1]
-                else:
-                    category_sp_system = ""
-                    category_sp_code = category_sp_split[0]
-                for entry in returned_resources:
-                    if not entry.resource:
-                        continue
-                    if category_sp_system and list(filter(lambda x: x.system == category_sp_system and x.code == category_sp_code, entry.resource.category)):
-                        filtered_entries.append(entry)
-                    elif any([coding.code == category_sp_code for coding in entry.resource.category.coding]):
-                        filtered_entries.append(entry)
-            case "clinicalStatus":
-                for entry in returned_resources:
-                    if entry.model_dump(exclude_none=True)["resource"][filter_sp]["coding"][0]["code"] in filter_sp_value.split(","):
-                        filtered_entries.append(entry)
-            case _:
-                for entry in returned_resources:
-                    if entry.model_dump(exclude_none=True)["resource"][filter_sp] == filter_sp_value:
-                        filtered_entries.append(entry)
-
-    output_bundle.entry = filtered_entries
-    output_bundle.total = len(filtered_entries)
-
-    return output_bundle
+        logger.debug(f"Compiling filter for search parameter {filter_sp}")
+        predicates.append(compile_search_param_filter(search_resource_type, filter_sp, search_params.searchParams[filter_sp]))
+
+    # Single pass over the entries: a resource has to match every search parameter (AND) and any of the comma separated values of each (OR)
+    filtered_entries: list[dict[str, Any]] = []
+    other_entries: list[dict[str, Any]] = []
+    for entry in entries:
+        resource: dict[str, Any] = entry.get("resource", {})
+        if resource.get("resourceType") != search_resource_type:
+            other_entries.append(entry)
+        elif all(predicate(resource) for predicate in predicates):
+            filtered_entries.append(entry)
+
+    output_bundle_json: dict[str, Any] = dict(bundle_json)
+    output_bundle_json["entry"] = filtered_entries + other_entries
+    output_bundle_json["total"] = len(filtered_entries)
+    count("entries_dropped", len(entries) - len(output_bundle_json["entry"]), reason="filter", resource_type=search_resource_type)
+
+    return output_bundle_json
+
+
+class TokenSet:
+    """
+    Hashed (system, code) membership for the comma separated values of a token search parameter, such as 'system|code,code' or its URL encoded form.
+
+    Values without a system (code) match a Coding with that code in any system, while values with an empty system (|code) only match a Coding with that
+    code and no system.
+    """
+
+    def __init__(self, filter_sp_value: str | int) -> None:
+        self.system_codes: set[tuple[str | None, str]] = set()
+        self.codes: set[str] = set()
+        for single_value in unquote(str(filter_sp_value)).split(","):
+            system, separator, code = single_value.partition("|")
+            if separator:
+                self.system_codes.add((system or None, code))
+            else:
+                self.codes.add(system)
+
+    def __len__(self) -> int:
+        return len(self.system_codes) + len(self.codes)
+
+    def matches(self, coding: dict[str, Any]) -> bool:
+        code: str | None = coding.get("code")
+        return code in self.codes or (coding.get("system"), code) in self.system_codes
+
+
+@lru_cache(maxsize=1024)
+def compile_search_param_filter(resource_type: str, filter_sp: str, filter_sp_value: str | int) -> EntryPredicate:
+    """
+    Compile a single search parameter into a predicate over a raw resource dictionary.
+
+    Compiled predicates are cached, so the same parameter and value across pages and queries is only parsed once. Parameters without a hand-written
+    case here are matched with their FHIRPath expression (see compile_fhirpath_filter), falling back to comparing the top-level element.
+    """
+
+    filter_sp_name: str = filter_sp
+    if "-" in filter_sp:
+        filter_sp = filter_sp[0].lower() + "".join(x.capitalize() for x in filter_sp.lower().split("-"))[1:]
+
+    match filter_sp:
+        case "code":
+            code_tokens: TokenSet = TokenSet(filter_sp_value)
+            if len(code_tokens) > 1:
+                logger.debug(f"There are a total of {len(code_tokens)} codes in the search parameter")
+            code_element: str = "medicationCodeableConcept" if resource_type == "MedicationRequest" else "code"
+
+            def match_code(resource: dict[str, Any]) -> bool:
+                codings: list[dict[str, Any]] = resource.get(code_element, {}).get("coding", [])
+                if not codings:
+                    logger.debug(f"Code does not have a coding, this {resource_type} resource does not match")
+                    return False
+                for idx, coding in enumerate(codings):
+                    if code_tokens.matches(coding):
+                        if resource_type == "MedicationRequest":
+                            # Move the matching coding to the front so downstream consumers see the queried code first
+                            codings[0], codings[idx] = codings[idx], codings[0]
+                        return True
+                return False
+
+            return match_code
+        case "category":
+            category_tokens: TokenSet = TokenSet(filter_sp_value)
+
+            def match_category(resource: dict[str, Any]) -> bool:
+                return any(category_tokens.matches(coding) for category in resource.get("category", []) for coding in category.get("coding", []))
+
+            return match_category
+        case "clinicalStatus":
+            status_codes: set[str] = set(unquote(str(filter_sp_value)).split(","))
+
+            def match_clinical_status(resource: dict[str, Any]) -> bool:
+                codings: list[dict[str, Any]] = resource.get("clinicalStatus", {}).get("coding", [])
+                return bool(codings) and codings[0].get("code") in status_codes
+
+            return match_clinical_status
+        case _:
+            fhirpath_predicate: EntryPredicate | None = compile_fhirpath_filter(resource_type, filter_sp_name, filter_sp_value)
+            if fhirpath_predicate is not None:
+                return fhirpath_predicate
+
+            element: str = filter_sp
+
+            def match_element(resource: dict[str, Any]) -> bool:
+                return resource.get(element) == filter_sp_value
+
+            return match_element
 
 
 def filter_bundle_new(input_bundle: Bundle, search_params: QuerySearchParams, gap_analysis_output: list[str]) -> Bundle:
-    """Function that takes an input bundle, the original search params, and the output from the gap analysis to filter a Bundle"""
+    """
+    Function that takes an input bundle, the original search params, and the output from the gap analysis to filter a Bundle
 
-    logger.debug("Filtering Bundle using gap analysis output...")
+    Unlike filter_bundle, every search parameter is evaluated generically using its FHIRPath expression from the R4 search parameter table and the
+    token, date, string, reference, or quantity semantics of the values it selects. Search parameters without a usable expression are not filtered on.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    logger.debug("Filtering Bundle using gap analysis output and FHIRPath...")
 
     if not gap_analysis_output:
         return input_bundle
@@ -115,28 +192,118 @@ def filter_bundle_new(input_bundle: Bundle, search_params: QuerySearchParams, ga
     returned_resources: list[BundleEntry] | None = input_bundle.entry
     if not returned_resources:
         return input_bundle
-    filtered_entries: list[BundleEntry] = []
-    output_bundle: Bundle = deepcopy(input_bundle)
+
+    predicates: list[EntryPredicate] = []
+    for filter_sp in gap_analysis_output:
+        predicate: EntryPredicate | None = compile_fhirpath_filter(search_params.resourceType, filter_sp, search_params.searchParams[filter_sp])
+        if predicate is None:
+            logger.warning(f"Search parameter {filter_sp} could not be filtered for locally, so no {search_params.resourceType} resources were removed for it")
+            continue
+        predicates.append(predicate)
+
+    output_bundle_json: dict[str, Any] = input_bundle.model_dump(mode="json", exclude_none=True)
+    filtered_entries: list[dict[str, Any]] = [
+        entry for entry in output_bundle_json["entry"] if entry.get("resource", {}).get("resourceType") == search_params.resourceType and all(predicate(entry["resource"]) for predicate in predicates)
+    ]
+
+    output_bundle_json["entry"] = filtered_entries
+    output_bundle_json["total"] = len(filtered_entries)
+
+    return Bundle.model_validate(output_bundle_json)
+
+
+@lru_cache(maxsize=None)
+def load_search_param_expressions() -> dict[str, dict[str, dict[str, Any]]]:
+    """Function to load the packaged R4 resource type -> search parameter -> FHIRPath expression table, read once per process"""
 
     with open(f"{Path(__file__).parents[1]}/resources/fhir_r4_search_params.json", "r") as fin:
-        r4_sp_json = json.load(fin)
+        return json.load(fin)
 
-    for filter_sp in gap_analysis_output:
-        filter_sp_value: str | int | dict = search_params.searchParams[filter_sp]
-        print("Filter sp value", filter_sp_value)
-        filter_sp_fhirpath = r4_sp_json[search_params.resourceType][filter_sp]["fhirpath"]
-
-        for entry in returned_resources:
-            resource_sp_output = fhirpathpy.evaluate(entry.resource, filter_sp_fhirpath)
-            if isinstance(filter_sp_value, str) and "%7C" in filter_sp_value:
-                logger.debug("The filter search parameter value is of type code")
-                filter_sp_value = {"system": filter_sp_value.split("%7C")[0], "code": filter_sp_value.split("%7C")[1]}
-                logger.debug("Updated filter search parameter value to be a dictionary")
-                print(filter_sp_value)
-            if filter_sp_value in resource_sp_output:  # type: ignore for now bc this a work in progress function
-                filtered_entries.append(entry)
-
-    output_bundle.entry = filtered_entries
-    output_bundle.total = len(filtered_entries)
-
-    return output_bundle
+
+def get_search_param_info(resource_type: str, search_param: str) -> dict[str, Any] | None:
+    """Function to get the entry of a search parameter in the R4 search parameter table, falling back to the parameters defined on Resource such as _lastUpdated"""
+
+    search_param_expressions: dict[str, dict[str, dict[str, Any]]] = load_search_param_expressions()
+    return search_param_expressions.get(resource_type, {}).get(search_param) or search_param_expressions["Resource"].get(search_param)
+
+
+def get_search_param_type(resource_type: str, search_param: str) -> str | None:
+    """Function to get the type of a search parameter (token, string, date, reference, quantity, uri, composite, or special), or None if it is unknown"""
+
+    search_param_info: dict[str, Any] | None = get_search_param_info(resource_type, search_param)
+    return search_param_info.get("type") if search_param_info else None
+
+
+@lru_cache(maxsize=None)
+def compile_search_param_expression(resource_type: str, search_param: str) -> tuple[Callable[[dict[str, Any]], list[Any]], str | None] | None:
+    """
+    Compile the FHIRPath expression of a search parameter with fhirpathpy, returning the compiled expression and the resource type its references must
+    point to, if any.
+
+    Compiled expressions are cached for the life of the process. Returns None for unknown search parameters and for composite search parameters, which
+    have no single expression.
+    """
+
+    import fhirpathpy
+    from fhirpathpy.models import models
+
+    search_param_info: dict[str, Any] | None = get_search_param_info(resource_type, search_param)
+    if not search_param_info or not search_param_info.get("fhirpath"):
+        return None
+    expression: str = search_param_info["fhirpath"]
+    if expression.startswith("On "):
+        return None
+    if expression.startswith("Resource."):
+        expression = f"{resource_type}.{expression.removeprefix('Resource.')}"
+
+    # fhirpathpy does not implement resolve(), so a where(resolve() is <type>) restriction is checked against the reference string instead
+    target_type: str | None = None
+    resolve_match: re.Match | None = RESOLVE_PATTERN.search(expression)
+    if resolve_match:
+        target_type = resolve_match.group(1)
+        expression = RESOLVE_PATTERN.sub("", expression)
+
+    try:
+        compiled_expression: Callable[[dict[str, Any]], list[Any]] = fhirpathpy.compile(expression, models["r4"])
+    except Exception as exc:
+        logger.warning(f"Unable to compile the FHIRPath expression {expression} for {resource_type}.{search_param}: {exc}")
+        return None
+    return compiled_expression, target_type
+
+
+@lru_cache(maxsize=1024)
+def compile_fhirpath_filter(resource_type: str, filter_sp: str, filter_sp_value: str | int) -> EntryPredicate | None:
+    """
+    Compile a single search parameter into a predicate over a raw resource dictionary using its FHIRPath expression.
+
+    A resource matches when any element selected by the expression matches any of the comma separated values, compared with the semantics of the search
+    parameter's type from the R4 search parameter table. Supported modifiers are :not, :missing, :exact, :contains, and :text. Returns None when the search
+    parameter has no usable FHIRPath expression.
+    """
+
+    search_param, _, modifier = filter_sp.partition(":")
+    compiled: tuple[Callable[[dict[str, Any]], list[Any]], str | None] | None = compile_search_param_expression(resource_type, search_param)
+    if compiled is None:
+        return None
+    compiled_expression, target_type = compiled
+    search_type: str | None = get_search_param_type(resource_type, search_param)
+
+    def evaluate(resource: dict[str, Any]) -> list[Any]:
+        try:
+            return compiled_expression(resource)
+        except Exception as exc:
+            logger.debug(f"Unable to evaluate {resource_type}.{search_param} for resource {resource.get('id')}: {exc}")
+            return []
+
+    if modifier == "missing":
+        is_missing: bool = str(filter_sp_value).lower() == "true"
+        return lambda resource: (not evaluate(resource)) == is_missing
+
+    search_values: list[SearchValue] = [SearchValue(value, modifier or None) for value in unquote(str(filter_sp_value)).split(",")]
+
+    def match_resource(resource: dict[str, Any]) -> bool:
+        return any(element_matches(element, search_value, target_type, search_type) for element in evaluate(resource) for search_value in search_values)
+
+    if modifier == "not":
+        return lambda resource: not match_resource(resource)
+    return match_resource
@@ -1,47 +1,76 @@
 """File to perform the search parameter gap analysis"""
 
+from __future__ import annotations
+
 import logging
+from typing import TYPE_CHECKING
 
-from fhir.resources.R4B.capabilitystatement import CapabilityStatementRestResourceSearchParam
+from ..models.models import QuerySearchParams, SearchParamCondition, SearchParamIndex, SupportedSearchParams
 
-from ..models.models import QuerySearchParams, SupportedSearchParams
+if TYPE_CHECKING:
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatementRestResourceSearchParam
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.gapanalysis")
 
 
-def run_gap_analysis(supported_search_params: list[SupportedSearchParams], query_search_params: QuerySearchParams) -> list[str]:
-    resource_type = query_search_params.resourceType
-
-    resouce_supported_search_params: SupportedSearchParams = list(filter(lambda x: x.resourceType == resource_type, supported_search_params))[0]
-
-    query_params_names = list(query_search_params.searchParams.keys())
-    temp_supported_params_names: list[str] = [rsc.name for rsc in resouce_supported_search_params.searchParams if rsc.name]
-
-    supported_params_names = []
-    for name in temp_supported_params_names:
-        search_param_obj: CapabilityStatementRestResourceSearchParam = list(filter(lambda x: x.name == name, resouce_supported_search_params.searchParams))[0]
-        if search_param_obj.extension:
-            filtered_ext_list = list(filter(lambda x: x.url == "true-when", search_param_obj.extension))  # type: ignore
-            if filtered_ext_list:
-                if "==" in filtered_ext_list[0].valueString:
-                    field, value = filtered_ext_list[0].valueString.split("==")
-                    if field in query_params_names and query_search_params.searchParams[field] == value:
-                        supported_params_names.append(name)
-                elif " in " in filtered_ext_list[0].valueString:
-                    field, values = filtered_ext_list[0].valueString.split(" in ")
-                    values = [value.strip() for value in values.strip("[").strip("]").split(",")]
-                    if (
-                        field in query_params_names
-                        and len(query_search_params.searchParams[field].split(",")) > 1
-                        and all([sp_value in values for sp_value in query_search_params.searchParams[field].split(",")])
-                    ):
-                        supported_params_names.append(name)
-                        continue
-                    if field in query_params_names and query_search_params.searchParams[field] in values:
-                        supported_params_names.append(name)
-        else:
-            supported_params_names.append(name)
-
-    params_not_supported = [name for name in query_params_names if name not in supported_params_names]
+def run_gap_analysis(supported_search_params: list[SupportedSearchParams], query_search_params: QuerySearchParams, search_param_index: SearchParamIndex | None = None) -> list[str]:
+    """
+    Function to find the search parameters of a query that the server does not support, and that need to be filtered for locally instead
+
+    Passing a search_param_index from compile_search_param_index turns the analysis into a few dictionary lookups. Without one, the searched resource type
+    is compiled on every call, so callers running more than one analysis against the same CapabilityStatement should compile the index once and pass it.
+    """
+
+    if search_param_index is None:
+        search_param_index = compile_search_param_index([resource_params for resource_params in supported_search_params if resource_params.resourceType == query_search_params.resourceType])
+
+    resource_search_params: dict[str, SearchParamCondition | None] = search_param_index.get(query_search_params.resourceType, {})
+
+    params_not_supported: list[str] = []
+    for name in query_search_params.searchParams:
+        if name not in resource_search_params:
+            params_not_supported.append(name)
+            continue
+        condition: SearchParamCondition | None = resource_search_params[name]
+        if condition and not condition.is_met(query_search_params.searchParams):
+            params_not_supported.append(name)
 
     return params_not_supported
+
+
+def compile_search_param_index(supported_search_params: list[SupportedSearchParams]) -> SearchParamIndex:
+    """Function to build the resource type -> search parameter -> parsed true-when condition index used by run_gap_analysis"""
+
+    search_param_index: SearchParamIndex = {}
+    for resource_params in supported_search_params:
+        resource_index: dict[str, SearchParamCondition | None] = search_param_index.setdefault(resource_params.resourceType, {})
+        for search_param_obj in resource_params.searchParams:
+            if not search_param_obj.name or search_param_obj.name in resource_index:
+                continue
+            if not search_param_obj.extension:
+                resource_index[search_param_obj.name] = None
+                continue
+            condition: SearchParamCondition | None = parse_true_when(search_param_obj)
+            if condition:
+                resource_index[search_param_obj.name] = condition
+
+    return search_param_index
+
+
+def parse_true_when(search_param_obj: CapabilityStatementRestResourceSearchParam) -> SearchParamCondition | None:
+    """Function to parse the true-when extension of a search parameter, returning None if there is no true-when extension it understands"""
+
+    filtered_ext_list = list(filter(lambda x: x.url == "true-when", search_param_obj.extension))  # type: ignore
+    if not filtered_ext_list:
+        return None
+
+    true_when: str = filtered_ext_list[0].valueString
+    if "==" in true_when:
+        field, value = true_when.split("==")
+        return SearchParamCondition(field=field, operator="==", values=frozenset([value]))
+    elif " in " in true_when:
+        field, values = true_when.split(" in ")
+        return SearchParamCondition(field=field, operator="in", values=frozenset([value.strip() for value in values.strip("[").strip("]").split(",")]))
+
+    logger.warning(f"Unable to parse true-when extension {true_when} on search parameter {search_param_obj.name}, it will be treated as unsupported")
+    return None
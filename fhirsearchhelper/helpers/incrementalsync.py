@@ -0,0 +1,94 @@
+"""File for the incremental sync mode, which keeps the output of each query in a store and only searches for what changed since the last sync"""
+
+import copy
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any
+
+from ..models.models import QuerySearchParams
+from .cache import ReferenceCache
+from .datesharding import get_entry_key
+from .querycache import normalize_search_url
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.incrementalsync")
+
+# Subtracted from the time a sync started to get its watermark, so resources updated while it ran, or on a server whose clock is behind, are not missed
+WATERMARK_OVERLAP: timedelta = timedelta(minutes=5)
+
+
+def get_sync_key(base_url: str, search_params: QuerySearchParams, sync_scope: str | None, expand_documents: bool) -> str:
+    """
+    Function to build the sync store key of a query, the normalized query string along with the options that change its output and the caller's sync_scope
+
+    The headers are left out, since jobs get a new OAuth token for every run and would never find their previous sync.
+    """
+
+    query_string: str = "&".join([f"{key}={value}" for key, value in search_params.searchParams.items()])
+    options: str = f"expand_documents={expand_documents}&scope={sync_scope or ''}"
+    return f"{normalize_search_url(f'{base_url}/{search_params.resourceType}?{query_string}')}#{options}"
+
+
+def has_last_updated(output_json: dict[str, Any], resource_type: str) -> bool:
+    """Function to check whether every resource of resource_type in a Bundle has meta.lastUpdated, which a delta filtered locally relies on"""
+
+    return all(entry["resource"].get("meta", {}).get("lastUpdated") for entry in output_json.get("entry", []) if entry.get("resource", {}).get("resourceType") == resource_type)
+
+
+class IncrementalSync:
+    """
+    One run of an incremental query, see the sync_store argument of run_fhir_query.
+
+    search_params is what to search for in this run: the query as is when there is no usable previous sync, or the query with _lastUpdated=gt<watermark>
+    added. The search pipeline sends _lastUpdated to the server when the CapabilityStatement supports it, and otherwise filters it locally on meta.lastUpdated
+    along with the other unsupported search parameters, which is after the Medications of MedicationRequests are expanded but before any other expansion.
+    finish then merges the delta into the previous output and stores it with the new watermark, keyed by the query and sync_scope (see get_sync_key), a
+    stable identity of the caller such as a client or tenant id, so callers sharing a store only read their own output.
+    """
+
+    def __init__(self, sync_store: ReferenceCache, base_url: str, search_params: QuerySearchParams, sync_scope: str | None, expand_documents: bool) -> None:
+        self.sync_store: ReferenceCache = sync_store
+        self.base_url: str = base_url
+        self.key: str = get_sync_key(base_url, search_params, sync_scope, expand_documents)
+        self.resource_type: str = search_params.resourceType
+        self.started_at: datetime = datetime.now(tz=timezone.utc)
+        self.previous_state: dict[str, Any] | None = sync_store.get(self.key)
+        self.search_params: QuerySearchParams = search_params
+
+        if self.previous_state is None:
+            logger.info(f"There is no previous sync of {self.key}, running the full query")
+        elif "_lastUpdated" in search_params.searchParams:
+            logger.warning(f"The query {self.key} already searches by _lastUpdated, so it is run in full rather than incrementally")
+            self.previous_state = None
+        elif not self.previous_state["lastUpdatedComplete"]:
+            logger.warning(f"Some resources of the previous sync of {self.key} have no meta.lastUpdated, so changes cannot be detected and it is run in full")
+            self.previous_state = None
+        else:
+            logger.info(f"Searching for changes to {self.key} since {self.previous_state['watermark']}")
+            self.search_params = QuerySearchParams(resourceType=search_params.resourceType, searchParams={**search_params.searchParams, "_lastUpdated": f"gt{self.previous_state['watermark']}"})
+
+    def finish(self, output_json: dict[str, Any] | None) -> dict[str, Any] | None:
+        """Function to merge the raw output of this run into the previous output and store it, returning the merged output or the failed output unchanged"""
+
+        if not output_json or output_json.get("resourceType") != "Bundle":
+            logger.warning(f"The sync of {self.key} failed, keeping the previous output and watermark")
+            return output_json
+
+        merged_output: dict[str, Any] = merge_sync_output(self.previous_state["output"], output_json) if self.previous_state else output_json
+        watermark: str = (self.started_at - WATERMARK_OVERLAP).strftime("%Y-%m-%dT%H:%M:%SZ")
+        self.sync_store.set(self.key, {"watermark": watermark, "lastUpdatedComplete": has_last_updated(merged_output, self.resource_type), "output": copy.deepcopy(merged_output)})
+        return merged_output
+
+
+def merge_sync_output(previous_output: dict[str, Any], delta_output: dict[str, Any]) -> dict[str, Any]:
+    """
+    Function to merge the changed resources of a delta Bundle into the previous output of a query, replacing the previous versions of the resources
+
+    Resources that were deleted, or changed so they no longer match the query, are not in the delta and stay in the output until the query is run in full.
+    """
+
+    merged_entries: dict[str, dict[str, Any]] = {}
+    for entry in [*previous_output.get("entry", []), *delta_output.get("entry", [])]:
+        merged_entries[get_entry_key(entry) or str(id(entry))] = entry
+
+    logger.info(f"Merged {len(delta_output.get('entry', []))} changed entries into {len(previous_output.get('entry', []))} previous entries")
+    return {**previous_output, "entry": list(merged_entries.values()), "total": len(merged_entries)}
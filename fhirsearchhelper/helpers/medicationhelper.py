@@ -1,52 +1,95 @@
 """File to handle all operations around Medication-related Resources"""
 
+from __future__ import annotations
+
+import asyncio
+import copy
 import logging
-from concurrent.futures import Future, ThreadPoolExecutor, as_completed
-from copy import deepcopy
-from typing import Any
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Any
 
 import httpx
-from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
+from .cache import LRUCache, ReferenceCache
+from .metrics import count, count_response
 from .operationoutcomehelper import handle_operation_outcomes
+from .ratelimit import RateLimitedTransport, create_transport
+from .referenceresolver import get_reference_lookup, get_unresolved_references, resolve_references_in_batches, schedule_batched_lookups
+from .singleflight import SingleFlight
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle, BundleEntry
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper.medicationhelper")
 
-cached_medication_resources: dict = {}
+# Medications rarely change, so they are kept between queries. See cache.configure_reference_caches to swap in a different cache.
+cached_medication_resources: ReferenceCache = LRUCache(max_entries=10000, ttl=24 * 60 * 60)
+medication_lookups: SingleFlight = SingleFlight()
+
+# The _include value that asks the server to return the referenced Medications alongside the MedicationRequests of a search
+MEDICATION_INCLUDE: str = "MedicationRequest:medication"
 
 
-def expand_single_medication_reference(resource: dict, base_url: str, query_headers: dict):
+def expand_single_medication_reference(resource: dict, base_url: str, query_headers: dict, client: httpx.Client | None = None):
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
         return resource
 
-    transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
-    client: httpx.Client = httpx.Client(transport=transport)
+    if not client:
+        transport: RateLimitedTransport = create_transport()
+        client = httpx.Client(transport=transport)
 
     if "medicationReference" in resource:
         med_ref: str = resource["medicationReference"]["reference"]
-        if base_url + "/" + med_ref in cached_medication_resources:
-            logger.debug("Found Medication in cached resources")
-            med_code_concept: dict[str, list[dict]] = cached_medication_resources[base_url + "/" + med_ref]["code"]
-        else:
-            logger.debug(f"Did not find Medication in cached resources, querying {base_url + '/' + med_ref}")
-            med_lookup: httpx.Response = client.get(f"{base_url}/{med_ref}", headers=query_headers)
-            if med_lookup.status_code != 200:
-                logger.error(f"The MedicationRequest Medication query responded with a status code of {med_lookup.status_code}")
-                if med_lookup.status_code == 403:
-                    logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Medication.Read.")
-                    if "WWW-Authenticate" in med_lookup.headers:
-                        logger.error(med_lookup.headers["WWW-Authenticate"])
-                return None
-            cached_medication_resources[base_url + "/" + med_ref] = med_lookup.json()
-            med_code_concept = med_lookup.json()["code"]
-        resource["medicationCodeableConcept"] = med_code_concept
+        medication: dict | None = lookup_medication(client=client, med_url=base_url + "/" + med_ref, query_headers=query_headers)
+        if not medication:
+            return None
+        resource["medicationCodeableConcept"] = copy.deepcopy(medication["code"])
         del resource["medicationReference"]
 
     return resource
 
 
-def expand_medication_reference(entry_resource: BundleEntry) -> dict[str, Any] | None:
+def lookup_medication(client: httpx.Client, med_url: str, query_headers: dict) -> dict | None:
+    """
+    Retrieve a Medication, first from the Medication cache and otherwise from the server.
+
+    Concurrent lookups of the same Medication from different threads share a single request and its parsed result. Returns None if the Medication could
+    not be retrieved.
+    """
+
+    cached_medication: dict | None = cached_medication_resources.get(med_url)
+    if cached_medication:
+        logger.debug("Found Medication in cached resources")
+        count("cache_hits", reference="Medication")
+        return cached_medication
+    count("cache_misses", reference="Medication")
+
+    def fetch_medication() -> dict | None:
+        logger.debug(f"Did not find Medication in cached resources, querying {med_url}")
+        med_lookup: httpx.Response = client.get(med_url, headers=query_headers)
+        count_response(med_lookup, kind="Medication")
+        if med_lookup.status_code != 200:
+            log_medication_lookup_error(med_lookup)
+            return None
+        medication: dict = med_lookup.json()
+        cached_medication_resources.set(med_url, medication)
+        return medication
+
+    return medication_lookups.do(med_url, fetch_medication)
+
+
+def log_medication_lookup_error(med_lookup: httpx.Response) -> None:
+    """Function to log why a Medication lookup failed"""
+
+    logger.error(f"The MedicationRequest Medication query responded with a status code of {med_lookup.status_code}")
+    if med_lookup.status_code == 403:
+        logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Medication.Read.")
+        if "WWW-Authenticate" in med_lookup.headers:
+            logger.error(med_lookup.headers["WWW-Authenticate"])
+
+
+def expand_medication_reference(entry_resource: BundleEntry, client: httpx.Client | None = None, base_url: str | None = None, query_headers: dict | None = None) -> dict[str, Any] | None:
     """
     Expand a MedicationReference within a Bundle.entry.resource.MedicationRequest resource to a MedicationCodeableConcept.
 
@@ -54,6 +97,7 @@ def expand_medication_reference(entry_resource: BundleEntry) -> dict[str, Any] |
 
     Parameters:
     - entry_resource (dict): A Bundle.entry where resourceType is MedicationRequest as a dictionary.
+    - client, base_url, query_headers (optional): The client, base URL, and headers used to resolve the reference. Default to the ones passed to the last call of expand_medication_references_in_bundle.
 
     Returns:
     - dict: The expanded MedicationRequest resource with MedicationCodeableConcept.
@@ -65,37 +109,76 @@ def expand_medication_reference(entry_resource: BundleEntry) -> dict[str, Any] |
 
     """
 
-    entry: dict[str, Any] = entry_resource.model_dump(exclude_none=True)
+    client = client or g_client
+    base_url = base_url or g_base_url
+    query_headers = query_headers if query_headers is not None else g_query_headers
+
+    return expand_medication_reference_json(entry=entry_resource.model_dump(exclude_none=True), client=client, base_url=base_url, query_headers=query_headers)
+
+
+def expand_medication_reference_json(entry: dict[str, Any], client: httpx.Client, base_url: str, query_headers: dict, prefetched_medications: dict[str, dict] | None = None) -> dict[str, Any] | None:
+    """
+    Function to expand the MedicationReference of a raw Bundle.entry dictionary in place, returning the entry or None if the Medication could not be retrieved
+
+    Medications in prefetched_medications (included in the Bundle or read in a batch) are used as is, and any other Medication is looked up.
+    """
+
     resource: dict[str, Any] = entry["resource"]
     if resource["resourceType"] == "OperationOutcome":
         handle_operation_outcomes(resource=resource)
-        return resource
+        return entry
 
     if "medicationReference" in resource:
-        med_ref: str = resource["medicationReference"]["reference"]
-        if g_base_url + "/" + med_ref in cached_medication_resources:
-            logger.debug("Found Medication in cached resources")
-            med_code_concept: dict[str, list[dict]] = cached_medication_resources[g_base_url + "/" + med_ref]["code"]
-        else:
-            logger.debug(f"Did not find Medication in cached resources, querying {g_base_url + '/' + med_ref}")
-            med_lookup: httpx.Response = g_client.get(f"{g_base_url}/{med_ref}", headers=g_query_headers)
-            if med_lookup.status_code != 200:
-                logger.error(f"The MedicationRequest Medication query responded with a status code of {med_lookup.status_code}")
-                if med_lookup.status_code == 403:
-                    logger.error("The 403 code typically means your defined scope does not allow for retrieving this resource. Please check your scope to ensure it includes Medication.Read.")
-                    if "WWW-Authenticate" in med_lookup.headers:
-                        logger.error(med_lookup.headers["WWW-Authenticate"])
-                return None
-            cached_medication_resources[g_base_url + "/" + med_ref] = med_lookup.json()
-            med_code_concept = med_lookup.json()["code"]
-        resource["medicationCodeableConcept"] = med_code_concept
+        med_url: str = base_url + "/" + resource["medicationReference"]["reference"]
+        medication: dict | None = get_prefetched_medication(prefetched_medications, med_url) or lookup_medication(client=client, med_url=med_url, query_headers=query_headers)
+        if not medication:
+            return None
+        resource["medicationCodeableConcept"] = copy.deepcopy(medication["code"])
         del resource["medicationReference"]
-        entry["resource"] = resource
 
     return entry
 
 
-def expand_medication_references_in_bundle(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}) -> Bundle:
+def pop_included_medications(bundle_json: dict[str, Any], base_url: str) -> dict[str, dict]:
+    """
+    Function to remove the Medication entries returned for _include=MedicationRequest:medication from a raw Bundle dictionary
+
+    Returns the Medications keyed by both <base_url>/Medication/<id> and their fullUrl, and adds them to the Medication cache for later queries.
+    """
+
+    included_medications: dict[str, dict] = {}
+    match_entries: list[dict[str, Any]] = []
+    for entry in bundle_json.get("entry", []):
+        resource: dict[str, Any] = entry.get("resource", {})
+        if resource.get("resourceType") != "Medication":
+            match_entries.append(entry)
+            continue
+        med_url: str = f"{base_url}/Medication/{resource.get('id')}"
+        included_medications[med_url] = resource
+        if entry.get("fullUrl"):
+            included_medications[entry["fullUrl"]] = resource
+        cached_medication_resources.set(med_url, resource)
+
+    if included_medications:
+        logger.debug(f"Found {len(bundle_json['entry']) - len(match_entries)} included Medication(s) in the Bundle")
+        bundle_json["entry"] = match_entries
+    return included_medications
+
+
+def get_prefetched_medication(prefetched_medications: dict[str, dict] | None, med_url: str) -> dict | None:
+    if not prefetched_medications or med_url not in prefetched_medications:
+        return None
+    count("prefetched_references", reference="Medication")
+    return prefetched_medications[med_url]
+
+
+def get_medication_urls(entries: list[dict[str, Any]], base_url: str) -> list[str]:
+    """Function to list the url of the Medication referenced by each MedicationRequest entry that has a medicationReference"""
+
+    return [f"{base_url}/{entry['resource']['medicationReference']['reference']}" for entry in entries if "reference" in entry["resource"].get("medicationReference", {})]
+
+
+def expand_medication_references_in_bundle(client: httpx.Client, input_bundle: Bundle, base_url: str, query_headers: dict = {}, batch_size: int = 0) -> Bundle:
     """
     Expand MedicationReferences into MedicationCodeableConcepts for all MedicationRequest entries in a Bundle.
 
@@ -105,6 +188,8 @@ def expand_medication_references_in_bundle(client: httpx.Client, input_bundle: B
     - input_bundle (Bundle): The input FHIR Bundle containing MedicationRequest resources to be processed.
     - base_url (str): The base URL used for making HTTP requests to resolve MedicationReferences.
     - query_headers (dict, optional): Additional headers for the HTTP requests (default: {}).
+    - batch_size (int, optional): When greater than 0, Medications are read with batch Bundles of up to this many GETs instead of one request each. Only use
+      this with servers whose CapabilityStatement supports the batch interaction (default: 0).
 
     Returns:
     - Bundle: A modified FHIR Bundle with expanded MedicationReferences or the input Bundle if an error ocurred during expansion.
@@ -112,27 +197,153 @@ def expand_medication_references_in_bundle(client: httpx.Client, input_bundle: B
     The function creates a new Bundle, leaving the original input Bundle unchanged.
     """
 
-    global cached_medication_resources, g_client, g_base_url, g_query_headers
-    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+    from fhir.resources.R4B.bundle import Bundle
 
-    returned_resources: list[BundleEntry] | None = input_bundle.entry
-    if not returned_resources:
+    if not input_bundle.entry:
         return input_bundle
-    output_bundle: dict = deepcopy(input_bundle).model_dump(exclude_none=True)
+
+    return Bundle.model_validate(
+        expand_medication_references_in_bundle_json(client=client, bundle_json=input_bundle.model_dump(exclude_none=True), base_url=base_url, query_headers=query_headers, batch_size=batch_size)
+    )
+
+
+def expand_medication_references_in_bundle_json(client: httpx.Client, bundle_json: dict[str, Any], base_url: str, query_headers: dict = {}, batch_size: int = 0) -> dict[str, Any]:
+    """
+    Raw JSON version of expand_medication_references_in_bundle that expands the entries of a Bundle dictionary in place and returns it.
+
+    The search pipeline uses this so each page is only validated into a Bundle once, after it has been expanded and filtered. Entries keep their original
+    order. Medications included in the Bundle by _include=MedicationRequest:medication are used for the expansion and removed from the entries, so only the
+    references the server did not include are looked up, in batches when batch_size is set.
+    """
+
+    global g_client, g_base_url, g_query_headers
+    g_client, g_base_url, g_query_headers = client, base_url, query_headers
+
+    prefetched_medications: dict[str, dict] = pop_included_medications(bundle_json, base_url)
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+    if batch_size:
+        unresolved_urls: list[str] = get_unresolved_references(get_medication_urls(entries, base_url), cached_medication_resources, prefetched_medications)
+        prefetched_medications |= resolve_references_in_batches(client, base_url, unresolved_urls, query_headers, batch_size, cached_medication_resources, "Medication")
+    saved_calls_before: int = medication_lookups.saved_calls
 
     with ThreadPoolExecutor() as executor:
-        future_to_entry: dict[Future[dict[str, Any] | None], BundleEntry] = {executor.submit(expand_medication_reference, entry): entry for entry in returned_resources}
+        expanded_entries: list[dict[str, Any] | None] = list(executor.map(lambda entry: expand_medication_reference_json(entry, client, base_url, query_headers, prefetched_medications), entries))
+
+    logger.debug(f"{medication_lookups.saved_calls - saved_calls_before} Medication lookups were shared with an identical lookup already in flight")
+
+    bundle_json["entry"] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(bundle_json["entry"]), reason="expansion", resource_type="MedicationRequest")
+    return bundle_json
 
-        expanded_entries: list[dict[str, Any] | None] = []
-        for future in as_completed(future_to_entry):
-            entry: dict[str, Any] | None = future.result()
-            if entry:
-                expanded_entries.append(entry)
 
-    expanded_entries_clean: list[dict[str, Any]] = [entry for entry in expanded_entries if entry]
+async def expand_medication_references_in_bundle_async(
+    client: httpx.AsyncClient,
+    input_bundle: Bundle,
+    base_url: str,
+    query_headers: dict = {},
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    batch_size: int = 0,
+) -> Bundle:
+    """
+    Async version of expand_medication_references_in_bundle that shares the caller's httpx.AsyncClient.
+
+    Parameters:
+    - client (httpx.AsyncClient): The client used for all Medication lookups.
+    - input_bundle (Bundle): The input FHIR Bundle containing MedicationRequest resources to be processed.
+    - base_url (str): The base URL used for making HTTP requests to resolve MedicationReferences.
+    - query_headers (dict, optional): Additional headers for the HTTP requests (default: {}).
+    - max_concurrency (int, optional): The maximum number of Medication lookups in flight at once (default: 10).
+    - reference_lookups (dict, optional): A dictionary of in-flight or finished lookups keyed by url, shared between calls so each Medication is only requested once across them.
+    - batch_size (int, optional): When greater than 0, Medications are read with batch Bundles of up to this many GETs, see expand_medication_references_in_bundle (default: 0).
+
+    Returns:
+    - Bundle: A modified FHIR Bundle with expanded MedicationReferences. Entries keep their original order.
+
+    Each distinct Medication is only requested once, even when many MedicationRequests reference it at the same time.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if not input_bundle.entry:
+        return input_bundle
+
+    return Bundle.model_validate(
+        await expand_medication_references_in_bundle_json_async(
+            client=client,
+            bundle_json=input_bundle.model_dump(exclude_none=True),
+            base_url=base_url,
+            query_headers=query_headers,
+            max_concurrency=max_concurrency,
+            reference_lookups=reference_lookups,
+            batch_size=batch_size,
+        )
+    )
+
+
+async def expand_medication_references_in_bundle_json_async(
+    client: httpx.AsyncClient,
+    bundle_json: dict[str, Any],
+    base_url: str,
+    query_headers: dict = {},
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    batch_size: int = 0,
+) -> dict[str, Any]:
+    """Async version of expand_medication_references_in_bundle_json, see expand_medication_references_in_bundle_async for the parameters"""
+
+    included_medications: dict[str, dict] = pop_included_medications(bundle_json, base_url)
+    entries: list[dict[str, Any]] = bundle_json.get("entry", [])
+    if not entries:
+        return bundle_json
+
+    semaphore: asyncio.Semaphore = asyncio.Semaphore(max_concurrency)
+    medication_lookups: dict[str, asyncio.Task] = reference_lookups if reference_lookups is not None else {}
+
+    async def lookup_medication(med_url: str) -> dict | None:
+        cached_medication: dict | None = cached_medication_resources.get(med_url)
+        if cached_medication:
+            logger.debug("Found Medication in cached resources")
+            count("cache_hits", reference="Medication")
+            return cached_medication
+        count("cache_misses", reference="Medication")
+        async with semaphore:
+            logger.debug(f"Querying {med_url}")
+            med_lookup: httpx.Response = await client.get(med_url, headers=query_headers)
+        count_response(med_lookup, kind="Medication")
+        if med_lookup.status_code != 200:
+            log_medication_lookup_error(med_lookup)
+            return None
+        medication: dict = med_lookup.json()
+        cached_medication_resources.set(med_url, medication)
+        return medication
+
+    if batch_size:
+        unresolved_urls: list[str] = get_unresolved_references(get_medication_urls(entries, base_url), cached_medication_resources, [*included_medications, *medication_lookups])
+        schedule_batched_lookups(client, base_url, unresolved_urls, query_headers, batch_size, cached_medication_resources, "Medication", medication_lookups, lookup_medication, semaphore)
+
+    async def expand_entry(entry: dict[str, Any]) -> dict[str, Any] | None:
+        resource: dict[str, Any] = entry["resource"]
+        if resource["resourceType"] == "OperationOutcome":
+            handle_operation_outcomes(resource=resource)
+            return entry
+
+        if "medicationReference" in resource:
+            med_url: str = f"{base_url}/{resource['medicationReference']['reference']}"
+            medication: dict | None = get_prefetched_medication(included_medications, med_url)
+            if not medication:
+                medication = await get_reference_lookup(medication_lookups, med_url, lookup_medication)
+            if not medication:
+                return None
+            resource["medicationCodeableConcept"] = copy.deepcopy(medication["code"])
+            del resource["medicationReference"]
+
+        return entry
 
-    if len(cached_medication_resources.keys()) != 0:
-        cached_medication_resources = {}
+    expanded_entries: list[dict[str, Any] | None] = await asyncio.gather(*[expand_entry(entry) for entry in entries])
 
-    output_bundle["entry"] = expanded_entries_clean
-    return Bundle.model_validate(output_bundle)
+    bundle_json["entry"] = [entry for entry in expanded_entries if entry]
+    count("entries_dropped", len(entries) - len(bundle_json["entry"]), reason="expansion", resource_type="MedicationRequest")
+    return bundle_json
@@ -0,0 +1,140 @@
+"""File for the metrics hooks that report stage timings and counters from the search pipeline"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from contextlib import AbstractContextManager, contextmanager, nullcontext
+from typing import Any, Iterator
+
+import httpx
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.metrics")
+
+# See add_metrics_hook. A tuple so it can be read from any thread without a lock.
+metrics_hooks: tuple["MetricsHook", ...] = ()
+
+
+class MetricsHook:
+    """
+    Base class for receiving metrics from the search pipeline, for example to export them to Prometheus or OpenTelemetry.
+
+    Subclasses override on_timing, on_count, or both. Both are called from whichever thread or event loop did the work, so they should be thread-safe
+    and quick. Exceptions raised by a hook are logged and otherwise ignored.
+
+    Stages passed to on_timing:
+    - capability_statement: Loading and parsing the CapabilityStatement.
+    - gap_analysis: Finding the search parameters that need to be filtered for locally.
+    - search: A single searchset page request.
+    - expand_medications, expand_conditions, expand_documents: Expanding the references of a page.
+    - filter: Filtering a page using the gap analysis output.
+    - validate: Validating a page into fhir.resources models.
+
+    Counters passed to on_count:
+    - http_calls, http_bytes: Requests made and response bytes downloaded, with a kind attribute (search, Medication, Encounter, Binary, batch, metadata).
+    - cache_hits, cache_misses: Reference and query cache lookups, with a reference attribute (Medication, Encounter, Binary, SearchResponse, SearchOutput).
+    - cache_revalidations: Stale cached search responses the server confirmed are unchanged, with a reference attribute (SearchResponse).
+    - prefetched_references: References resolved from resources fetched ahead of the expansion with _include or a batch Bundle, with a reference attribute
+      (Medication, Encounter).
+    - http_retries: Throttled responses (429 or 5xx) retried by the request scheduler, with status_code and host attributes.
+    - entries_dropped: Entries removed from a page, with a reason attribute (operation_outcome, filter, expansion).
+
+    Every call has a resource_type attribute when the searched resource type is known.
+    """
+
+    def on_timing(self, stage: str, seconds: float, attributes: dict[str, Any]) -> None:
+        pass
+
+    def on_count(self, counter: str, value: int, attributes: dict[str, Any]) -> None:
+        pass
+
+
+class MetricsRecorder(MetricsHook):
+    """
+    Thread-safe hook that keeps metrics in memory, useful for tests and for reporting on a batch of queries.
+
+    timings maps each stage to the list of its durations in seconds, and counters maps each counter to its total. Attributes are not kept.
+    """
+
+    def __init__(self) -> None:
+        self.timings: defaultdict[str, list[float]] = defaultdict(list)
+        self.counters: defaultdict[str, int] = defaultdict(int)
+        self._lock: threading.Lock = threading.Lock()
+
+    def on_timing(self, stage: str, seconds: float, attributes: dict[str, Any]) -> None:
+        with self._lock:
+            self.timings[stage].append(seconds)
+
+    def on_count(self, counter: str, value: int, attributes: dict[str, Any]) -> None:
+        with self._lock:
+            self.counters[counter] += value
+
+    def total_seconds(self, stage: str) -> float:
+        return sum(self.timings.get(stage, []))
+
+    def clear(self) -> None:
+        with self._lock:
+            self.timings.clear()
+            self.counters.clear()
+
+
+def add_metrics_hook(hook: MetricsHook) -> None:
+    """Function to start sending the pipeline's metrics to hook. Until a hook is added, nothing is timed or counted."""
+
+    global metrics_hooks
+    metrics_hooks = (*metrics_hooks, hook)
+
+
+def remove_metrics_hook(hook: MetricsHook) -> None:
+    global metrics_hooks
+    metrics_hooks = tuple(existing_hook for existing_hook in metrics_hooks if existing_hook is not hook)
+
+
+def timed(stage: str, **attributes: Any) -> AbstractContextManager:
+    """Function to time the block of a with statement as stage, which is a no-op context manager when no hooks are added"""
+
+    if not metrics_hooks:
+        return nullcontext()
+    return _timed(stage, attributes)
+
+
+@contextmanager
+def _timed(stage: str, attributes: dict[str, Any]) -> Iterator[None]:
+    start: float = time.perf_counter()
+    try:
+        yield
+    finally:
+        seconds: float = time.perf_counter() - start
+        for hook in metrics_hooks:
+            try:
+                hook.on_timing(stage, seconds, attributes)
+            except Exception:
+                logger.exception(f"Metrics hook {hook!r} failed on timing {stage}")
+
+
+def count(counter: str, value: int = 1, **attributes: Any) -> None:
+    """Function to add value to counter, which returns immediately when no hooks are added"""
+
+    if not metrics_hooks or not value:
+        return
+    for hook in metrics_hooks:
+        try:
+            hook.on_count(counter, value, attributes)
+        except Exception:
+            logger.exception(f"Metrics hook {hook!r} failed on counter {counter}")
+
+
+def count_response(response: httpx.Response, kind: str, **attributes: Any) -> None:
+    """Function to count an HTTP call and the bytes it downloaded"""
+
+    if not metrics_hooks:
+        return
+    downloaded_bytes: int = response.num_bytes_downloaded
+    if not downloaded_bytes:
+        # Responses that did not come from the network (such as from httpx.MockTransport) only know the size of their content
+        try:
+            downloaded_bytes = len(response.content)
+        except httpx.ResponseNotRead:
+            pass
+    count("http_calls", kind=kind, status_code=response.status_code, **attributes)
+    count("http_bytes", downloaded_bytes, kind=kind, **attributes)
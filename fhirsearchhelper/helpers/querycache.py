@@ -0,0 +1,190 @@
+"""File for the optional caches of search responses and search outputs, keyed by the normalized search URL and a fingerprint of the request headers"""
+
+import copy
+import hashlib
+import json
+import logging
+import time
+from datetime import datetime, timezone
+from typing import Any
+
+import httpx
+
+from ..models.models import QuerySearchParams
+from .cache import ReferenceCache
+from .metrics import count
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.querycache")
+
+# Both caches are off until configure_query_caches is called
+search_response_cache: ReferenceCache | None = None
+search_output_cache: ReferenceCache | None = None
+# Cached search responses younger than this many seconds are used without asking the server, older ones are revalidated first
+response_fresh_for: float = 60.0
+
+
+def configure_query_caches(responses: ReferenceCache | None = None, outputs: ReferenceCache | None = None, fresh_for: float | None = None) -> None:
+    """
+    Function to turn on the caches of search responses and search outputs
+
+    Parameters:
+    - responses (ReferenceCache, optional): Caches each searchset page response by its normalized URL and headers. A cached page younger than fresh_for is used as is,
+      and an older one is revalidated with If-None-Match (ETag), If-Modified-Since (Last-Modified), or a _lastUpdated count search when the server
+      supports it. The TTL of the cache bounds how long pages are kept for revalidation.
+    - outputs (ReferenceCache, optional): Caches the filtered and expanded output of run_fhir_query by its normalized query and headers, so a repeat query returns
+      without any requests or expansions until the entry expires from the cache.
+    - fresh_for (float, optional): The number of seconds a cached search response is used without revalidating it (default: 60).
+
+    Only the caches that are passed are replaced. See disable_query_caches to turn them off again.
+    """
+
+    global search_response_cache, search_output_cache, response_fresh_for
+    if responses is not None:
+        search_response_cache = responses
+    if outputs is not None:
+        search_output_cache = outputs
+    if fresh_for is not None:
+        response_fresh_for = fresh_for
+
+
+def disable_query_caches() -> None:
+    global search_response_cache, search_output_cache
+    search_response_cache = None
+    search_output_cache = None
+
+
+def normalize_search_url(url: str) -> str:
+    """Function to normalize a search URL into <base_url>/<resourceType>?<params sorted by name and value>, so equivalent searches share a key"""
+
+    url_res, _, query_string = url.partition("?")
+    params: list[str] = sorted(param for param in query_string.split("&") if param)
+    return f"{url_res.rstrip('/')}?{'&'.join(params)}" if params else url_res.rstrip("/")
+
+
+def get_credential_fingerprint(query_headers: dict[str, str] | None) -> str:
+    """
+    Function to fingerprint the headers a search is sent with, so callers with different Authorization headers never share a cache entry
+
+    Every header is hashed rather than just Authorization, since servers also take credentials from Cookie or API key headers, and headers such as Accept
+    change the response. Only a truncated SHA-256 ends up in the key, so the credentials themselves are not stored in the cache.
+    """
+
+    headers: list[str] = sorted(f"{name.lower()}:{value}" for name, value in (query_headers or {}).items())
+    return hashlib.sha256("\n".join(headers).encode()).hexdigest()[:32]
+
+
+def get_search_response_key(page_url: str, query_headers: dict[str, str] | None) -> str:
+    return f"{normalize_search_url(page_url)}#credentials={get_credential_fingerprint(query_headers)}"
+
+
+def get_search_output_key(
+    base_url: str, search_params: QuerySearchParams, query_headers: dict[str, str] | None, capability_statement_key: str | None, follow_next: bool, expand_documents: bool
+) -> str:
+    """
+    Function to build the search output cache key, which also depends on the headers, the options that change the output, and the CapabilityStatement
+    deciding which search parameters are filtered locally (see capabilitystatement.get_capability_statement_key and get_capability_statement_source_key)
+    """
+
+    query_string: str = "&".join([f"{key}={value}" for key, value in search_params.searchParams.items()])
+    capability_statement: str = hashlib.sha256((capability_statement_key or "").encode()).hexdigest()[:32]
+    options: str = f"follow_next={follow_next}&expand_documents={expand_documents}&credentials={get_credential_fingerprint(query_headers)}&capability_statement={capability_statement}"
+    return f"{normalize_search_url(f'{base_url}/{search_params.resourceType}?{query_string}')}#{options}"
+
+
+def get_cached_search_output(key: str, copy_output: bool = True) -> dict[str, Any] | None:
+    """
+    Function to get a copy of a cached search output, so callers can modify it without changing the cache
+
+    Set copy_output to False when the output is only read to build new objects, such as validating it into fhir.resources models, to skip the copy.
+    """
+
+    if search_output_cache is None:
+        return None
+    cached_output: dict[str, Any] | None = search_output_cache.get(key)
+    if cached_output is None:
+        count("cache_misses", reference="SearchOutput")
+        return None
+    logger.debug(f"Found the output of {key} in the search output cache")
+    count("cache_hits", reference="SearchOutput")
+    return copy.deepcopy(cached_output) if copy_output else cached_output
+
+
+def set_cached_search_output(key: str, output_json: dict[str, Any], copy_output: bool = True) -> None:
+    """
+    Function to cache a search output, only keeping searchset Bundles so failed searches are retried
+
+    Set copy_output to False when nothing else holds output_json, such as a fresh model_dump, to skip the copy.
+    """
+
+    if search_output_cache is None or output_json.get("resourceType") != "Bundle":
+        return
+    search_output_cache.set(key, copy.deepcopy(output_json) if copy_output else output_json)
+
+
+def get_cached_search_response(page_url: str, query_headers: dict[str, str] | None) -> dict[str, Any] | None:
+    """Function to get the cached search response for page_url requested with query_headers, which holds the page body, its validators, and when it was stored"""
+
+    if search_response_cache is None:
+        return None
+    cached_response: dict[str, Any] | None = search_response_cache.get(get_search_response_key(page_url, query_headers))
+    count("cache_hits" if cached_response else "cache_misses", reference="SearchResponse")
+    return cached_response
+
+
+def is_fresh(cached_response: dict[str, Any]) -> bool:
+    return time.time() - cached_response["stored_at"] <= response_fresh_for
+
+
+def get_revalidation_headers(cached_response: dict[str, Any]) -> dict[str, str]:
+    """Function to build the conditional request headers for a cached search response, empty if the server sent no validators"""
+
+    if cached_response.get("etag"):
+        return {"If-None-Match": cached_response["etag"]}
+    if cached_response.get("last_modified"):
+        return {"If-Modified-Since": cached_response["last_modified"]}
+    return {}
+
+
+def get_last_updated_probe_url(page_url: str, cached_response: dict[str, Any]) -> str:
+    """Function to build the search that counts the resources updated since the cached response was stored, for servers supporting _lastUpdated"""
+
+    stored_at: str = datetime.fromtimestamp(cached_response["stored_at"], tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    return f"{page_url}{'&' if '?' in page_url else '?'}_lastUpdated=gt{stored_at}&_summary=count"
+
+
+def is_unchanged_probe(probe_response: httpx.Response) -> bool:
+    """Function to check whether a _lastUpdated count search found no resources updated since the cached response was stored"""
+
+    if probe_response.status_code != 200:
+        return False
+    try:
+        return probe_response.json().get("total") == 0
+    except json.JSONDecodeError:
+        return False
+
+
+def set_cached_search_response(page_url: str, query_headers: dict[str, str] | None, response: httpx.Response) -> None:
+    """Function to cache a successful search response along with its ETag and Last-Modified validators"""
+
+    if search_response_cache is None or response.status_code != 200:
+        return
+    try:
+        body: dict[str, Any] = response.json()
+    except json.JSONDecodeError:
+        return
+    cached_response: dict[str, Any] = {"stored_at": time.time(), "etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified"), "body": body}
+    search_response_cache.set(get_search_response_key(page_url, query_headers), cached_response)
+
+
+def refresh_cached_search_response(page_url: str, query_headers: dict[str, str] | None, cached_response: dict[str, Any]) -> httpx.Response:
+    """Function to mark a revalidated search response as fresh again and rebuild the response from its body"""
+
+    logger.debug(f"The cached response of {page_url} is still valid")
+    count("cache_revalidations", reference="SearchResponse")
+    if search_response_cache is not None:
+        search_response_cache.set(get_search_response_key(page_url, query_headers), {**cached_response, "stored_at": time.time()})
+    return build_cached_response(page_url, cached_response)
+
+
+def build_cached_response(page_url: str, cached_response: dict[str, Any]) -> httpx.Response:
+    return httpx.Response(200, json=cached_response["body"], request=httpx.Request("GET", page_url))
@@ -0,0 +1,226 @@
+"""File to plan searches, choosing between rewrites of a query by the number of entries previous queries returned"""
+
+import logging
+import threading
+from typing import Any
+
+from ..models.models import QueryPlan, QuerySearchParams, SearchParamIndex, SupportedSearchParams
+from .fhirfilter import EntryPredicate, compile_search_param_filter
+from .gapanalysis import run_gap_analysis
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.queryplanner")
+
+# Left out of the statistics keys, so the statistics of one patient's queries estimate the same query for another patient
+STATISTICS_IGNORED_PARAMS: frozenset[str] = frozenset(["patient", "subject", "_count"])
+
+
+class QueryStatistics:
+    """
+    Thread-safe running totals of the entries returned by the server for each query shape, see get_statistics_key.
+
+    searches maps each key to the number of searches observed and the number of entries (of the searched resource type) they returned in total.
+    """
+
+    def __init__(self) -> None:
+        self.searches: dict[str, tuple[int, int]] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def record(self, key: str, entry_count: int) -> None:
+        with self._lock:
+            search_count, total_entries = self.searches.get(key, (0, 0))
+            self.searches[key] = (search_count + 1, total_entries + entry_count)
+
+    def estimate(self, key: str) -> float | None:
+        """Function to estimate the entries a search returns as the mean of the searches observed for key, or None if there were none"""
+
+        search_count, total_entries = self.searches.get(key, (0, 0))
+        return total_entries / search_count if search_count else None
+
+    def clear(self) -> None:
+        with self._lock:
+            self.searches.clear()
+
+
+# The planner is off until configure_query_planner is called
+query_statistics: QueryStatistics | None = None
+# The cost of one more server query, in entries, so a plan has to save more than this many entries per extra query to be chosen
+request_cost: float = 20.0
+
+
+def configure_query_planner(statistics: QueryStatistics | None = None, cost_per_request: float | None = None) -> QueryStatistics:
+    """
+    Function to turn on the query planner for every query that follows all pages, and return the statistics it plans with
+
+    Parameters:
+    - statistics (QueryStatistics, optional): The statistics to plan with and add to (default: the current statistics, or new ones).
+    - cost_per_request (float, optional): The cost of each server query, in entries (default: 20).
+
+    See disable_query_planner to turn it off again.
+    """
+
+    global query_statistics, request_cost
+    query_statistics = statistics or query_statistics or QueryStatistics()
+    if cost_per_request is not None:
+        request_cost = cost_per_request
+    return query_statistics
+
+
+def disable_query_planner() -> None:
+    global query_statistics
+    query_statistics = None
+
+
+def get_statistics_key(search_params: QuerySearchParams, gap_output: list[str]) -> str:
+    """Function to build the statistics key of a search, which is the search parameters sent to the server, sorted, without STATISTICS_IGNORED_PARAMS"""
+
+    server_params: list[str] = sorted(
+        f"{name}={','.join(sorted(str(value).split(',')))}" for name, value in search_params.searchParams.items() if name not in gap_output and name not in STATISTICS_IGNORED_PARAMS
+    )
+    return f"{search_params.resourceType}?{'&'.join(server_params)}"
+
+
+def enumerate_query_plans(search_params: QuerySearchParams, supported_search_params: list[SupportedSearchParams], search_param_index: SearchParamIndex | None = None) -> list[QueryPlan]:
+    """
+    Function to list the plans for a search, starting with the search as is
+
+    Every search parameter with comma separated values can be split into one branch per group of values, so that a search parameter whose true-when
+    condition only holds for some of the values is sent to the server for those. For example Condition?category=infection,problem-list-item&code=<code>
+    can be run as category=infection&code=<code> and category=problem-list-item, with code only filtered locally on the second. The values are grouped by
+    which search parameters the gap analysis leaves to filter locally, so splits that change nothing are not listed. The branches together return the same
+    resources as the search as is.
+    """
+
+    plans: list[QueryPlan] = [QueryPlan(branches=[search_params])]
+    for name, value in search_params.searchParams.items():
+        values: list[str] = str(value).split(",")
+        if len(values) < 2:
+            continue
+        value_groups: dict[tuple[str, ...], list[str]] = {}
+        for single_value in values:
+            branch_params: QuerySearchParams = QuerySearchParams(resourceType=search_params.resourceType, searchParams={**search_params.searchParams, name: single_value})
+            gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=branch_params, search_param_index=search_param_index)
+            value_groups.setdefault(tuple(sorted(gap_output)), []).append(single_value)
+        if len(value_groups) < 2:
+            continue
+        plans.append(
+            QueryPlan(
+                branches=[
+                    QuerySearchParams(resourceType=search_params.resourceType, searchParams={**search_params.searchParams, name: ",".join(group_values)}) for group_values in value_groups.values()
+                ]
+            )
+        )
+    return plans
+
+
+def estimate_plan_cost(query_plan: QueryPlan, statistics: QueryStatistics, supported_search_params: list[SupportedSearchParams], search_param_index: SearchParamIndex | None = None) -> float | None:
+    """Function to estimate the cost of a plan as its estimated entries plus request_cost per branch, or None if any branch has no statistics"""
+
+    cost: float = 0.0
+    for branch_params in query_plan.branches:
+        gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=branch_params, search_param_index=search_param_index)
+        estimated_entries: float | None = statistics.estimate(get_statistics_key(branch_params, gap_output))
+        if estimated_entries is None:
+            return None
+        cost += estimated_entries + request_cost
+    return cost
+
+
+def choose_query_plan(query_plans: list[QueryPlan], statistics: QueryStatistics, supported_search_params: list[SupportedSearchParams], search_param_index: SearchParamIndex | None = None) -> QueryPlan:
+    """
+    Function to choose the cheapest of query_plans, whose first plan is the search as is
+
+    The first plan is chosen whenever it has no statistics yet, which is also when its pages are used to estimate the other plans (see PlanObserver).
+    Plans without statistics are skipped, and ties go to the earlier plan.
+    """
+
+    chosen_plan: QueryPlan = query_plans[0]
+    chosen_plan.estimatedCost = estimate_plan_cost(chosen_plan, statistics, supported_search_params, search_param_index)
+    if chosen_plan.estimatedCost is None:
+        return chosen_plan
+
+    for query_plan in query_plans[1:]:
+        query_plan.estimatedCost = estimate_plan_cost(query_plan, statistics, supported_search_params, search_param_index)
+        if query_plan.estimatedCost is not None and query_plan.estimatedCost < chosen_plan.estimatedCost:  # type: ignore
+            chosen_plan = query_plan
+
+    if chosen_plan is not query_plans[0]:
+        logger.info(
+            f"Running the search as {len(chosen_plan.branches)} branches with an estimated cost of {chosen_plan.estimatedCost:.0f} instead of "
+            f"{query_plans[0].estimatedCost:.0f}: {[branch.searchParams for branch in chosen_plan.branches]}"
+        )
+    return chosen_plan
+
+
+class PlanObserver:
+    """
+    Counts the entries of one search as its raw pages come back, and adds them to the statistics when the search finishes.
+
+    Every branch of the other plans asks the server for a subset of what the search as is returns, so the raw pages of the search as is are also matched
+    against the search parameters each branch would send to the server. One run of the search as is therefore estimates every plan.
+
+    Parameters:
+    - statistics (QueryStatistics): The statistics to add to.
+    - search_params (QuerySearchParams): The search that is run.
+    - gap_output (list[str]): The gap analysis output of the search that is run.
+    - candidate_branches (list[QuerySearchParams], optional): The branches to also estimate, from enumerate_query_plans.
+    """
+
+    def __init__(
+        self,
+        statistics: QueryStatistics,
+        search_params: QuerySearchParams,
+        gap_output: list[str],
+        supported_search_params: list[SupportedSearchParams],
+        search_param_index: SearchParamIndex | None = None,
+        candidate_branches: list[QuerySearchParams] | None = None,
+    ) -> None:
+        self.statistics: QueryStatistics = statistics
+        self.resource_type: str = search_params.resourceType
+        self.search_key: str = get_statistics_key(search_params, gap_output)
+        self.entry_count: int = 0
+        self.branch_predicates: dict[str, list[EntryPredicate]] = {}
+        self.branch_counts: dict[str, int] = {}
+
+        server_params: dict[str, Any] = {name: value for name, value in search_params.searchParams.items() if name not in gap_output}
+        for branch_params in candidate_branches or []:
+            branch_gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=branch_params, search_param_index=search_param_index)
+            branch_key: str = get_statistics_key(branch_params, branch_gap_output)
+            if branch_key == self.search_key or branch_key in self.branch_predicates:
+                continue
+            self.branch_predicates[branch_key] = [
+                compile_search_param_filter(self.resource_type, name, value) for name, value in branch_params.searchParams.items() if name not in branch_gap_output and server_params.get(name) != value
+            ]
+            self.branch_counts[branch_key] = 0
+
+    def observe(self, page_json: dict[str, Any]) -> None:
+        for entry in page_json.get("entry", []):
+            resource: dict[str, Any] = entry.get("resource", {})
+            if resource.get("resourceType") != self.resource_type:
+                continue
+            self.entry_count += 1
+            for branch_key, predicates in self.branch_predicates.items():
+                if all(predicate(resource) for predicate in predicates):
+                    self.branch_counts[branch_key] += 1
+
+    def finish(self) -> None:
+        """Function to add the counts to the statistics, which should only be called once every page of the search was observed"""
+
+        self.statistics.record(self.search_key, self.entry_count)
+        for branch_key, branch_count in self.branch_counts.items():
+            self.statistics.record(branch_key, branch_count)
+        logger.debug(f"Observed {self.entry_count} entries for {self.search_key} and estimated {self.branch_counts}")
+
+
+def create_plan_observer(
+    search_params: QuerySearchParams,
+    gap_output: list[str],
+    supported_search_params: list[SupportedSearchParams],
+    search_param_index: SearchParamIndex | None = None,
+    query_plans: list[QueryPlan] | None = None,
+) -> PlanObserver | None:
+    """Function to create the PlanObserver of a search when the planner is on, estimating the branches of query_plans too, or None when it is off"""
+
+    if query_statistics is None:
+        return None
+    candidate_branches: list[QuerySearchParams] = [branch_params for query_plan in (query_plans or [])[1:] for branch_params in query_plan.branches]
+    return PlanObserver(query_statistics, search_params, gap_output, supported_search_params, search_param_index, candidate_branches)
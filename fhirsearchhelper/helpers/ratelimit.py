@@ -0,0 +1,377 @@
+"""File for the request scheduler that rate limits, bounds, and retries the requests made to each FHIR server"""
+
+import asyncio
+import email.utils
+import logging
+import random
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+from typing import AsyncIterator, Callable, Iterator
+
+import httpx
+
+from .metrics import count
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.ratelimit")
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket that lets through rate requests per second on average, and bursts of up to burst requests.
+
+    reserve takes a token and returns how long to wait before using it, so sync and async callers can both wait without holding a lock.
+    """
+
+    def __init__(self, rate: float, burst: int | None = None) -> None:
+        self.rate: float = rate
+        self.capacity: float = float(burst or max(rate, 1))
+        self.tokens: float = self.capacity
+        self.updated: float = time.monotonic()
+        self._lock: threading.Lock = threading.Lock()
+
+    def reserve(self) -> float:
+        with self._lock:
+            now: float = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+
+class AdaptiveConcurrencyLimit:
+    """
+    Thread-safe limit on the number of requests in flight that adapts to the server (additive increase, multiplicative decrease).
+
+    Every successful request raises the limit by 1 / limit, so it grows by about one per round of requests, up to maximum. Every throttled request (429
+    or 5xx) halves it, down to minimum.
+
+    Slots are released from both threads and event loops, so rather than an asyncio.Condition, which belongs to one event loop, each async request
+    waiting for a slot parks on a future of its own loop, and release wakes as many of them as there are free slots with call_soon_threadsafe.
+    """
+
+    def __init__(self, initial: int = 10, minimum: int = 1, maximum: int = 50) -> None:
+        self.limit: float = float(initial)
+        self.minimum: int = minimum
+        self.maximum: int = maximum
+        self.in_flight: int = 0
+        self._condition: threading.Condition = threading.Condition()
+        self._async_waiters: deque[tuple[asyncio.AbstractEventLoop, asyncio.Future[None]]] = deque()
+
+    def try_acquire(self) -> bool:
+        with self._condition:
+            if self.in_flight < int(self.limit):
+                self.in_flight += 1
+                return True
+            return False
+
+    def acquire(self) -> None:
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    async def acquire_async(self) -> None:
+        loop: asyncio.AbstractEventLoop = asyncio.get_running_loop()
+        while True:
+            with self._condition:
+                if self.in_flight < int(self.limit):
+                    self.in_flight += 1
+                    return
+                waiter: asyncio.Future[None] = loop.create_future()
+                self._async_waiters.append((loop, waiter))
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                with self._condition:
+                    if (loop, waiter) in self._async_waiters:
+                        self._async_waiters.remove((loop, waiter))
+                    # If this waiter was already woken, the free slot goes to the next one instead
+                    self._wake_async_waiters()
+                raise
+
+    def release(self, throttled: bool = False) -> None:
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(float(self.minimum), self.limit / 2)
+            else:
+                self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self._condition.notify_all()
+            self._wake_async_waiters()
+
+    def _wake_async_waiters(self) -> None:
+        free_slots: int = int(self.limit) - self.in_flight
+        while free_slots > 0 and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(set_waiter_result, waiter)
+            except RuntimeError:
+                # The waiter's event loop was closed, so there is no one left to wake
+                continue
+            free_slots -= 1
+
+
+def hold_slot_until_closed(response: httpx.Response, release: Callable[[], None]) -> httpx.Response:
+    """Function to have response release its concurrency slot when it is closed, or right away if its body was already read into memory"""
+
+    if response.is_closed:
+        release()
+    else:
+        response.stream = SlotReleasingStream(response.stream, release)
+    return response
+
+
+def set_waiter_result(waiter: asyncio.Future[None]) -> None:
+    if not waiter.done():
+        waiter.set_result(None)
+
+
+class SlotReleasingStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """
+    Wraps the body stream of a response so its concurrency slot is only released when the response is closed, once its body was read or abandoned.
+
+    Otherwise a streamed response would give up its slot as soon as its headers arrived, while its body is still being downloaded.
+    """
+
+    def __init__(self, stream: httpx.SyncByteStream | httpx.AsyncByteStream, release: Callable[[], None]) -> None:
+        self.stream: httpx.SyncByteStream | httpx.AsyncByteStream = stream
+        self.release: Callable[[], None] | None = release
+
+    def __iter__(self) -> Iterator[bytes]:
+        yield from self.stream  # type: ignore
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for chunk in self.stream:  # type: ignore
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            self.stream.close()  # type: ignore
+        finally:
+            self.release_slot()
+
+    async def aclose(self) -> None:
+        try:
+            await self.stream.aclose()  # type: ignore
+        finally:
+            self.release_slot()
+
+    def release_slot(self) -> None:
+        if self.release is not None:
+            release, self.release = self.release, None
+            release()
+
+
+class ServerThrottle:
+    """The rate limit, concurrency limit, and Retry-After pause shared by every request to one server"""
+
+    def __init__(self, rate: float | None, burst: int | None, initial_concurrency: int, min_concurrency: int, max_concurrency: int) -> None:
+        self.bucket: TokenBucket | None = TokenBucket(rate, burst) if rate else None
+        self.concurrency: AdaptiveConcurrencyLimit = AdaptiveConcurrencyLimit(initial=initial_concurrency, minimum=min_concurrency, maximum=max_concurrency)
+        self.paused_until: float = 0.0
+
+    def get_delay(self) -> float:
+        """Function to reserve a token and return how long the next request has to wait, for both the rate limit and any Retry-After pause"""
+
+        bucket_delay: float = self.bucket.reserve() if self.bucket else 0.0
+        return max(bucket_delay, self.paused_until - time.monotonic())
+
+    def pause(self, seconds: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+
+class RequestScheduler:
+    """
+    Schedules the requests to each server (keyed by scheme, host, and port), applying a token bucket rate limit and an adaptive concurrency limit, and
+    retrying throttled responses.
+
+    Parameters:
+    - rate (float, optional): The average number of requests per second to each server, or None for no rate limit (default: None).
+    - burst (int, optional): The number of requests allowed at once before the rate limit applies (default: rate).
+    - initial_concurrency, min_concurrency, max_concurrency (int, optional): The bounds of the adaptive concurrency limit for each server (default: 10, 1, 50).
+    - max_retries (int, optional): The number of times a request with a status in retry_statuses is retried (default: 5).
+    - backoff_base (float, optional): The first retry waits up to this many seconds, doubling for every retry after (default: 0.5).
+    - backoff_max (float, optional): The most a retry waits without a Retry-After header (default: 30).
+    - max_retry_after (float, optional): Retry-After values longer than this many seconds are capped to it (default: 120).
+    - retry_statuses (set[int], optional): The response statuses that are retried (default: 429, 500, 502, 503, 504).
+
+    Retry waits are jittered uniformly between 0 and the backoff for the attempt. A Retry-After header replaces the backoff and also pauses every other
+    request to the same server for that long.
+    """
+
+    def __init__(
+        self,
+        rate: float | None = None,
+        burst: int | None = None,
+        initial_concurrency: int = 10,
+        min_concurrency: int = 1,
+        max_concurrency: int = 50,
+        max_retries: int = 5,
+        backoff_base: float = 0.5,
+        backoff_max: float = 30.0,
+        max_retry_after: float = 120.0,
+        retry_statuses: set[int] = {429, 500, 502, 503, 504},
+    ) -> None:
+        self.rate: float | None = rate
+        self.burst: int | None = burst
+        self.initial_concurrency: int = initial_concurrency
+        self.min_concurrency: int = min_concurrency
+        self.max_concurrency: int = max_concurrency
+        self.max_retries: int = max_retries
+        self.backoff_base: float = backoff_base
+        self.backoff_max: float = backoff_max
+        self.max_retry_after: float = max_retry_after
+        self.retry_statuses: set[int] = set(retry_statuses)
+        self.throttles: dict[tuple[str, str, int | None], ServerThrottle] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def get_throttle(self, url: httpx.URL) -> ServerThrottle:
+        key: tuple[str, str, int | None] = (url.scheme, url.host, url.port)
+        with self._lock:
+            if key not in self.throttles:
+                self.throttles[key] = ServerThrottle(self.rate, self.burst, self.initial_concurrency, self.min_concurrency, self.max_concurrency)
+            return self.throttles[key]
+
+    def should_retry(self, response: httpx.Response, attempt: int) -> bool:
+        return response.status_code in self.retry_statuses and attempt < self.max_retries
+
+    def get_retry_delay(self, response: httpx.Response, attempt: int, throttle: ServerThrottle) -> float:
+        """Function to get how long to wait before retrying response, pausing the whole server when it sent a Retry-After header"""
+
+        retry_after: float | None = parse_retry_after(response.headers.get("Retry-After"))
+        if retry_after is not None:
+            retry_after = min(retry_after, self.max_retry_after)
+            throttle.pause(retry_after)
+            return retry_after
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def log_retry(self, request: httpx.Request, response: httpx.Response, attempt: int, delay: float) -> None:
+        logger.warning(f"{request.method} {request.url} responded with a status code of {response.status_code}, retrying in {delay:.2f}s ({attempt + 1}/{self.max_retries})")
+        count("http_retries", status_code=response.status_code, host=request.url.host)
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """Function to parse a Retry-After header, given either as a number of seconds or as an HTTP date, into a number of seconds"""
+
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at: datetime = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        logger.debug(f"Unable to parse Retry-After header {value}")
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=timezone.utc)
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+
+class RateLimitedTransport(httpx.BaseTransport):
+    """
+    httpx transport that sends every request through a RequestScheduler before handing it to transport.
+
+    Parameters:
+    - transport (httpx.BaseTransport, optional): The transport that sends the requests (default: httpx.HTTPTransport(retries=5), which retries failed connections).
+    - scheduler (RequestScheduler, optional): The scheduler to use (default: the shared request_scheduler, see configure_request_scheduler).
+    """
+
+    def __init__(self, transport: httpx.BaseTransport | None = None, scheduler: RequestScheduler | None = None) -> None:
+        self.transport: httpx.BaseTransport = transport or httpx.HTTPTransport(retries=5)
+        self.scheduler: RequestScheduler | None = scheduler
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        scheduler: RequestScheduler = self.scheduler or request_scheduler
+        throttle: ServerThrottle = scheduler.get_throttle(request.url)
+        attempt: int = 0
+        while True:
+            delay: float = throttle.get_delay()
+            if delay > 0:
+                time.sleep(delay)
+            throttle.concurrency.acquire()
+            try:
+                response: httpx.Response = self.transport.handle_request(request)
+            except BaseException:
+                throttle.concurrency.release()
+                raise
+            throttled: bool = response.status_code in scheduler.retry_statuses
+
+            if not scheduler.should_retry(response, attempt):
+                return hold_slot_until_closed(response, lambda: throttle.concurrency.release(throttled=throttled))
+            retry_delay: float = scheduler.get_retry_delay(response, attempt, throttle)
+            scheduler.log_retry(request, response, attempt, retry_delay)
+            response.close()
+            throttle.concurrency.release(throttled=throttled)
+            time.sleep(retry_delay)
+            attempt += 1
+
+    def close(self) -> None:
+        self.transport.close()
+
+
+class AsyncRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Async version of RateLimitedTransport, wrapping httpx.AsyncHTTPTransport(retries=5) by default"""
+
+    def __init__(self, transport: httpx.AsyncBaseTransport | None = None, scheduler: RequestScheduler | None = None) -> None:
+        self.transport: httpx.AsyncBaseTransport = transport or httpx.AsyncHTTPTransport(retries=5)
+        self.scheduler: RequestScheduler | None = scheduler
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        scheduler: RequestScheduler = self.scheduler or request_scheduler
+        throttle: ServerThrottle = scheduler.get_throttle(request.url)
+        attempt: int = 0
+        while True:
+            delay: float = throttle.get_delay()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await throttle.concurrency.acquire_async()
+            try:
+                response: httpx.Response = await self.transport.handle_async_request(request)
+            except BaseException:
+                throttle.concurrency.release()
+                raise
+            throttled: bool = response.status_code in scheduler.retry_statuses
+
+            if not scheduler.should_retry(response, attempt):
+                return hold_slot_until_closed(response, lambda: throttle.concurrency.release(throttled=throttled))
+            retry_delay: float = scheduler.get_retry_delay(response, attempt, throttle)
+            scheduler.log_retry(request, response, attempt, retry_delay)
+            await response.aclose()
+            throttle.concurrency.release(throttled=throttled)
+            await asyncio.sleep(retry_delay)
+            attempt += 1
+
+    async def aclose(self) -> None:
+        await self.transport.aclose()
+
+
+# The scheduler shared by the clients the package creates. Throttling state is kept per server, so every query to the same server shares its limits.
+request_scheduler: RequestScheduler = RequestScheduler()
+
+
+def configure_request_scheduler(scheduler: RequestScheduler | None = None, **options) -> RequestScheduler:
+    """
+    Function to replace the shared request scheduler, either with scheduler or with a new RequestScheduler built from options, and return it
+
+    Example: configure_request_scheduler(rate=10, max_concurrency=8) limits every server to 10 requests per second and 8 requests in flight.
+    """
+
+    global request_scheduler
+    request_scheduler = scheduler or RequestScheduler(**options)
+    return request_scheduler
+
+
+def create_transport() -> RateLimitedTransport:
+    """Function to create the transport for the httpx.Clients the package creates"""
+
+    return RateLimitedTransport(httpx.HTTPTransport(retries=5))
+
+
+def create_async_transport() -> AsyncRateLimitedTransport:
+    """Function to create the transport for the httpx.AsyncClients the package creates"""
+
+    return AsyncRateLimitedTransport(httpx.AsyncHTTPTransport(retries=5))
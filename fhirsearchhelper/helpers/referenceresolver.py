@@ -0,0 +1,174 @@
+"""File to resolve many references in one round trip with batch Bundles of reads, for servers whose CapabilityStatement supports the batch interaction"""
+
+import asyncio
+import json
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Awaitable, Callable, Iterable
+
+import httpx
+
+from .cache import ReferenceCache
+from .metrics import count, count_response
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.referenceresolver")
+
+BATCH_HEADERS: dict[str, str] = {"Content-Type": "application/fhir+json", "Accept": "application/fhir+json"}
+
+
+def get_unresolved_references(reference_urls: Iterable[str], cache: ReferenceCache, resolved: Iterable[str] = ()) -> list[str]:
+    """Function to list the distinct reference urls, in their original order, that are neither in cache nor in resolved"""
+
+    already_resolved: set[str] = set(resolved)
+    return [url for url in dict.fromkeys(reference_urls) if url not in already_resolved and url not in cache]
+
+
+def evict_failed_lookup(lookups: dict[str, asyncio.Task], url: str, task: asyncio.Task) -> None:
+    """Function to remove a finished lookup from lookups if it failed, so a later expansion requests the reference again rather than reusing the failure"""
+
+    if lookups.get(url) is task and (task.cancelled() or task.exception() is not None or task.result() is None):
+        del lookups[url]
+
+
+def add_reference_lookup(lookups: dict[str, asyncio.Task], url: str, lookup: Awaitable[dict | None]) -> asyncio.Task:
+    """Function to run lookup as a task added to lookups under url, which evicts itself again when it fails (see evict_failed_lookup)"""
+
+    task: asyncio.Task = asyncio.create_task(lookup)  # type: ignore
+    task.add_done_callback(lambda done_task: evict_failed_lookup(lookups, url, done_task))
+    lookups[url] = task
+    return task
+
+
+def get_reference_lookup(lookups: dict[str, asyncio.Task], url: str, lookup: Callable[[str], Awaitable[dict | None]]) -> asyncio.Task:
+    """Function to get the in-flight or finished lookup of url from lookups, starting lookup(url) if there is none"""
+
+    return lookups.get(url) or add_reference_lookup(lookups, url, lookup(url))
+
+
+def chunk_references(reference_urls: list[str], batch_size: int) -> list[list[str]]:
+    return [reference_urls[start : start + batch_size] for start in range(0, len(reference_urls), batch_size)]
+
+
+def build_batch_bundle(reference_urls: list[str], base_url: str) -> dict[str, Any]:
+    """Function to build a batch Bundle with a GET of each reference url, relative to base_url"""
+
+    return {"resourceType": "Bundle", "type": "batch", "entry": [{"request": {"method": "GET", "url": url.removeprefix(f"{base_url}/")}} for url in reference_urls]}
+
+
+def read_batch_response(response: httpx.Response, reference_urls: list[str]) -> dict[str, dict]:
+    """
+    Function to map the entries of a batch-response Bundle back to the reference urls of the batch, by position
+
+    Reads that did not succeed are left out. If the batch itself failed, nothing is returned and a warning is logged.
+    """
+
+    if response.status_code != 200:
+        logger.warning(f"The batch of {len(reference_urls)} reads responded with a status code of {response.status_code}, reading them one at a time instead")
+        return {}
+    try:
+        response_entries: list[dict[str, Any]] = response.json().get("entry", [])
+    except json.JSONDecodeError:
+        logger.warning("Unable to parse the batch response as JSON, reading the references one at a time instead")
+        return {}
+    if len(response_entries) != len(reference_urls):
+        logger.warning(f"The batch response has {len(response_entries)} entries for {len(reference_urls)} reads, reading them one at a time instead")
+        return {}
+
+    resolved: dict[str, dict] = {}
+    for url, response_entry in zip(reference_urls, response_entries):
+        if response_entry.get("response", {}).get("status", "").startswith("2") and response_entry.get("resource"):
+            resolved[url] = response_entry["resource"]
+        else:
+            logger.debug(f"The batch read of {url} responded with {response_entry.get('response', {}).get('status')}")
+    return resolved
+
+
+def resolve_references_in_batches(client: httpx.Client, base_url: str, reference_urls: list[str], query_headers: dict, batch_size: int, cache: ReferenceCache, reference: str) -> dict[str, dict]:
+    """
+    Function to read reference_urls with batch Bundles of at most batch_size GETs each, adding every resource read to cache
+
+    Parameters:
+    - client (httpx.Client): The client used to POST the batches.
+    - base_url (str): The base URL the batches are POSTed to.
+    - reference_urls (list[str]): The distinct <base_url>/<reference> urls to read, see get_unresolved_references.
+    - query_headers (dict): Headers for the batch requests, such as an Authorization header.
+    - batch_size (int): The maximum number of reads in each batch Bundle.
+    - cache (ReferenceCache): The cache the resources read are added to.
+    - reference (str): The type of resource being read, for logging and metrics.
+
+    Returns:
+    - dict: The resources read, keyed by reference url. References missing from it could not be read in a batch and should be looked up on their own.
+    """
+
+    if len(reference_urls) < 2:
+        return {}
+
+    def post_batch(chunk: list[str]) -> dict[str, dict]:
+        logger.debug(f"Reading {len(chunk)} {reference} resources in one batch")
+        try:
+            response: httpx.Response = client.post(base_url, json=build_batch_bundle(chunk, base_url), headers={**query_headers, **BATCH_HEADERS})
+        except httpx.HTTPError as exc:
+            logger.warning(f"The batch of {len(chunk)} {reference} reads failed with {exc!r}, reading them one at a time instead")
+            return {}
+        count_response(response, kind="batch", reference=reference)
+        return read_batch_response(response, chunk)
+
+    resolved: dict[str, dict] = {}
+    with ThreadPoolExecutor() as executor:
+        for chunk_resolved in executor.map(post_batch, chunk_references(reference_urls, batch_size)):
+            resolved.update(chunk_resolved)
+
+    for url, resource in resolved.items():
+        cache.set(url, resource)
+    logger.debug(f"Read {len(resolved)} of {len(reference_urls)} {reference} resources in batches")
+    return resolved
+
+
+def schedule_batched_lookups(
+    client: httpx.AsyncClient,
+    base_url: str,
+    reference_urls: list[str],
+    query_headers: dict,
+    batch_size: int,
+    cache: ReferenceCache,
+    reference: str,
+    lookups: dict[str, asyncio.Task],
+    lookup: Callable[[str], Awaitable[dict | None]],
+    semaphore: asyncio.Semaphore,
+) -> None:
+    """
+    Async version of resolve_references_in_batches that adds a task to lookups for each reference url instead of returning the resources
+
+    Each task waits for the batch its url is read in, and falls back to lookup(url) if the batch could not read it. Since the tasks go in the shared lookups
+    dictionary, other expansions awaiting the same reference wait for the batch rather than requesting it again. At most one batch per permit of semaphore
+    is in flight at once.
+    """
+
+    if len(reference_urls) < 2:
+        return
+
+    async def post_batch(chunk: list[str]) -> dict[str, dict]:
+        logger.debug(f"Reading {len(chunk)} {reference} resources in one batch")
+        try:
+            async with semaphore:
+                response: httpx.Response = await client.post(base_url, json=build_batch_bundle(chunk, base_url), headers={**query_headers, **BATCH_HEADERS})
+        except httpx.HTTPError as exc:
+            logger.warning(f"The batch of {len(chunk)} {reference} reads failed with {exc!r}, reading them one at a time instead")
+            return {}
+        count_response(response, kind="batch", reference=reference)
+        resolved: dict[str, dict] = read_batch_response(response, chunk)
+        for url, resource in resolved.items():
+            cache.set(url, resource)
+        return resolved
+
+    async def lookup_from_batch(batch_task: asyncio.Task[dict[str, dict]], url: str) -> dict | None:
+        resolved: dict[str, dict] = await batch_task
+        if url in resolved:
+            count("prefetched_references", reference=reference)
+            return resolved[url]
+        return await lookup(url)
+
+    for chunk in chunk_references(reference_urls, batch_size):
+        batch_task: asyncio.Task[dict[str, dict]] = asyncio.create_task(post_batch(chunk))
+        for url in chunk:
+            add_reference_lookup(lookups, url, lookup_from_batch(batch_task, url))
@@ -0,0 +1,310 @@
+"""File to match FHIR element values against search parameter values using token, date, string, reference, and quantity search semantics"""
+
+import re
+import unicodedata
+from datetime import datetime, timedelta, timezone
+from decimal import Decimal, InvalidOperation
+from typing import Any
+
+PREFIX_PATTERN: re.Pattern = re.compile(r"^(eq|ne|gt|lt|ge|le|sa|eb|ap)(?=[\d+-])")
+DATE_PATTERN: re.Pattern = re.compile(r"^(\d{4})(?:-(\d{2})(?:-(\d{2})(?:T(\d{2}):(\d{2})(?::(\d{2})(?:\.(\d+))?)?(Z|[+-]\d{2}:\d{2})?)?)?)?$")
+MIN_DATETIME: datetime = datetime.min.replace(tzinfo=timezone.utc)
+MAX_DATETIME: datetime = datetime.max.replace(tzinfo=timezone.utc)
+
+
+class SearchValue:
+    """
+    A single search parameter value (one of the comma separated values) parsed once for every search type it could be compared as.
+
+    Parameters:
+    - value (str): The raw value, e.g. 'ge2020-01-01', 'http://loinc.org|789-8', '5.4|http://unitsofmeasure.org|mg', or 'Patient/123'.
+    - modifier (str, optional): The search parameter modifier, e.g. 'exact', 'contains', 'text', or 'not'.
+    """
+
+    def __init__(self, value: str, modifier: str | None = None) -> None:
+        self.value: str = value
+        self.modifier: str | None = modifier
+
+        prefix_match: re.Match | None = PREFIX_PATTERN.match(value)
+        self.prefix: str = prefix_match.group(1) if prefix_match else "eq"
+        unprefixed_value: str = value[2:] if prefix_match else value
+
+        # Token: [system]|[code] or code
+        system, separator, code = value.partition("|")
+        self.token_system: str | None = system if separator else None
+        self.token_code: str = code if separator else value
+
+        # Date: [prefix]date with an implicit range from its precision
+        self.date_range: tuple[datetime, datetime] | None = parse_date_range(unprefixed_value)
+
+        # Quantity and number: [prefix]number|[system]|[code]
+        quantity_parts: list[str] = unprefixed_value.split("|")
+        self.number: Decimal | None = parse_decimal(quantity_parts[0])
+        self.number_range: tuple[Decimal, Decimal] | None = get_decimal_range(self.number) if self.number is not None else None
+        self.quantity_system: str | None = quantity_parts[1] if len(quantity_parts) > 1 and quantity_parts[1] else None
+        self.quantity_code: str | None = quantity_parts[2] if len(quantity_parts) > 2 and quantity_parts[2] else None
+
+        # String: case and accent insensitive unless :exact is used
+        self.normalized_string: str = normalize_string(value)
+
+
+def normalize_string(value: str) -> str:
+    """Function to remove case and accents from a string for string search comparisons"""
+
+    return "".join(char for char in unicodedata.normalize("NFKD", value) if not unicodedata.combining(char)).casefold()
+
+
+def parse_decimal(value: str) -> Decimal | None:
+    try:
+        return Decimal(value)
+    except InvalidOperation:
+        return None
+
+
+def get_decimal_range(number: Decimal) -> tuple[Decimal, Decimal]:
+    """Function to get the implicit range of a number from its precision, e.g. 5.4 -> [5.35, 5.45)"""
+
+    exponent: int = number.as_tuple().exponent  # type: ignore
+    half_step: Decimal = Decimal(5).scaleb(exponent - 1)
+    return number - half_step, number + half_step
+
+
+def parse_date_range(value: str) -> tuple[datetime, datetime] | None:
+    """
+    Function to parse a FHIR date, dateTime, or instant into the range of time it covers.
+
+    The range is [start, end) where the end depends on the precision, e.g. '2020-01' covers all of January 2020. Values without a timezone are treated
+    as UTC. Returns None if the value is not a date.
+    """
+
+    date_match: re.Match | None = DATE_PATTERN.match(value)
+    if not date_match:
+        return None
+    year, month, day, hour, minute, second, fraction, tz = date_match.groups()
+
+    if tz in (None, "Z"):
+        tzinfo: timezone = timezone.utc
+    else:
+        offset: timedelta = timedelta(hours=int(tz[1:3]), minutes=int(tz[4:6]))
+        tzinfo = timezone(offset if tz[0] == "+" else -offset)
+
+    try:
+        start: datetime = datetime(int(year), int(month or 1), int(day or 1), int(hour or 0), int(minute or 0), int(second or 0), int((fraction or "0")[:6].ljust(6, "0")), tzinfo=tzinfo)
+    except ValueError:
+        return None
+
+    if month is None:
+        end: datetime = start.replace(year=start.year + 1) if start.year < 9999 else MAX_DATETIME
+    elif day is None:
+        end = start.replace(year=start.year + 1, month=1) if start.month == 12 else start.replace(month=start.month + 1)
+    elif hour is None:
+        end = start + timedelta(days=1)
+    elif second is None:
+        end = start + timedelta(minutes=1)
+    elif fraction is None:
+        end = start + timedelta(seconds=1)
+    else:
+        end = start + timedelta(microseconds=1)
+
+    return start, end
+
+
+def compare_ranges(prefix: str, target: tuple[Any, Any], search: tuple[Any, Any]) -> bool:
+    """Function to compare a target range against a search range using a search prefix, where both ranges are [start, end)"""
+
+    target_start, target_end = target
+    search_start, search_end = search
+    match prefix:
+        case "eq":
+            return search_start <= target_start and target_end <= search_end
+        case "ne":
+            return not (search_start <= target_start and target_end <= search_end)
+        case "gt":
+            return target_end > search_end
+        case "lt":
+            return target_start < search_start
+        case "ge":
+            return target_end > search_start
+        case "le":
+            return target_start < search_end
+        case "sa":
+            return target_start >= search_end
+        case "eb":
+            return target_end <= search_start
+        case _:  # ap
+            return target_start < search_end and target_end > search_start
+
+
+def compare_numbers(prefix: str, target: Decimal, search_value: SearchValue) -> bool:
+    """Function to compare a target number against a search number using a search prefix"""
+
+    number: Decimal = search_value.number  # type: ignore
+    match prefix:
+        case "eq":
+            return search_value.number_range[0] <= target < search_value.number_range[1]  # type: ignore
+        case "ne":
+            return not (search_value.number_range[0] <= target < search_value.number_range[1])  # type: ignore
+        case "gt" | "sa":
+            return target > number
+        case "lt" | "eb":
+            return target < number
+        case "ge":
+            return target >= number
+        case "le":
+            return target <= number
+        case _:  # ap, within 10% of the search value
+            return abs(target - number) <= abs(number) * Decimal("0.1")
+
+
+def get_element_date_range(element: Any) -> tuple[datetime, datetime] | None:
+    """Function to get the range of time covered by a date, dateTime, instant, or Period element"""
+
+    if isinstance(element, dict):
+        start_range: tuple[datetime, datetime] | None = parse_date_range(str(element["start"])) if "start" in element else None
+        end_range: tuple[datetime, datetime] | None = parse_date_range(str(element["end"])) if "end" in element else None
+        return (start_range[0] if start_range else MIN_DATETIME), (end_range[1] if end_range else MAX_DATETIME)
+    return parse_date_range(str(element))
+
+
+def match_token(element: Any, search_value: SearchValue) -> bool:
+    """Function to match a code, Coding, CodeableConcept, Identifier, or ContactPoint element against a token search value"""
+
+    if isinstance(element, dict):
+        if "coding" in element or "text" in element and search_value.modifier == "text":
+            if search_value.modifier == "text":
+                return normalize_string(element.get("text", "")).startswith(search_value.normalized_string)
+            return any(match_token(coding, search_value) for coding in element.get("coding", []))
+        code: Any = element.get("code", element.get("value"))
+        system: Any = element.get("system")
+    else:
+        code, system = element, None
+
+    if isinstance(code, bool):
+        code = str(code).lower()
+    if code is None or str(code) != search_value.token_code:
+        return False
+    if search_value.token_system is None:
+        return True
+    if search_value.token_system == "":
+        return system is None
+    return system == search_value.token_system
+
+
+def match_reference(element: Any, search_value: SearchValue, target_type: str | None = None) -> bool:
+    """Function to match a Reference element against a reference search value of the form [type]/[id], [id], or an absolute URL"""
+
+    reference: str | None = element.get("reference") if isinstance(element, dict) else str(element)
+    if not reference:
+        return False
+    if target_type and f"{target_type}/" not in reference:
+        return False
+    return reference == search_value.value or reference.endswith("/" + search_value.value) or search_value.value.endswith("/" + reference)
+
+
+def match_quantity(element: Any, search_value: SearchValue) -> bool:
+    """Function to match a Quantity or number element against a [prefix]number|[system]|[code] search value"""
+
+    if search_value.number is None:
+        return False
+    if isinstance(element, dict):
+        if "value" not in element:
+            return False
+        target_value: Decimal | None = parse_decimal(str(element["value"]))
+        if search_value.quantity_code and search_value.quantity_code not in (element.get("code"), element.get("unit")):
+            return False
+        if search_value.quantity_system and search_value.quantity_system != element.get("system"):
+            return False
+    else:
+        target_value = parse_decimal(str(element))
+    if target_value is None:
+        return False
+    return compare_numbers(search_value.prefix, target_value, search_value)
+
+
+def match_string(element: Any, search_value: SearchValue) -> bool:
+    """Function to match a string, HumanName, or Address element against a string search value"""
+
+    if isinstance(element, dict):
+        return any(match_string(part, search_value) for part in get_string_parts(element))
+    element_string: str = str(element)
+    if search_value.modifier == "exact":
+        return element_string == search_value.value
+    if search_value.modifier == "contains":
+        return search_value.normalized_string in normalize_string(element_string)
+    return normalize_string(element_string).startswith(search_value.normalized_string)
+
+
+def match_date(element: Any, search_value: SearchValue) -> bool:
+    """Function to match a date, dateTime, instant, Period, or Timing element against a [prefix]date search value"""
+
+    if search_value.date_range is None:
+        return False
+    if isinstance(element, dict) and "start" not in element and "end" not in element:
+        return any(match_date(event, search_value) for event in element.get("event", []))
+    element_date_range: tuple[datetime, datetime] | None = get_element_date_range(element)
+    return element_date_range is not None and compare_ranges(search_value.prefix, element_date_range, search_value.date_range)
+
+
+def match_uri(element: Any, search_value: SearchValue) -> bool:
+    """Function to match a uri element against a uri search value, exactly or as a prefix with :below"""
+
+    if search_value.modifier == "below":
+        return str(element).startswith(search_value.value)
+    return str(element) == search_value.value
+
+
+def get_string_parts(element: dict[str, Any]) -> list[str]:
+    """Function to collect the string parts of a complex element such as HumanName.given or Address.line"""
+
+    parts: list[str] = []
+    for part in element.values():
+        if isinstance(part, str):
+            parts.append(part)
+        elif isinstance(part, list):
+            parts.extend(item for item in part if isinstance(item, str))
+    return parts
+
+
+def element_matches(element: Any, search_value: SearchValue, target_type: str | None = None, search_type: str | None = None) -> bool:
+    """
+    Function to match a single element selected by a search parameter's FHIRPath expression against a search value.
+
+    The semantics come from search_type, the type of the search parameter. Only string search parameters match case-insensitive prefixes, so a token
+    such as status=entered does not match entered-in-error. Without a search_type they are chosen from the shape of the element: Quantities and numbers
+    use quantity semantics, References use reference semantics, Periods and date strings use date semantics, HumanNames and Addresses use string
+    semantics, and Codings, CodeableConcepts, Identifiers, and other strings use token semantics.
+    """
+
+    match search_type:
+        case "token":
+            return match_token(element, search_value)
+        case "string":
+            return match_string(element, search_value)
+        case "date":
+            return match_date(element, search_value)
+        case "reference":
+            return match_reference(element, search_value, target_type)
+        case "quantity" | "number":
+            return match_quantity(element, search_value)
+        case "uri":
+            return match_uri(element, search_value)
+
+    if isinstance(element, dict):
+        if "value" in element and isinstance(element["value"], (int, float, Decimal)) and not isinstance(element["value"], bool):
+            return match_quantity(element, search_value)
+        if "reference" in element:
+            return match_reference(element, search_value, target_type)
+        if "start" in element or "end" in element:
+            return search_value.date_range is not None and compare_ranges(search_value.prefix, get_element_date_range(element), search_value.date_range)  # type: ignore
+        if "coding" in element or "code" in element or "system" in element:
+            return match_token(element, search_value)
+        return match_string(element, search_value)
+
+    if isinstance(element, bool):
+        return match_token(element, search_value)
+    if isinstance(element, (int, float, Decimal)):
+        return match_quantity(element, search_value)
+
+    if get_element_date_range(element) is not None:
+        return match_date(element, search_value)
+    return match_token(element, search_value)
@@ -0,0 +1,52 @@
+"""File for deduplicating concurrent lookups of the same reference"""
+
+import logging
+import threading
+from concurrent.futures import Future
+from typing import Callable, TypeVar
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.singleflight")
+
+T = TypeVar("T")
+
+
+class SingleFlight:
+    """
+    Thread-safe single-flight call deduplication.
+
+    While a call for a key is in flight, every other thread asking for the same key waits for that call and shares its result (or exception) instead of
+    making its own. Once the call finishes the key is released, so later calls run again (and should hit a cache instead).
+
+    saved_calls counts the calls that were answered by another thread's in-flight call.
+    """
+
+    def __init__(self) -> None:
+        self.saved_calls: int = 0
+        self._calls: dict[str, Future] = {}
+        self._lock: threading.Lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable[[], T]) -> T:
+        with self._lock:
+            call: Future | None = self._calls.get(key)
+            is_leader: bool = call is None
+            if call is None:
+                call = Future()
+                self._calls[key] = call
+            else:
+                self.saved_calls += 1
+
+        if not is_leader:
+            logger.debug(f"Waiting on in-flight lookup of {key}")
+            return call.result()
+
+        try:
+            result: T = fn()
+        except BaseException as exc:
+            call.set_exception(exc)
+            raise
+        else:
+            call.set_result(result)
+            return result
+        finally:
+            with self._lock:
+                del self._calls[key]
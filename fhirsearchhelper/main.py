@@ -1,28 +1,47 @@
 """Main file for entrypoint to package"""
 
+from __future__ import annotations
+
+import asyncio
 import json
 import logging
 import re
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import TYPE_CHECKING, AsyncIterator, Iterable, Iterator
 
 import httpx
-from fhir.resources.R4B.bundle import Bundle
-from fhir.resources.R4B.capabilitystatement import CapabilityStatement
-from fhir.resources.R4B.operationoutcome import OperationOutcome
-
-from .helpers.capabilitystatement import get_supported_search_params, load_capability_statement
-from .helpers.conditionhelper import expand_condition_onset_in_bundle
-from .helpers.documenthelper import expand_document_references_in_bundle
-from .helpers.fhirfilter import filter_bundle
-from .helpers.gapanalysis import run_gap_analysis
-from .helpers.medicationhelper import expand_medication_references_in_bundle
-from .models.models import CustomFormatter, QuerySearchParams, SupportedSearchParams
+
+from .helpers import compiledcapabilitystatement, querycache, queryplanner
+from .helpers.cache import ReferenceCache
+from .helpers.capabilitystatement import (
+    get_capability_statement_key,
+    get_capability_statement_source_key,
+    load_search_capabilities,
+    load_search_capabilities_async,
+    supports_search_include,
+)
+from .helpers.compiledcapabilitystatement import get_compiled_search_param_index, get_compiled_supported_search_params
+from .helpers.conditionhelper import expand_condition_onset_in_bundle_json, expand_condition_onset_in_bundle_json_async
+from .helpers.datesharding import DateSharding, DateWindow, DateWindowPlanner, add_date_window, can_shard_by_date, count_page_entries, remove_seen_entries
+from .helpers.documenthelper import expand_document_references_in_bundle_json, expand_document_references_in_bundle_json_async
+from .helpers.fhirfilter import filter_bundle_json
+from .helpers.gapanalysis import compile_search_param_index, run_gap_analysis
+from .helpers.incrementalsync import IncrementalSync
+from .helpers.medicationhelper import MEDICATION_INCLUDE, expand_medication_references_in_bundle_json, expand_medication_references_in_bundle_json_async
+from .helpers.metrics import count, count_response, timed
+from .helpers.queryplanner import PlanObserver, choose_query_plan, create_plan_observer, enumerate_query_plans
+from .helpers.ratelimit import AsyncRateLimitedTransport, RateLimitedTransport, create_async_transport, create_transport
+from .models.models import CompiledCapabilityStatement, CustomFormatter, QueryPlan, QuerySearchParams, SearchParamIndex, SupportedSearchParams
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle, BundleEntry
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
 
 logger: logging.Logger = logging.getLogger("fhirsearchhelper")
 logger.setLevel(logging.INFO)
 ch: logging.StreamHandler = logging.StreamHandler()
 ch.setLevel(logging.INFO)
 ch.setFormatter(CustomFormatter())
-logger.addHandler(ch)
 
 
 def run_fhir_query(
@@ -33,121 +52,1184 @@ def run_fhir_query(
     capability_statement_file: str | None = None,
     capability_statement_url: str | None = None,
     debug: bool = False,
-) -> Bundle | OperationOutcome | None:
+    follow_next: bool = False,
+    client: httpx.Client | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 50,
+    date_sharding: DateSharding | None = None,
+    sync_store: ReferenceCache | None = None,
+    sync_scope: str | None = None,
+) -> Bundle | OperationOutcome | dict | None:
     """
     Entry function to run FHIR query using a CapabilityStatement and returning filtered resources
     WARNING: There is currently not a way to use a CapabilityStatement out of the box. See README.md of source for details.
+
+    By default only the first searchset page is returned. Setting follow_next to True follows Bundle.link[relation=next] until the last page and returns all of the
+    filtered and expanded pages merged into a single Bundle. Use run_fhir_query_pages to receive the pages one at a time instead.
+
+    Setting expand_documents to False returns DocumentReferences with their attachment URLs in place of the Binary content, which can then be retrieved on
+    demand with documenthelper.get_binary_handles or documenthelper.iter_expanded_document_references.
+
+    Setting raw to True returns the filtered and expanded Bundle (or OperationOutcome) as a JSON dictionary without validating it into fhir.resources models,
+    which saves most of the processing time for large Bundles.
+
+    If the CapabilityStatement lists the batch interaction, the Medications and Encounters the expansions need are read with batch Bundles of up to
+    reference_batch_size GETs rather than one request each. Setting reference_batch_size to 0 always reads them one at a time.
+
+    When the search output cache is on (see querycache.configure_query_caches), a repeat of a cached query returns the cached output without any requests.
+
+    Passing a datesharding.DateSharding splits the search into disjoint date=ge..&date=lt.. windows that are searched in parallel, every page of each, and
+    merges them without duplicates, along with a date:missing=true search for the resources without a date. It is only used when the CapabilityStatement
+    supports date for the resource type, the DateSharding says the server supports date:missing, and the query has no date of its own.
+
+    Passing a sync_store (such as a cache.SQLiteCache) runs the query incrementally, following every page: the first run stores its output with a
+    watermark, and later runs only search for resources updated since the watermark (_lastUpdated=gt<watermark>, filtered locally on meta.lastUpdated when
+    the server does not support _lastUpdated) and merge them into the stored output. Runs are stored by the query and sync_scope, a stable identity of the
+    caller such as a client or tenant id, which callers sharing a sync_store must set to keep their outputs apart. See incrementalsync.IncrementalSync.
     """
 
+    if sync_store is not None:
+        incremental_sync: IncrementalSync = start_incremental_sync(sync_store, base_url=base_url, search_params=search_params, query=query, sync_scope=sync_scope, expand_documents=expand_documents)
+        sync_output: Bundle | OperationOutcome | dict | None = run_fhir_query(
+            base_url=incremental_sync.base_url,
+            query_headers=query_headers,
+            search_params=incremental_sync.search_params,
+            capability_statement_file=capability_statement_file,
+            capability_statement_url=capability_statement_url,
+            debug=debug,
+            follow_next=True,
+            client=client,
+            expand_documents=expand_documents,
+            raw=True,
+            reference_batch_size=reference_batch_size,
+            date_sharding=date_sharding,
+        )
+        return load_sync_output(incremental_sync.finish(sync_output), raw=raw, resource_type=incremental_sync.resource_type)  # type: ignore
+
+    output_key: str | None = get_search_output_key(
+        base_url=base_url,
+        search_params=search_params,
+        query=query,
+        query_headers=query_headers,
+        capability_statement_key=get_query_capability_statement_key(base_url, query, capability_statement_url, capability_statement_file),
+        follow_next=follow_next or bool(date_sharding),
+        expand_documents=expand_documents,
+    )
+    cached_output: Bundle | dict | None = get_cached_search_output(output_key, raw=raw)
+    if cached_output is not None:
+        return cached_output
+
+    pages: Iterator[Bundle | OperationOutcome | dict | None] = run_fhir_query_pages(
+        base_url=base_url,
+        query_headers=query_headers,
+        search_params=search_params,
+        query=query,
+        capability_statement_file=capability_statement_file,
+        capability_statement_url=capability_statement_url,
+        debug=debug,
+        follow_next=follow_next,
+        client=client,
+        expand_documents=expand_documents,
+        raw=raw,
+        reference_batch_size=reference_batch_size,
+        date_sharding=date_sharding,
+    )
+
+    if not follow_next and not date_sharding:
+        try:
+            return cache_search_output(output_key, next(pages))
+        finally:
+            pages.close()  # type: ignore
+
+    return cache_search_output(output_key, merge_bundle_pages(pages))
+
+
+def run_fhir_query_pages(
+    base_url: str | None = None,
+    query_headers: dict[str, str] | None = None,
+    search_params: QuerySearchParams | None = None,
+    query: str | None = None,
+    capability_statement_file: str | None = None,
+    capability_statement_url: str | None = None,
+    debug: bool = False,
+    follow_next: bool = True,
+    client: httpx.Client | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 50,
+    date_sharding: DateSharding | None = None,
+) -> Iterator[Bundle | OperationOutcome | dict | None]:
+    """
+    Generator version of run_fhir_query that yields one filtered and expanded Bundle per searchset page
+
+    Each page is filtered and expanded on its own, so memory is bounded by the page size rather than the size of the full result set. While a page is being
+    filtered and expanded, the request for the next page (Bundle.link[relation=next]) is already in flight. If any request fails, the OperationOutcome (or None)
+    describing the failure is yielded and paging stops.
+
+    Without a capability_statement_file or capability_statement_url, the compiled CapabilityStatement registered for the server's base url is used (see
+    compiledcapabilitystatement.configure_capability_statement_registry).
+    """
+
+    add_log_handler()
     if debug:
-        logger.info("Logging level is being set to DEBUG")
-        logger.setLevel(logging.DEBUG)
-        ch.setLevel(logging.DEBUG)
-        logger.addHandler(ch)
+        enable_debug_logging()
 
-    # Error handling
-    if not base_url and not search_params and not query:
-        raise ValueError("You must provide either a base_url and a dictionary of search parameters or the full query string in the form of <baseUrl>/<resourceType>?<param1>=<value1>&...")
+    check_query_arguments(base_url=base_url, search_params=search_params, query=query)
+
+    if not client:
+        transport: RateLimitedTransport = create_transport()
+        client = httpx.Client(transport=transport)
 
-    transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
-    client: httpx.Client = httpx.Client(transport=transport)
+    with timed("capability_statement"):
+        compiled_cs: CompiledCapabilityStatement | None = get_registered_capability_statement(
+            base_url=base_url, query=query, capability_statement_url=capability_statement_url, capability_statement_file=capability_statement_file
+        )
+        if compiled_cs:
+            supported_search_params: list[SupportedSearchParams] = get_compiled_supported_search_params(compiled_cs)
+            search_param_index: SearchParamIndex | None = get_compiled_search_param_index(compiled_cs)
+            batch_supported: bool = compiled_cs.batch
+        else:
+            supported_search_params, search_param_index, batch_supported = load_search_capabilities(client=client, url=capability_statement_url, file_path=capability_statement_file)
 
-    cap_state: CapabilityStatement = load_capability_statement(client=client, url=capability_statement_url, file_path=capability_statement_file)
-    supported_search_params: list[SupportedSearchParams] = get_supported_search_params(cap_state)
+    yield from search_pages(
+        client=client,
+        supported_search_params=supported_search_params,
+        search_param_index=search_param_index,
+        base_url=base_url,
+        query_headers=query_headers,
+        search_params=search_params,
+        query=query,
+        follow_next=follow_next,
+        expand_documents=expand_documents,
+        raw=raw,
+        reference_batch_size=reference_batch_size if batch_supported else 0,
+        date_sharding=date_sharding,
+    )
 
-    pretty_supported_search_params: dict[str, list[str]] = {
-        resource_params["resourceType"]: [item["name"] for item in resource_params["searchParams"]] for resource_params in [item.dict(exclude_none=True) for item in supported_search_params]
-    }
+
+def search_pages(
+    client: httpx.Client,
+    supported_search_params: list[SupportedSearchParams],
+    base_url: str | None = None,
+    query_headers: dict[str, str] | None = None,
+    search_params: QuerySearchParams | None = None,
+    query: str | None = None,
+    follow_next: bool = True,
+    search_param_index: SearchParamIndex | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+    date_sharding: DateSharding | None = None,
+    date_window: DateWindow | None = None,
+    use_query_planner: bool = True,
+) -> Iterator[Bundle | OperationOutcome | dict | None]:
+    """
+    Function that runs the paged search of run_fhir_query_pages with an existing client and already loaded supported search parameters
+
+    reference_batch_size is only used as is, so it should be 0 unless the server supports batch Bundles. date_window limits the search to one date window,
+    and date_sharding runs it as parallel date windows (see search_date_shards). When the query planner is on (see queryplanner.configure_query_planner),
+    a search following every page may be run as the branches of a cheaper plan (see search_query_plan), unless use_query_planner is False.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    check_query_arguments(base_url=base_url, search_params=search_params, query=query)
+
+    pretty_supported_search_params: dict[str, list[str]] = get_pretty_supported_search_params(supported_search_params)
 
     logger.debug(f"Supported search parameters for this server are: {pretty_supported_search_params}")
 
     if query:
-        url_res, q_search_params = query.split("?")
-        if url_res.split("/")[-1] not in pretty_supported_search_params:
-            logger.error(f"Resource {url_res.split('/')[-1]} is not supported for searching, returning empty Bundle")
-            return Bundle(**{"type": "searchset", "total": 0, "link": [{"relation": "self", "url": url_res}]})
-        if not q_search_params:
+        base_url, new_search_params = parse_search_query(query)
+        url_res: str = f"{base_url}/{new_search_params.resourceType}"
+        if new_search_params.resourceType not in pretty_supported_search_params:
+            logger.error(f"Resource {new_search_params.resourceType} is not supported for searching, returning empty Bundle")
+            yield dump_search_output(Bundle(**{"type": "searchset", "total": 0, "link": [{"relation": "self", "url": url_res}]}), raw=raw)
+            return
+        if not new_search_params.searchParams:
             logger.error("No search params, Epic does not support pulling all resources of a given type with no search parameters. Please refine your query.")
-            new_query_response: httpx.Response = client.get(f"{url_res}", headers=query_headers)
-            if new_query_response.status_code == 403:
-                logger.error(f"The query responded with a status code of {new_query_response.status_code}")
-                if "WWW-Authenticate" in new_query_response.headers:
-                    logger.error(f"WWW-Authenticate Error: {new_query_response.headers['WWW-Authenticate']}")
-                    OO_body = {
-                        "resourceType": "OperationOutcome",
-                        "issue": [{"severity": "error", "code": "processing", "diagnostics": f"WWW-Authenticate Error: {new_query_response.headers['WWW-Authenticate']}"}],
-                    }
-                else:
-                    OO_body: dict = {
-                        "resourceType": "OperationOutcome",
-                        "issue": [{"severity": "error", "code": "processing", "diagnostics": f"The query responded with a status code of {new_query_response.status_code}"}],
-                    }
-                return OperationOutcome(**OO_body)
-            elif new_query_response.status_code == 400:
-                return OperationOutcome(**new_query_response.json())
+            yield dump_search_output(handle_no_search_params_response(client.get(f"{url_res}", headers=query_headers)), raw=raw)
+            return
+    else:
+        assert search_params
+        new_search_params = search_params
+
+    logger.info(f"Search parameters for this request are: {new_search_params}")
+
+    # Compiled once here so the date sharding, query planning, and gap analysis below all share it
+    if search_param_index is None:
+        search_param_index = compile_search_param_index(supported_search_params)
+
+    if date_sharding and can_shard_by_date(date_sharding, supported_search_params, search_params=new_search_params, search_param_index=search_param_index):
+        yield from search_date_shards(
+            client=client,
+            supported_search_params=supported_search_params,
+            date_sharding=date_sharding,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=new_search_params,
+            search_param_index=search_param_index,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=reference_batch_size,
+        )
+        return
+
+    plan_statistics: bool = queryplanner.query_statistics is not None and follow_next and not date_window
+    query_plans: list[QueryPlan] | None = None
+    if plan_statistics and use_query_planner:
+        query_plans = enumerate_query_plans(new_search_params, supported_search_params=supported_search_params, search_param_index=search_param_index)
+        query_plan: QueryPlan = choose_query_plan(query_plans, queryplanner.query_statistics, supported_search_params=supported_search_params, search_param_index=search_param_index)  # type: ignore
+        if len(query_plan.branches) > 1:
+            yield from search_query_plan(
+                client=client,
+                supported_search_params=supported_search_params,
+                query_plan=query_plan,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_param_index=search_param_index,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+            )
+            return
+
+    with timed("gap_analysis", resource_type=new_search_params.resourceType):
+        gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=new_search_params, search_param_index=search_param_index)
+
+    logger.debug(f"Gap output from these two sets of search parameters is: {gap_output}")
+
+    plan_observer: PlanObserver | None = (
+        create_plan_observer(new_search_params, gap_output, supported_search_params=supported_search_params, search_param_index=search_param_index, query_plans=query_plans)
+        if plan_statistics
+        else None
+    )
+
+    new_query_string: str = build_query_string(search_params=new_search_params, gap_output=gap_output)
+    new_query_string = add_search_includes(new_query_string, search_params=new_search_params, supported_search_params=supported_search_params)
+    new_query_string = add_date_window(new_query_string, date_window)
+
+    logger.debug(f"New query string is {new_query_string}")
+
+    assert base_url
+    assert query_headers
+    page_url: str | None = f"{base_url}/{new_query_string}"
+    page_number: int = 0
+
+    # A single worker is enough to have the next page in flight while the current page is filtered and expanded
+    with ThreadPoolExecutor(max_workers=1) as prefetcher:
+        logger.info(f"Making request to {page_url}")
+        next_page_future: Future[httpx.Response] | None = prefetcher.submit(
+            fetch_search_page, client, page_url, query_headers, new_search_params.resourceType, "_lastUpdated" in pretty_supported_search_params[new_search_params.resourceType]
+        )
+        while next_page_future:
+            new_query_response = next_page_future.result()
+            next_page_future = None
+            page_number += 1
+
+            if new_query_response.status_code != 200:
+                yield dump_search_output(handle_search_error_response(response=new_query_response, request_url=str(page_url)), raw=raw)
+                return
+
+            new_query_response_json: dict = new_query_response.json()
+            if plan_observer:
+                plan_observer.observe(new_query_response_json)
+
+            next_url: str | None = get_next_page_url(new_query_response_json) if follow_next else None
+            if next_url:
+                logger.info(f"Making request to page {page_number + 1} at {next_url}")
+                page_url = next_url
+                next_page_future = prefetcher.submit(fetch_search_page, client, next_url, query_headers, new_search_params.resourceType)
+
+            yield process_search_page(
+                client=client,
+                page_json=new_query_response_json,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_params=new_search_params,
+                gap_output=gap_output,
+                new_query_string=new_query_string,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+            )
+
+    if plan_observer:
+        plan_observer.finish()
+    logger.debug(f"Finished paging after {page_number} page(s)")
+
+
+async def run_fhir_query_async(
+    base_url: str | None = None,
+    query_headers: dict[str, str] | None = None,
+    search_params: QuerySearchParams | None = None,
+    query: str | None = None,
+    capability_statement_file: str | None = None,
+    capability_statement_url: str | None = None,
+    debug: bool = False,
+    follow_next: bool = False,
+    client: httpx.AsyncClient | None = None,
+    max_concurrency: int = 10,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 50,
+    date_sharding: DateSharding | None = None,
+    sync_store: ReferenceCache | None = None,
+    sync_scope: str | None = None,
+) -> Bundle | OperationOutcome | dict | None:
+    """
+    Async version of run_fhir_query built on httpx.AsyncClient
+
+    The search, paging, and the Medication, Binary, and Encounter lookups of the expansions all share one httpx.AsyncClient, which can be passed in to share
+    its connection pool across many concurrent queries. max_concurrency limits how many reference lookups each expansion has in flight at once.
+    """
+
+    if sync_store is not None:
+        incremental_sync: IncrementalSync = start_incremental_sync(sync_store, base_url=base_url, search_params=search_params, query=query, sync_scope=sync_scope, expand_documents=expand_documents)
+        sync_output: Bundle | OperationOutcome | dict | None = await run_fhir_query_async(
+            base_url=incremental_sync.base_url,
+            query_headers=query_headers,
+            search_params=incremental_sync.search_params,
+            capability_statement_file=capability_statement_file,
+            capability_statement_url=capability_statement_url,
+            debug=debug,
+            follow_next=True,
+            client=client,
+            max_concurrency=max_concurrency,
+            expand_documents=expand_documents,
+            raw=True,
+            reference_batch_size=reference_batch_size,
+            date_sharding=date_sharding,
+        )
+        return load_sync_output(incremental_sync.finish(sync_output), raw=raw, resource_type=incremental_sync.resource_type)  # type: ignore
+
+    output_key: str | None = get_search_output_key(
+        base_url=base_url,
+        search_params=search_params,
+        query=query,
+        query_headers=query_headers,
+        capability_statement_key=get_query_capability_statement_key(base_url, query, capability_statement_url, capability_statement_file),
+        follow_next=follow_next or bool(date_sharding),
+        expand_documents=expand_documents,
+    )
+    cached_output: Bundle | dict | None = get_cached_search_output(output_key, raw=raw)
+    if cached_output is not None:
+        return cached_output
+
+    pages: AsyncIterator[Bundle | OperationOutcome | dict | None] = run_fhir_query_pages_async(
+        base_url=base_url,
+        query_headers=query_headers,
+        search_params=search_params,
+        query=query,
+        capability_statement_file=capability_statement_file,
+        capability_statement_url=capability_statement_url,
+        debug=debug,
+        follow_next=follow_next,
+        client=client,
+        max_concurrency=max_concurrency,
+        expand_documents=expand_documents,
+        raw=raw,
+        reference_batch_size=reference_batch_size,
+        date_sharding=date_sharding,
+    )
+
+    if not follow_next and not date_sharding:
+        try:
+            return cache_search_output(output_key, await anext(pages))  # type: ignore
+        finally:
+            await pages.aclose()  # type: ignore
+
+    return cache_search_output(output_key, merge_bundle_pages([page async for page in pages]))
+
+
+async def run_fhir_query_pages_async(
+    base_url: str | None = None,
+    query_headers: dict[str, str] | None = None,
+    search_params: QuerySearchParams | None = None,
+    query: str | None = None,
+    capability_statement_file: str | None = None,
+    capability_statement_url: str | None = None,
+    debug: bool = False,
+    follow_next: bool = True,
+    client: httpx.AsyncClient | None = None,
+    max_concurrency: int = 10,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 50,
+    date_sharding: DateSharding | None = None,
+) -> AsyncIterator[Bundle | OperationOutcome | dict | None]:
+    """Async generator version of run_fhir_query_pages that yields one filtered and expanded Bundle per searchset page"""
+
+    add_log_handler()
+    if debug:
+        enable_debug_logging()
+
+    check_query_arguments(base_url=base_url, search_params=search_params, query=query)
+
+    owns_client: bool = client is None
+    if not client:
+        transport: AsyncRateLimitedTransport = create_async_transport()
+        client = httpx.AsyncClient(transport=transport)
+
+    try:
+        with timed("capability_statement"):
+            compiled_cs: CompiledCapabilityStatement | None = get_registered_capability_statement(
+                base_url=base_url, query=query, capability_statement_url=capability_statement_url, capability_statement_file=capability_statement_file
+            )
+            if compiled_cs:
+                supported_search_params: list[SupportedSearchParams] = get_compiled_supported_search_params(compiled_cs)
+                search_param_index: SearchParamIndex | None = get_compiled_search_param_index(compiled_cs)
+                batch_supported: bool = compiled_cs.batch
             else:
-                return None
+                supported_search_params, search_param_index, batch_supported = await load_search_capabilities_async(client=client, url=capability_statement_url, file_path=capability_statement_file)
 
-        base_url = "/".join(url_res.split("/")[:-1])
-        q_resource_type = url_res.split("/")[-1]
-        search_params_list: list[str] = q_search_params.split("&")
-        search_params_dict: dict[str, str] = {item.split("=")[0]: item.split("=")[1] for item in search_params_list}
-        new_search_params: QuerySearchParams = QuerySearchParams(resourceType=q_resource_type, searchParams=search_params_dict)
+        async for page in search_pages_async(
+            client=client,
+            supported_search_params=supported_search_params,
+            search_param_index=search_param_index,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=search_params,
+            query=query,
+            follow_next=follow_next,
+            max_concurrency=max_concurrency,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=reference_batch_size if batch_supported else 0,
+            date_sharding=date_sharding,
+        ):
+            yield page
+    finally:
+        if owns_client:
+            await client.aclose()
+
+
+async def search_pages_async(
+    client: httpx.AsyncClient,
+    supported_search_params: list[SupportedSearchParams],
+    base_url: str | None = None,
+    query_headers: dict[str, str] | None = None,
+    search_params: QuerySearchParams | None = None,
+    query: str | None = None,
+    follow_next: bool = True,
+    search_param_index: SearchParamIndex | None = None,
+    max_concurrency: int = 10,
+    gap_output: list[str] | None = None,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+    date_sharding: DateSharding | None = None,
+    date_window: DateWindow | None = None,
+    use_query_planner: bool = True,
+) -> AsyncIterator[Bundle | OperationOutcome | dict | None]:
+    """
+    Async version of search_pages
+
+    A precomputed gap_output skips the gap analysis, and a shared reference_lookups dictionary lets several searches reuse each other's Medication and Encounter
+    lookups, and the Binary lookups of searches running at the same time.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    check_query_arguments(base_url=base_url, search_params=search_params, query=query)
+
+    pretty_supported_search_params: dict[str, list[str]] = get_pretty_supported_search_params(supported_search_params)
+
+    logger.debug(f"Supported search parameters for this server are: {pretty_supported_search_params}")
+
+    if query:
+        base_url, new_search_params = parse_search_query(query)
+        url_res: str = f"{base_url}/{new_search_params.resourceType}"
+        if new_search_params.resourceType not in pretty_supported_search_params:
+            logger.error(f"Resource {new_search_params.resourceType} is not supported for searching, returning empty Bundle")
+            yield dump_search_output(Bundle(**{"type": "searchset", "total": 0, "link": [{"relation": "self", "url": url_res}]}), raw=raw)
+            return
+        if not new_search_params.searchParams:
+            logger.error("No search params, Epic does not support pulling all resources of a given type with no search parameters. Please refine your query.")
+            yield dump_search_output(handle_no_search_params_response(await client.get(f"{url_res}", headers=query_headers)), raw=raw)
+            return
     else:
         assert search_params
         new_search_params = search_params
 
     logger.info(f"Search parameters for this request are: {new_search_params}")
 
-    gap_output: list[str] = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=new_search_params)
+    # Compiled once here so the date sharding, query planning, and gap analysis below all share it
+    if search_param_index is None:
+        search_param_index = compile_search_param_index(supported_search_params)
+
+    if date_sharding and can_shard_by_date(date_sharding, supported_search_params, search_params=new_search_params, search_param_index=search_param_index):
+        async for page in search_date_shards_async(
+            client=client,
+            supported_search_params=supported_search_params,
+            date_sharding=date_sharding,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=new_search_params,
+            search_param_index=search_param_index,
+            max_concurrency=max_concurrency,
+            gap_output=gap_output,
+            reference_lookups=reference_lookups,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=reference_batch_size,
+        ):
+            yield page
+        return
+
+    plan_statistics: bool = queryplanner.query_statistics is not None and follow_next and not date_window
+    query_plans: list[QueryPlan] | None = None
+    if plan_statistics and use_query_planner:
+        query_plans = enumerate_query_plans(new_search_params, supported_search_params=supported_search_params, search_param_index=search_param_index)
+        query_plan: QueryPlan = choose_query_plan(query_plans, queryplanner.query_statistics, supported_search_params=supported_search_params, search_param_index=search_param_index)  # type: ignore
+        if len(query_plan.branches) > 1:
+            async for page in search_query_plan_async(
+                client=client,
+                supported_search_params=supported_search_params,
+                query_plan=query_plan,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_param_index=search_param_index,
+                max_concurrency=max_concurrency,
+                reference_lookups=reference_lookups,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+            ):
+                yield page
+            return
+
+    if gap_output is None:
+        with timed("gap_analysis", resource_type=new_search_params.resourceType):
+            gap_output = run_gap_analysis(supported_search_params=supported_search_params, query_search_params=new_search_params, search_param_index=search_param_index)
 
     logger.debug(f"Gap output from these two sets of search parameters is: {gap_output}")
 
-    new_query_params_str: str = "&".join([f"{key}={value}" for key, value in new_search_params.searchParams.items() if key not in gap_output])
-    if new_query_params_str:
-        new_query_string: str = f"{new_search_params.resourceType}?{new_query_params_str}"
-    else:
-        new_query_string = new_search_params.resourceType
+    plan_observer: PlanObserver | None = (
+        create_plan_observer(new_search_params, gap_output, supported_search_params=supported_search_params, search_param_index=search_param_index, query_plans=query_plans)
+        if plan_statistics
+        else None
+    )
+
+    new_query_string: str = build_query_string(search_params=new_search_params, gap_output=gap_output)
+    new_query_string = add_search_includes(new_query_string, search_params=new_search_params, supported_search_params=supported_search_params)
+    new_query_string = add_date_window(new_query_string, date_window)
 
     logger.debug(f"New query string is {new_query_string}")
 
     assert base_url
     assert query_headers
-    logger.info(f"Making request to {base_url}/{new_query_string}")
-    new_query_response = client.get(f"{base_url}/{new_query_string}", headers=query_headers)
-    if new_query_response.status_code == 400:
+    page_url: str = f"{base_url}/{new_query_string}"
+    page_number: int = 0
+
+    logger.info(f"Making request to {page_url}")
+    next_page_task: asyncio.Task[httpx.Response] | None = asyncio.create_task(
+        fetch_search_page_async(client, page_url, query_headers, new_search_params.resourceType, "_lastUpdated" in pretty_supported_search_params[new_search_params.resourceType])
+    )
+    try:
+        while next_page_task:
+            new_query_response: httpx.Response = await next_page_task
+            next_page_task = None
+            page_number += 1
+
+            if new_query_response.status_code != 200:
+                yield dump_search_output(handle_search_error_response(response=new_query_response, request_url=page_url), raw=raw)
+                return
+
+            new_query_response_json: dict = new_query_response.json()
+            if plan_observer:
+                plan_observer.observe(new_query_response_json)
+
+            next_url: str | None = get_next_page_url(new_query_response_json) if follow_next else None
+            if next_url:
+                logger.info(f"Making request to page {page_number + 1} at {next_url}")
+                page_url = next_url
+                next_page_task = asyncio.create_task(fetch_search_page_async(client, next_url, query_headers, new_search_params.resourceType))
+
+            yield await process_search_page_async(
+                client=client,
+                page_json=new_query_response_json,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_params=new_search_params,
+                gap_output=gap_output,
+                new_query_string=new_query_string,
+                max_concurrency=max_concurrency,
+                reference_lookups=reference_lookups,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+            )
+    finally:
+        if next_page_task:
+            next_page_task.cancel()
+
+    if plan_observer:
+        plan_observer.finish()
+    logger.debug(f"Finished paging after {page_number} page(s)")
+
+
+def search_date_shards(
+    client: httpx.Client,
+    supported_search_params: list[SupportedSearchParams],
+    date_sharding: DateSharding,
+    base_url: str | None,
+    query_headers: dict[str, str] | None,
+    search_params: QuerySearchParams,
+    search_param_index: SearchParamIndex | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> Iterator[Bundle | OperationOutcome | dict | None]:
+    """
+    Function to run a search as disjoint date windows, date_sharding.concurrency at a time, yielding the pages of each window as it finishes
+
+    Every page of each window is retrieved. A new window is started whenever one finishes, sized by DateWindowPlanner from the entries the finished windows
+    returned. Entries already yielded from another window are removed. If a window fails, its OperationOutcome (or None) is yielded and no more windows are
+    started.
+    """
+
+    planner: DateWindowPlanner = DateWindowPlanner(date_sharding)
+    seen_entries: set[str] = set()
+
+    def search_window(date_window: DateWindow) -> list[Bundle | OperationOutcome | dict | None]:
+        return list(
+            search_pages(
+                client=client,
+                supported_search_params=supported_search_params,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_params=search_params,
+                follow_next=True,
+                search_param_index=search_param_index,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+                date_window=date_window,
+            )
+        )
+
+    with ThreadPoolExecutor(max_workers=date_sharding.concurrency) as executor:
+        in_flight: dict[Future[list[Bundle | OperationOutcome | dict | None]], DateWindow] = {}
+        while True:
+            while len(in_flight) < date_sharding.concurrency and (date_window := planner.next_window()):
+                in_flight[executor.submit(search_window, date_window)] = date_window
+            if not in_flight:
+                break
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for window_future in done:
+                window_pages: list[Bundle | OperationOutcome | dict | None] = window_future.result()
+                planner.record(in_flight.pop(window_future), sum([count_page_entries(page) for page in window_pages]))
+                for page in window_pages:
+                    if not is_bundle_page(page):
+                        for pending_future in in_flight:
+                            pending_future.cancel()
+                        yield page
+                        return
+                    yield remove_seen_entries(page, seen_entries)
+
+
+async def search_date_shards_async(
+    client: httpx.AsyncClient,
+    supported_search_params: list[SupportedSearchParams],
+    date_sharding: DateSharding,
+    base_url: str | None,
+    query_headers: dict[str, str] | None,
+    search_params: QuerySearchParams,
+    search_param_index: SearchParamIndex | None = None,
+    max_concurrency: int = 10,
+    gap_output: list[str] | None = None,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> AsyncIterator[Bundle | OperationOutcome | dict | None]:
+    """Async version of search_date_shards, where the windows share their reference lookups"""
+
+    planner: DateWindowPlanner = DateWindowPlanner(date_sharding)
+    seen_entries: set[str] = set()
+    shared_lookups: dict[str, asyncio.Task] = reference_lookups if reference_lookups is not None else {}
+
+    async def search_window(date_window: DateWindow) -> list[Bundle | OperationOutcome | dict | None]:
+        return [
+            page
+            async for page in search_pages_async(
+                client=client,
+                supported_search_params=supported_search_params,
+                base_url=base_url,
+                query_headers=query_headers,
+                search_params=search_params,
+                follow_next=True,
+                search_param_index=search_param_index,
+                max_concurrency=max_concurrency,
+                gap_output=gap_output,
+                reference_lookups=shared_lookups,
+                expand_documents=expand_documents,
+                raw=raw,
+                reference_batch_size=reference_batch_size,
+                date_window=date_window,
+            )
+        ]
+
+    in_flight: dict[asyncio.Task[list[Bundle | OperationOutcome | dict | None]], DateWindow] = {}
+    try:
+        while True:
+            while len(in_flight) < date_sharding.concurrency and (date_window := planner.next_window()):
+                in_flight[asyncio.create_task(search_window(date_window))] = date_window
+            if not in_flight:
+                break
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            for window_task in done:
+                window_pages: list[Bundle | OperationOutcome | dict | None] = window_task.result()
+                planner.record(in_flight.pop(window_task), sum([count_page_entries(page) for page in window_pages]))
+                for page in window_pages:
+                    if not is_bundle_page(page):
+                        yield page
+                        return
+                    yield remove_seen_entries(page, seen_entries)
+    finally:
+        for window_task in in_flight:
+            window_task.cancel()
+
+
+def search_query_plan(
+    client: httpx.Client,
+    supported_search_params: list[SupportedSearchParams],
+    query_plan: QueryPlan,
+    base_url: str | None,
+    query_headers: dict[str, str] | None,
+    search_param_index: SearchParamIndex | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> Iterator[Bundle | OperationOutcome | dict | None]:
+    """
+    Function to run the branches of a query plan one after another, following every page of each, and yield their pages
+
+    Entries already yielded from another branch (such as a Condition with two of the split categories) are removed. If a branch fails, its
+    OperationOutcome (or None) is yielded and no more branches are run.
+    """
+
+    seen_entries: set[str] = set()
+    for branch_params in query_plan.branches:
+        for page in search_pages(
+            client=client,
+            supported_search_params=supported_search_params,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=branch_params,
+            follow_next=True,
+            search_param_index=search_param_index,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=reference_batch_size,
+            use_query_planner=False,
+        ):
+            if not is_bundle_page(page):
+                yield page
+                return
+            yield remove_seen_entries(page, seen_entries)
+
+
+async def search_query_plan_async(
+    client: httpx.AsyncClient,
+    supported_search_params: list[SupportedSearchParams],
+    query_plan: QueryPlan,
+    base_url: str | None,
+    query_headers: dict[str, str] | None,
+    search_param_index: SearchParamIndex | None = None,
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> AsyncIterator[Bundle | OperationOutcome | dict | None]:
+    """Async version of search_query_plan, where the branches share their reference lookups"""
+
+    seen_entries: set[str] = set()
+    shared_lookups: dict[str, asyncio.Task] = reference_lookups if reference_lookups is not None else {}
+    for branch_params in query_plan.branches:
+        async for page in search_pages_async(
+            client=client,
+            supported_search_params=supported_search_params,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=branch_params,
+            follow_next=True,
+            search_param_index=search_param_index,
+            max_concurrency=max_concurrency,
+            reference_lookups=shared_lookups,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=reference_batch_size,
+            use_query_planner=False,
+        ):
+            if not is_bundle_page(page):
+                yield page
+                return
+            yield remove_seen_entries(page, seen_entries)
+
+
+def is_bundle_page(page: Bundle | OperationOutcome | dict | None) -> bool:
+    from fhir.resources.R4B.bundle import Bundle
+
+    return isinstance(page, Bundle) or (isinstance(page, dict) and page.get("resourceType") == "Bundle")
+
+
+def fetch_search_page(client: httpx.Client, page_url: str, query_headers: dict[str, str] | None, resource_type: str, last_updated_probe: bool = False) -> httpx.Response:
+    """
+    Function to get a single searchset page, from the search response cache when it is configured (see querycache.configure_query_caches)
+
+    A fresh cached page is returned without a request. A stale one is revalidated with its ETag or Last-Modified validator, or, when last_updated_probe is
+    set and the server sent neither, with a _lastUpdated count search.
+    """
+
+    cached_response: dict | None = querycache.get_cached_search_response(page_url, query_headers)
+    if cached_response and querycache.is_fresh(cached_response):
+        return querycache.build_cached_response(page_url, cached_response)
+
+    revalidation_headers: dict[str, str] = querycache.get_revalidation_headers(cached_response) if cached_response else {}
+    if cached_response and not revalidation_headers and last_updated_probe:
+        probe_response: httpx.Response = request_search_page(client, querycache.get_last_updated_probe_url(page_url, cached_response), query_headers, resource_type)
+        if querycache.is_unchanged_probe(probe_response):
+            return querycache.refresh_cached_search_response(page_url, query_headers, cached_response)
+
+    response: httpx.Response = request_search_page(client, page_url, {**(query_headers or {}), **revalidation_headers}, resource_type)
+    if response.status_code == 304 and cached_response:
+        return querycache.refresh_cached_search_response(page_url, query_headers, cached_response)
+    querycache.set_cached_search_response(page_url, query_headers, response)
+    return response
+
+
+async def fetch_search_page_async(client: httpx.AsyncClient, page_url: str, query_headers: dict[str, str] | None, resource_type: str, last_updated_probe: bool = False) -> httpx.Response:
+    """Async version of fetch_search_page"""
+
+    cached_response: dict | None = querycache.get_cached_search_response(page_url, query_headers)
+    if cached_response and querycache.is_fresh(cached_response):
+        return querycache.build_cached_response(page_url, cached_response)
+
+    revalidation_headers: dict[str, str] = querycache.get_revalidation_headers(cached_response) if cached_response else {}
+    if cached_response and not revalidation_headers and last_updated_probe:
+        probe_response: httpx.Response = await request_search_page_async(client, querycache.get_last_updated_probe_url(page_url, cached_response), query_headers, resource_type)
+        if querycache.is_unchanged_probe(probe_response):
+            return querycache.refresh_cached_search_response(page_url, query_headers, cached_response)
+
+    response: httpx.Response = await request_search_page_async(client, page_url, {**(query_headers or {}), **revalidation_headers}, resource_type)
+    if response.status_code == 304 and cached_response:
+        return querycache.refresh_cached_search_response(page_url, query_headers, cached_response)
+    querycache.set_cached_search_response(page_url, query_headers, response)
+    return response
+
+
+def request_search_page(client: httpx.Client, page_url: str, query_headers: dict[str, str] | None, resource_type: str) -> httpx.Response:
+    """Function to request a single searchset page, timing and counting the request for the metrics hooks"""
+
+    with timed("search", resource_type=resource_type):
+        response: httpx.Response = client.get(page_url, headers=query_headers)
+    count_response(response, kind="search", resource_type=resource_type)
+    return response
+
+
+async def request_search_page_async(client: httpx.AsyncClient, page_url: str, query_headers: dict[str, str] | None, resource_type: str) -> httpx.Response:
+    """Async version of request_search_page"""
+
+    with timed("search", resource_type=resource_type):
+        response: httpx.Response = await client.get(page_url, headers=query_headers)
+    count_response(response, kind="search", resource_type=resource_type)
+    return response
+
+
+def get_search_output_key(
+    base_url: str | None,
+    search_params: QuerySearchParams | None,
+    query: str | None,
+    query_headers: dict[str, str] | None,
+    capability_statement_key: str | None,
+    follow_next: bool,
+    expand_documents: bool,
+) -> str | None:
+    """Function to get the search output cache key of a query, or None when the search output cache is off"""
+
+    if querycache.search_output_cache is None:
+        return None
+    if query:
+        if "?" not in query:
+            return None
+        base_url, search_params = parse_search_query(query)
+    if not base_url or not search_params:
+        return None
+    return querycache.get_search_output_key(base_url, search_params, query_headers, capability_statement_key, follow_next=follow_next, expand_documents=expand_documents)
+
+
+def get_cached_search_output(output_key: str | None, raw: bool) -> Bundle | dict | None:
+    """Function to get a cached search output in the form the caller asked for, or None if it is not cached"""
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if not output_key:
+        return None
+    # Validating builds new objects, so only raw output needs a copy to keep the cache safe from changes by the caller
+    cached_output: dict | None = querycache.get_cached_search_output(output_key, copy_output=raw)
+    if cached_output is None:
+        return None
+    return cached_output if raw else Bundle.model_validate(cached_output)
+
+
+def get_query_capability_statement_key(base_url: str | None, query: str | None, capability_statement_url: str | None, capability_statement_file: str | None) -> str | None:
+    """
+    Function to identify the CapabilityStatement a query runs under for its search output cache key, without loading it, or None when the search output
+    cache is off
+    """
+
+    if querycache.search_output_cache is None:
+        return None
+    compiled_cs: CompiledCapabilityStatement | None = get_registered_capability_statement(
+        base_url=base_url, query=query, capability_statement_url=capability_statement_url, capability_statement_file=capability_statement_file
+    )
+    if compiled_cs:
+        return get_capability_statement_key(compiled_cs)
+    return get_capability_statement_source_key(url=capability_statement_url, file_path=capability_statement_file)
+
+
+def cache_search_output(output_key: str | None, output: Bundle | OperationOutcome | dict | None) -> Bundle | OperationOutcome | dict | None:
+    """Function to add a search output to the search output cache, returning it unchanged"""
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if output_key and isinstance(output, (Bundle, dict)):
+        if isinstance(output, dict):
+            querycache.set_cached_search_output(output_key, output)
+        else:
+            querycache.set_cached_search_output(output_key, output.model_dump(mode="json", exclude_none=True), copy_output=False)
+    return output
+
+
+def add_log_handler() -> None:
+    """Function to attach the package's console handler to its logger, done when the first query runs rather than at import so importing has no side effects"""
+
+    logger.addHandler(ch)
+
+
+def enable_debug_logging() -> None:
+    """Function to switch the package logger and its handler to DEBUG"""
+
+    add_log_handler()
+    logger.info("Logging level is being set to DEBUG")
+    logger.setLevel(logging.DEBUG)
+    ch.setLevel(logging.DEBUG)
+
+
+def check_query_arguments(base_url: str | None, search_params: QuerySearchParams | None, query: str | None) -> None:
+    """Function to make sure there is enough information to build a query"""
+
+    # Error handling
+    if not base_url and not search_params and not query:
+        raise ValueError("You must provide either a base_url and a dictionary of search parameters or the full query string in the form of <baseUrl>/<resourceType>?<param1>=<value1>&...")
+
+
+def start_incremental_sync(
+    sync_store: ReferenceCache, base_url: str | None, search_params: QuerySearchParams | None, query: str | None, sync_scope: str | None, expand_documents: bool
+) -> IncrementalSync:
+    """Function to start an incremental run of a query given either as a base url and search parameters or as a full query string"""
+
+    check_query_arguments(base_url=base_url, search_params=search_params, query=query)
+    if query:
+        base_url, search_params = parse_search_query(query)
+    assert base_url and search_params
+    return IncrementalSync(sync_store, base_url=base_url, search_params=search_params, sync_scope=sync_scope, expand_documents=expand_documents)
+
+
+def load_sync_output(output: dict | None, raw: bool, resource_type: str) -> Bundle | OperationOutcome | dict | None:
+    """Function to validate the raw output of an incremental run into fhir.resources models, unless the caller asked for raw output"""
+
+    from fhir.resources.R4B.bundle import Bundle
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+    if raw or output is None:
+        return output
+    if output.get("resourceType") == "Bundle":
+        with timed("validate", resource_type=resource_type):
+            return Bundle.model_validate(output)
+    return OperationOutcome.model_validate(output)
+
+
+def get_registered_capability_statement(base_url: str | None, query: str | None, capability_statement_url: str | None, capability_statement_file: str | None) -> CompiledCapabilityStatement | None:
+    """Function to find the compiled CapabilityStatement registered for the server being searched, when no CapabilityStatement file or url was given"""
+
+    if capability_statement_url or capability_statement_file:
+        return None
+    if query and "?" in query:
+        base_url, _ = parse_search_query(query)
+    return compiledcapabilitystatement.capability_statement_registry.get(base_url) if base_url else None
+
+
+def get_pretty_supported_search_params(supported_search_params: list[SupportedSearchParams]) -> dict[str, list[str]]:
+    """Function to map each searchable resource type to the names of its supported search parameters"""
+
+    return {resource_params.resourceType: [item.name for item in resource_params.searchParams if item.name] for resource_params in supported_search_params}
+
+
+def parse_search_query(query: str) -> tuple[str, QuerySearchParams]:
+    """Function to split a full query string in the form of <baseUrl>/<resourceType>?<param1>=<value1>&... into the base url and its search parameters"""
+
+    url_res, q_search_params = query.split("?")
+    base_url: str = "/".join(url_res.split("/")[:-1])
+    q_resource_type: str = url_res.split("/")[-1]
+    search_params_dict: dict[str, str] = {}
+    if q_search_params:
+        search_params_list: list[str] = q_search_params.split("&")
+        search_params_dict = {item.split("=")[0]: item.split("=")[1] for item in search_params_list}
+
+    return base_url, QuerySearchParams(resourceType=q_resource_type, searchParams=search_params_dict)
+
+
+def build_query_string(search_params: QuerySearchParams, gap_output: list[str]) -> str:
+    """Function to build the <resourceType>?<params> query string sent to the server, leaving out the search parameters found by the gap analysis"""
+
+    new_query_params_str: str = "&".join([f"{key}={value}" for key, value in search_params.searchParams.items() if key not in gap_output])
+    if new_query_params_str:
+        return f"{search_params.resourceType}?{new_query_params_str}"
+    return search_params.resourceType
+
+
+def add_search_includes(query_string: str, search_params: QuerySearchParams, supported_search_params: list[SupportedSearchParams]) -> str:
+    """
+    Function to ask the server to include the resources the expansions would otherwise look up one by one, when the CapabilityStatement allows it
+
+    MedicationRequest searches get _include=MedicationRequest:medication, so the referenced Medications come back in the same Bundle as the
+    MedicationRequests. Queries that already have an _include are left alone.
+    """
+
+    if search_params.resourceType != "MedicationRequest" or "_include" in search_params.searchParams:
+        return query_string
+    if not supports_search_include(supported_search_params, "MedicationRequest", MEDICATION_INCLUDE):
+        return query_string
+    return f"{query_string}{'&' if '?' in query_string else '?'}_include={MEDICATION_INCLUDE}"
+
+
+def handle_no_search_params_response(response: httpx.Response) -> OperationOutcome | None:
+    """Function to turn the response of a query without search parameters into the value returned to the caller"""
+
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+    if response.status_code == 403:
+        logger.error(f"The query responded with a status code of {response.status_code}")
+        if "WWW-Authenticate" in response.headers:
+            logger.error(f"WWW-Authenticate Error: {response.headers['WWW-Authenticate']}")
+            OO_body = {
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": "processing", "diagnostics": f"WWW-Authenticate Error: {response.headers['WWW-Authenticate']}"}],
+            }
+        else:
+            OO_body: dict = {
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": "processing", "diagnostics": f"The query responded with a status code of {response.status_code}"}],
+            }
+        return OperationOutcome(**OO_body)
+    elif response.status_code == 400:
+        return OperationOutcome(**response.json())
+    return None
+
+
+def get_next_page_url(bundle_json: dict) -> str | None:
+    """Function to pull the url of Bundle.link[relation=next] out of a searchset Bundle, if there is one"""
+
+    for link in bundle_json.get("link", []):
+        if link.get("relation") == "next" and link.get("url"):
+            return link["url"]
+    return None
+
+
+def merge_bundle_pages(pages: Iterable[Bundle | OperationOutcome | dict | None]) -> Bundle | OperationOutcome | dict | None:
+    """
+    Function to merge the pages yielded by run_fhir_query_pages into a single searchset Bundle, returning the first non-Bundle output if any page failed
+
+    Pages run with raw=True are merged into a single Bundle dictionary.
+    """
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    merged_bundle: Bundle | dict | None = None
+    merged_entries: list[BundleEntry | dict] = []
+
+    for page in pages:
+        is_raw_bundle: bool = isinstance(page, dict) and page.get("resourceType") == "Bundle"
+        if not isinstance(page, Bundle) and not is_raw_bundle:
+            return page
+        if merged_bundle is None:
+            merged_bundle = page  # type: ignore
+        page_entries: list | None = page.get("entry") if is_raw_bundle else page.entry  # type: ignore
+        if page_entries:
+            merged_entries.extend(page_entries)
+
+    if merged_bundle is None:
+        return None
+
+    if isinstance(merged_bundle, dict):
+        if "link" in merged_bundle:
+            merged_bundle["link"] = [link for link in merged_bundle["link"] if link.get("relation") != "next"]
+        merged_bundle["entry"] = merged_entries
+        merged_bundle["total"] = len(merged_entries)
+        return merged_bundle
+
+    if merged_bundle.link:
+        merged_bundle.link = [link for link in merged_bundle.link if link.relation != "next"]
+    merged_bundle.entry = merged_entries  # type: ignore
+    merged_bundle.total = len(merged_entries)
+
+    return merged_bundle
+
+
+def handle_search_error_response(response: httpx.Response, request_url: str) -> Bundle | OperationOutcome | dict:
+    """Function to turn a non-200 search response into the value returned to the caller"""
+
+    from fhir.resources.R4B.bundle import Bundle
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+    if response.status_code == 400:
         logger.warning(
             "The query responded with a status code of 400 Bad Request. Most likely this is due to using an incorrect codesystem when searching a code on a resource. "
             "For example, searching CPT or HCPCS codes (Procedure codes) on an Observation. This will return an empty Bundle, but make sure to modify your queries to "
             "only search appropriate codes for the type of resource."
         )
-        return Bundle(**{"type": "searchset", "total": 0, "link": [{"relation": "self", "url": f"{base_url}/{new_query_string}"}]})
-    if new_query_response.status_code != 200:
-        logger.error(f"The query responded with a status code of {new_query_response.status_code}")
-        if "WWW-Authenticate" in new_query_response.headers:
-            logger.error(f"WWW-Authenticate Error: {new_query_response.headers['WWW-Authenticate']}")
-            return OperationOutcome(
-                **{
-                    "resourceType": "OperationOutcome",
-                    "issue": [{"severity": "error", "code": "processing", "diagnostics": f"WWW-Authenticate Error: {new_query_response.headers['WWW-Authenticate']}"}],
-                }
-            )
-        try:
-            return new_query_response.json()
-        except json.JSONDecodeError:
-            if "html" in new_query_response.headers["Content-Type"]:
-                logger.error("Error caused HTML response")
-                title_match: re.Match[str] | None = re.search(r"<title>(.*?)</title>", new_query_response.text)
-                if title_match:
-                    title_content = title_match.group(1)  # Extract the content within the title tags
-                    logger.error(f"Response error from query: {title_content}")
-                    return OperationOutcome(**{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": "From Epic: " + title_content}]})
-            logger.error("Unable to parse response as JSON body")
-            return OperationOutcome(
-                **{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": "Unable to parse response as JSON or HTML with a title"}]}
-            )
+        return Bundle(**{"type": "searchset", "total": 0, "link": [{"relation": "self", "url": request_url}]})
+    logger.error(f"The query responded with a status code of {response.status_code}")
+    if "WWW-Authenticate" in response.headers:
+        logger.error(f"WWW-Authenticate Error: {response.headers['WWW-Authenticate']}")
+        return OperationOutcome(
+            **{
+                "resourceType": "OperationOutcome",
+                "issue": [{"severity": "error", "code": "processing", "diagnostics": f"WWW-Authenticate Error: {response.headers['WWW-Authenticate']}"}],
+            }
+        )
+    try:
+        return response.json()
+    except json.JSONDecodeError:
+        if "html" in response.headers["Content-Type"]:
+            logger.error("Error caused HTML response")
+            title_match: re.Match[str] | None = re.search(r"<title>(.*?)</title>", response.text)
+            if title_match:
+                title_content = title_match.group(1)  # Extract the content within the title tags
+                logger.error(f"Response error from query: {title_content}")
+                return OperationOutcome(**{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": "From Epic: " + title_content}]})
+        logger.error("Unable to parse response as JSON body")
+        return OperationOutcome(**{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "processing", "diagnostics": "Unable to parse response as JSON or HTML with a title"}]})
+
+
+def validate_search_page(page_json: dict) -> Bundle:
+    """Function to validate a single searchset page into a Bundle, removing any OperationOutcome entries after logging their diagnostics"""
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    return Bundle.model_validate(clean_search_page_json(page_json))
 
-    new_query_response_json: dict = new_query_response.json()
+
+def clean_search_page_json(page_json: dict) -> dict:
+    """Function to fix up a raw searchset page before it is filtered and expanded, removing any OperationOutcome entries after logging their diagnostics"""
+
+    new_query_response_json: dict = page_json
 
     try:
         if new_query_response_json["entry"][0]["resource"]["resourceType"] == "Patient":
@@ -161,54 +1243,163 @@ def run_fhir_query(
     except (IndexError, KeyError):
         pass
 
-    new_query_response_bundle: Bundle = Bundle.model_validate(new_query_response_json)
-
-    if not new_query_response_bundle.entry:
-        return new_query_response_bundle
+    entries: list[dict] = new_query_response_json.get("entry", [])
+    oo_resources: list[dict] = [entry["resource"] for entry in entries if entry.get("resource", {}).get("resourceType") == "OperationOutcome"]
 
-    return_resource_types = [entry.resource.__resource_type__.lower() for entry in new_query_response_bundle.entry]
-
-    if "operationoutcome" in return_resource_types:
-        if all([item == "operationoutcome" for item in return_resource_types]):
+    if oo_resources:
+        if len(oo_resources) == len(entries):
             logger.warning("There was only OperationOutcomes in the return Bundle. Bundle.entry will be empty. See below for collected diagnostics or details strings:")
-            collected_log_strings = list(
-                set(
-                    [
-                        (issue.diagnostics if issue.diagnostics else issue.details.text if issue.details and issue.details.text else None)
-                        for entry in new_query_response_bundle.entry
-                        for issue in entry.resource.issue
-                    ]
-                )
-            )
-            logger.warning(collected_log_strings)
-            new_query_response_bundle.entry = []
         else:
             logger.warning("There was at least one OperationOutcome in the return Bundle. See below for collected diagnostics or details strings:")
-            oo_resources = list(filter(lambda x: x.__resource_type__ == "OperationOutcome", [entry.resource for entry in new_query_response_bundle.entry]))
-            collected_log_strings = list(
-                set([(issue.diagnostics if issue.diagnostics else issue.details.text if issue.details and issue.details.text else None) for entry in oo_resources for issue in entry.issue])
-            )
-            logger.warning(collected_log_strings)
-            new_query_response_bundle.entry = list(filter(lambda x: x.resource.__resource_type__ != "OperationOutcome", new_query_response_bundle.entry))
+        collected_log_strings = list(set([issue.get("diagnostics") or issue.get("details", {}).get("text") for resource in oo_resources for issue in resource.get("issue", [])]))
+        logger.warning(collected_log_strings)
+        new_query_response_json["entry"] = [entry for entry in entries if entry.get("resource", {}).get("resourceType") != "OperationOutcome"]
+        count("entries_dropped", len(oo_resources), reason="operation_outcome")
+
+    return new_query_response_json
+
+
+def dump_search_output(output: Bundle | OperationOutcome | dict | None, raw: bool) -> Bundle | OperationOutcome | dict | None:
+    """Function to turn a validated search output into a JSON dictionary when the caller asked for raw output"""
 
-    # This happens before since its searching on code which is completed by this expansion
+    from fhir.resources.R4B.bundle import Bundle
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+    if raw and isinstance(output, (Bundle, OperationOutcome)):
+        return output.model_dump(mode="json", exclude_none=True)
+    return output
+
+
+def process_search_page(
+    client: httpx.Client,
+    page_json: dict,
+    base_url: str,
+    query_headers: dict[str, str],
+    search_params: QuerySearchParams,
+    gap_output: list[str],
+    new_query_string: str,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> Bundle | dict:
+    """
+    Function to filter and expand a single searchset page
+
+    The page stays in its raw JSON form through filtering and expansion and is only validated into a Bundle once at the end, or not at all when raw is set.
+    """
+
+    page_json = clean_search_page_json(page_json)
+    if not page_json.get("entry"):
+        return validate_output_page(page_json, raw=raw, resource_type=search_params.resourceType)
+
+    # MedicationRequest is filtered after expansion since its searching on code which is completed by the expansion
     if "MedicationRequest" in new_query_string:
         logger.info("Resources are of type MedicationRequest, proceeding to expand MedicationReferences")
-        new_query_response_bundle = expand_medication_references_in_bundle(client=client, input_bundle=new_query_response_bundle, base_url=base_url, query_headers=query_headers)
+        with timed("expand_medications", resource_type=search_params.resourceType):
+            page_json = expand_medication_references_in_bundle_json(client=client, bundle_json=page_json, base_url=base_url, query_headers=query_headers, batch_size=reference_batch_size)
+    logger.debug(f"Size of bundle before filtering is {len(page_json.get('entry', []))} resources")
+    with timed("filter", resource_type=search_params.resourceType):
+        output_json: dict = filter_bundle_json(bundle_json=page_json, search_params=search_params, gap_analysis_output=gap_output)
+    logger.info(f"Size of bundle after filtering is {output_json.get('total')} resources")
+
+    if not output_json.get("entry"):
+        return validate_output_page(output_json, raw=raw, resource_type=search_params.resourceType)
+
+    if "DocumentReference" in new_query_string and not expand_documents:
+        logger.info("Resources are of type DocumentReference, leaving Binary content to be retrieved on demand")
+    elif "DocumentReference" in new_query_string:
+        logger.info("Resources are of type DocumentReference, proceeding to expand DocumentReferences")
+        with timed("expand_documents", resource_type=search_params.resourceType):
+            output_json = expand_document_references_in_bundle_json(client=client, bundle_json=output_json, base_url=base_url, query_headers=query_headers)
+    elif "Condition" in new_query_string:
+        logger.info("Resources are of type Condition, checking if any are Encounter Diagnoses...")
+        if has_encounter_diagnoses(output_json):
+            logger.info("Found Condition resources with category Encounter Diagnosis, proceeding to extract Encounter.period.start as Condition.onsetDateTime")
+            with timed("expand_conditions", resource_type=search_params.resourceType):
+                output_json = expand_condition_onset_in_bundle_json(client=client, bundle_json=output_json, base_url=base_url, query_headers=query_headers, batch_size=reference_batch_size)
+
+    return validate_output_page(output_json, raw=raw, resource_type=search_params.resourceType)
 
-    logger.debug(f"Size of bundle before filtering is {new_query_response_bundle.total} resources")
-    filtered_bundle: Bundle = filter_bundle(input_bundle=new_query_response_bundle, search_params=new_search_params, gap_analysis_output=gap_output)
-    logger.info(f"Size of bundle after filtering is {filtered_bundle.total} resources")
 
-    output_bundle = filtered_bundle
+async def process_search_page_async(
+    client: httpx.AsyncClient,
+    page_json: dict,
+    base_url: str,
+    query_headers: dict[str, str],
+    search_params: QuerySearchParams,
+    gap_output: list[str],
+    new_query_string: str,
+    max_concurrency: int = 10,
+    reference_lookups: dict[str, asyncio.Task] | None = None,
+    expand_documents: bool = True,
+    raw: bool = False,
+    reference_batch_size: int = 0,
+) -> Bundle | dict:
+    """Async version of process_search_page"""
+
+    page_json = clean_search_page_json(page_json)
+    if not page_json.get("entry"):
+        return validate_output_page(page_json, raw=raw, resource_type=search_params.resourceType)
+
+    # See process_search_page for why MedicationRequest is filtered after expansion
+    if "MedicationRequest" in new_query_string:
+        logger.info("Resources are of type MedicationRequest, proceeding to expand MedicationReferences")
+        with timed("expand_medications", resource_type=search_params.resourceType):
+            page_json = await expand_medication_references_in_bundle_json_async(
+                client=client,
+                bundle_json=page_json,
+                base_url=base_url,
+                query_headers=query_headers,
+                max_concurrency=max_concurrency,
+                reference_lookups=reference_lookups,
+                batch_size=reference_batch_size,
+            )
+    logger.debug(f"Size of bundle before filtering is {len(page_json.get('entry', []))} resources")
+    with timed("filter", resource_type=search_params.resourceType):
+        output_json: dict = filter_bundle_json(bundle_json=page_json, search_params=search_params, gap_analysis_output=gap_output)
+    logger.info(f"Size of bundle after filtering is {output_json.get('total')} resources")
+
+    if not output_json.get("entry"):
+        return validate_output_page(output_json, raw=raw, resource_type=search_params.resourceType)
 
-    if "DocumentReference" in new_query_string:
+    if "DocumentReference" in new_query_string and not expand_documents:
+        logger.info("Resources are of type DocumentReference, leaving Binary content to be retrieved on demand")
+    elif "DocumentReference" in new_query_string:
         logger.info("Resources are of type DocumentReference, proceeding to expand DocumentReferences")
-        output_bundle = expand_document_references_in_bundle(client=client, input_bundle=filtered_bundle, base_url=base_url, query_headers=query_headers)
+        with timed("expand_documents", resource_type=search_params.resourceType):
+            output_json = await expand_document_references_in_bundle_json_async(
+                client=client, bundle_json=output_json, base_url=base_url, query_headers=query_headers, max_concurrency=max_concurrency, reference_lookups=reference_lookups
+            )
     elif "Condition" in new_query_string:
         logger.info("Resources are of type Condition, checking if any are Encounter Diagnoses...")
-        if "encounter-diagnosis" in [category.coding[0].code for entry in filtered_bundle.entry for category in entry.resource.category]:  # type: ignore
+        if has_encounter_diagnoses(output_json):
             logger.info("Found Condition resources with category Encounter Diagnosis, proceeding to extract Encounter.period.start as Condition.onsetDateTime")
-            output_bundle = expand_condition_onset_in_bundle(client=client, input_bundle=filtered_bundle, base_url=base_url, query_headers=query_headers)
+            with timed("expand_conditions", resource_type=search_params.resourceType):
+                output_json = await expand_condition_onset_in_bundle_json_async(
+                    client=client,
+                    bundle_json=output_json,
+                    base_url=base_url,
+                    query_headers=query_headers,
+                    max_concurrency=max_concurrency,
+                    reference_lookups=reference_lookups,
+                    batch_size=reference_batch_size,
+                )
+
+    return validate_output_page(output_json, raw=raw, resource_type=search_params.resourceType)
+
+
+def validate_output_page(bundle_json: dict, raw: bool, resource_type: str) -> Bundle | dict:
+    """Function to validate a filtered and expanded searchset page into a Bundle, unless the caller asked for raw output"""
+
+    from fhir.resources.R4B.bundle import Bundle
+
+    if raw:
+        return bundle_json
+    with timed("validate", resource_type=resource_type):
+        return Bundle.model_validate(bundle_json)
+
+
+def has_encounter_diagnoses(bundle_json: dict) -> bool:
+    """Function to check whether any Condition in a raw searchset page has an encounter-diagnosis category"""
 
-    return output_bundle
+    return "encounter-diagnosis" in [category.get("coding", [{}])[0].get("code") for entry in bundle_json["entry"] for category in entry["resource"].get("category", [])]
@@ -1,9 +1,9 @@
 """File for custom models"""
 
 import logging
+from typing import Any, Literal
 
-from fhir.resources.R4B.capabilitystatement import CapabilityStatementRestResourceSearchParam
-from pydantic import BaseModel
+from pydantic import BaseModel, field_serializer
 
 
 class CustomFormatter(logging.Formatter):
@@ -31,9 +31,56 @@ class CustomFormatter(logging.Formatter):
 
 class SupportedSearchParams(BaseModel):
     resourceType: str
-    searchParams: list[CapabilityStatementRestResourceSearchParam]
+    # CapabilityStatementRestResourceSearchParam objects, left as Any so importing the models does not import fhir.resources
+    searchParams: list[Any]
+    searchInclude: list[str] = []
 
 
 class QuerySearchParams(BaseModel):
     resourceType: str
     searchParams: dict[str, str]
+
+
+class QueryPlan(BaseModel):
+    """One way to run a search, as branches whose results together are the results of the search, see queryplanner.enumerate_query_plans"""
+
+    branches: list[QuerySearchParams]
+    estimatedCost: float | None = None
+
+
+class SearchParamCondition(BaseModel):
+    """A parsed true-when extension, e.g. category==infection or category in [infection, health-concern]"""
+
+    field: str
+    operator: Literal["==", "in"]
+    values: frozenset[str]
+
+    def is_met(self, query_params: dict[str, str]) -> bool:
+        if self.field not in query_params:
+            return False
+        if self.operator == "==":
+            return query_params[self.field] in self.values
+        return all([value in self.values for value in query_params[self.field].split(",")])
+
+    @field_serializer("values")
+    def serialize_values(self, values: frozenset[str]) -> list[str]:
+        return sorted(values)
+
+
+# resourceType -> search parameter name -> condition, where None means the parameter is always supported and a missing name means it is never supported
+SearchParamIndex = dict[str, dict[str, SearchParamCondition | None]]
+
+
+class CompiledResourceSearchParams(BaseModel):
+    searchParams: list[str] = []
+    searchParamIndex: dict[str, SearchParamCondition | None] = {}
+    searchInclude: list[str] = []
+
+
+class CompiledCapabilityStatement(BaseModel):
+    """The parts of a CapabilityStatement the search pipeline reads, keyed by resource type, see compiledcapabilitystatement.compile_capability_statement"""
+
+    formatVersion: int
+    source: str | None = None
+    resources: dict[str, CompiledResourceSearchParams]
+    batch: bool = False
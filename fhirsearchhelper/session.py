@@ -0,0 +1,505 @@
+"""File for a long-lived search session that reuses its client and CapabilityStatement across queries"""
+
+from __future__ import annotations
+
+import asyncio
+import logging
+from functools import cached_property
+from typing import TYPE_CHECKING, AsyncIterator, Iterator
+
+import httpx
+
+from .helpers.cache import ReferenceCache
+from .helpers.capabilitystatement import get_capability_statement_key, get_supported_search_params, load_capability_statement, supports_batch
+from .helpers.compiledcapabilitystatement import get_compiled_search_param_index, get_compiled_supported_search_params
+from .helpers.datesharding import DateSharding
+from .helpers.gapanalysis import compile_search_param_index, run_gap_analysis
+from .helpers.incrementalsync import IncrementalSync
+from .helpers.metrics import timed
+from .helpers.ratelimit import AsyncRateLimitedTransport, RateLimitedTransport, create_async_transport, create_transport
+from .main import (
+    add_log_handler,
+    cache_search_output,
+    dump_search_output,
+    enable_debug_logging,
+    get_cached_search_output,
+    get_search_output_key,
+    load_sync_output,
+    merge_bundle_pages,
+    parse_search_query,
+    search_pages,
+    search_pages_async,
+    start_incremental_sync,
+)
+from .models.models import CompiledCapabilityStatement, QuerySearchParams, SearchParamCondition, SearchParamIndex, SupportedSearchParams
+
+if TYPE_CHECKING:
+    from fhir.resources.R4B.bundle import Bundle
+    from fhir.resources.R4B.capabilitystatement import CapabilityStatement
+    from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+logger: logging.Logger = logging.getLogger("fhirsearchhelper.session")
+
+
+class FHIRSearchSession:
+    """
+    A reusable search session that holds a pooled httpx client and a parsed CapabilityStatement.
+
+    The CapabilityStatement is loaded and validated once when the session is created, and the derived SupportedSearchParams and compiled gap analysis index
+    are reused by every query run through the session. All queries share the session's connection pool, so TLS handshakes are only paid when a new connection is needed. The session can be
+    used as a context manager, or closed with close() (and aclose() if any async queries were run).
+
+    Parameters:
+    - capability_statement_file (str, optional): A file name in the packaged CapabilityStatements folder or a path to a CapabilityStatement file.
+    - capability_statement_url (str, optional): A url to retrieve the CapabilityStatement from. Takes precedence over capability_statement_file.
+    - capability_statement (CapabilityStatement or CompiledCapabilityStatement, optional): An already loaded CapabilityStatement, or one compiled with
+      compiledcapabilitystatement.compile_capability_statement (e.g. from a CapabilityStatementRegistry). Takes precedence over both of the above.
+    - query_headers (dict, optional): Default headers used for every query, such as an Authorization header. Headers passed to a query are merged on top.
+    - client (httpx.Client, optional): An existing client to use instead of creating one. The session does not close clients it did not create.
+    - async_client (httpx.AsyncClient, optional): An existing async client to use for async queries instead of creating one on first use.
+    - max_concurrency (int, optional): The maximum number of reference lookups in flight at once for async queries (default: 10).
+    - reference_batch_size (int, optional): The maximum number of Medication or Encounter reads in each batch Bundle, used only when the CapabilityStatement
+      lists the batch interaction. 0 always reads them one at a time (default: 50).
+    - debug (bool, optional): Set the package logger to DEBUG.
+    """
+
+    def __init__(
+        self,
+        capability_statement_file: str | None = None,
+        capability_statement_url: str | None = None,
+        capability_statement: CapabilityStatement | CompiledCapabilityStatement | None = None,
+        query_headers: dict[str, str] | None = None,
+        client: httpx.Client | None = None,
+        async_client: httpx.AsyncClient | None = None,
+        max_concurrency: int = 10,
+        reference_batch_size: int = 50,
+        debug: bool = False,
+    ) -> None:
+        add_log_handler()
+        if debug:
+            enable_debug_logging()
+
+        self._owns_client: bool = client is None
+        if not client:
+            transport: RateLimitedTransport = create_transport()
+            client = httpx.Client(transport=transport)
+        self.client: httpx.Client = client
+        self._owns_async_client: bool = async_client is None
+        self._async_client: httpx.AsyncClient | None = async_client
+
+        if not capability_statement:
+            with timed("capability_statement"):
+                capability_statement = load_capability_statement(client=self.client, url=capability_statement_url, file_path=capability_statement_file)
+        self.capability_statement: CapabilityStatement | CompiledCapabilityStatement = capability_statement
+        if isinstance(capability_statement, CompiledCapabilityStatement):
+            self.supported_search_params: list[SupportedSearchParams] = get_compiled_supported_search_params(capability_statement)
+            self.search_param_index: SearchParamIndex = get_compiled_search_param_index(capability_statement)
+        else:
+            self.supported_search_params = get_supported_search_params(capability_statement)
+            self.search_param_index = compile_search_param_index(self.supported_search_params)
+
+        self.query_headers: dict[str, str] = query_headers or {}
+        self.max_concurrency: int = max_concurrency
+        batch_supported: bool = capability_statement.batch if isinstance(capability_statement, CompiledCapabilityStatement) else supports_batch(capability_statement)
+        self.reference_batch_size: int = reference_batch_size if batch_supported else 0
+
+    @cached_property
+    def capability_statement_key(self) -> str:
+        """The fingerprint of the session's CapabilityStatement in search output cache keys, computed on first use"""
+
+        return get_capability_statement_key(self.capability_statement)
+
+    @property
+    def async_client(self) -> httpx.AsyncClient:
+        """The session's httpx.AsyncClient, created on first use"""
+
+        if not self._async_client:
+            transport: AsyncRateLimitedTransport = create_async_transport()
+            self._async_client = httpx.AsyncClient(transport=transport)
+        return self._async_client
+
+    def run_fhir_query(
+        self,
+        base_url: str | None = None,
+        query_headers: dict[str, str] | None = None,
+        search_params: QuerySearchParams | None = None,
+        query: str | None = None,
+        follow_next: bool = False,
+        expand_documents: bool = True,
+        raw: bool = False,
+        date_sharding: DateSharding | None = None,
+        sync_store: ReferenceCache | None = None,
+        sync_scope: str | None = None,
+    ) -> Bundle | OperationOutcome | dict | None:
+        """Function to run a FHIR query through the session, see fhirsearchhelper.run_fhir_query"""
+
+        if sync_store is not None:
+            incremental_sync: IncrementalSync = start_incremental_sync(
+                sync_store,
+                base_url=base_url,
+                search_params=search_params,
+                query=query,
+                sync_scope=sync_scope,
+                expand_documents=expand_documents,
+            )
+            sync_output: Bundle | OperationOutcome | dict | None = self.run_fhir_query(
+                base_url=incremental_sync.base_url,
+                query_headers=query_headers,
+                search_params=incremental_sync.search_params,
+                follow_next=True,
+                expand_documents=expand_documents,
+                raw=True,
+                date_sharding=date_sharding,
+            )
+            return load_sync_output(incremental_sync.finish(sync_output), raw=raw, resource_type=incremental_sync.resource_type)  # type: ignore
+
+        output_key: str | None = get_search_output_key(
+            base_url=base_url,
+            search_params=search_params,
+            query=query,
+            query_headers=self.merge_query_headers(query_headers),
+            capability_statement_key=self.capability_statement_key,
+            follow_next=follow_next or bool(date_sharding),
+            expand_documents=expand_documents,
+        )
+        cached_output: Bundle | dict | None = get_cached_search_output(output_key, raw=raw)
+        if cached_output is not None:
+            return cached_output
+
+        pages: Iterator[Bundle | OperationOutcome | dict | None] = self.run_fhir_query_pages(
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=search_params,
+            query=query,
+            follow_next=follow_next,
+            expand_documents=expand_documents,
+            raw=raw,
+            date_sharding=date_sharding,
+        )
+
+        if not follow_next and not date_sharding:
+            try:
+                return cache_search_output(output_key, next(pages))
+            finally:
+                pages.close()  # type: ignore
+
+        return cache_search_output(output_key, merge_bundle_pages(pages))
+
+    def run_fhir_query_pages(
+        self,
+        base_url: str | None = None,
+        query_headers: dict[str, str] | None = None,
+        search_params: QuerySearchParams | None = None,
+        query: str | None = None,
+        follow_next: bool = True,
+        expand_documents: bool = True,
+        raw: bool = False,
+        date_sharding: DateSharding | None = None,
+    ) -> Iterator[Bundle | OperationOutcome | dict | None]:
+        """Function to run a paged FHIR query through the session, see fhirsearchhelper.run_fhir_query_pages"""
+
+        return search_pages(
+            client=self.client,
+            supported_search_params=self.supported_search_params,
+            search_param_index=self.search_param_index,
+            base_url=base_url,
+            query_headers=self.merge_query_headers(query_headers),
+            search_params=search_params,
+            query=query,
+            follow_next=follow_next,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=self.reference_batch_size,
+            date_sharding=date_sharding,
+        )
+
+    async def run_fhir_query_async(
+        self,
+        base_url: str | None = None,
+        query_headers: dict[str, str] | None = None,
+        search_params: QuerySearchParams | None = None,
+        query: str | None = None,
+        follow_next: bool = False,
+        expand_documents: bool = True,
+        raw: bool = False,
+        date_sharding: DateSharding | None = None,
+        sync_store: ReferenceCache | None = None,
+        sync_scope: str | None = None,
+    ) -> Bundle | OperationOutcome | dict | None:
+        """Function to run a FHIR query through the session's httpx.AsyncClient, see fhirsearchhelper.run_fhir_query_async"""
+
+        if sync_store is not None:
+            incremental_sync: IncrementalSync = start_incremental_sync(
+                sync_store,
+                base_url=base_url,
+                search_params=search_params,
+                query=query,
+                sync_scope=sync_scope,
+                expand_documents=expand_documents,
+            )
+            sync_output: Bundle | OperationOutcome | dict | None = await self.run_fhir_query_async(
+                base_url=incremental_sync.base_url,
+                query_headers=query_headers,
+                search_params=incremental_sync.search_params,
+                follow_next=True,
+                expand_documents=expand_documents,
+                raw=True,
+                date_sharding=date_sharding,
+            )
+            return load_sync_output(incremental_sync.finish(sync_output), raw=raw, resource_type=incremental_sync.resource_type)  # type: ignore
+
+        return await self._run_query_async(
+            client=self.async_client,
+            base_url=base_url,
+            query_headers=self.merge_query_headers(query_headers),
+            search_params=search_params,
+            query=query,
+            follow_next=follow_next,
+            expand_documents=expand_documents,
+            raw=raw,
+            date_sharding=date_sharding,
+        )
+
+    async def run_fhir_query_batch_async(
+        self,
+        queries: list[str] | None = None,
+        patient_ids: list[str] | None = None,
+        query_template: str | None = None,
+        patient_param: str = "patient",
+        query_headers: dict[str, str] | None = None,
+        follow_next: bool = False,
+        max_parallel_queries: int = 10,
+        expand_documents: bool = True,
+        raw: bool = False,
+    ) -> AsyncIterator[tuple[str, Bundle | OperationOutcome | dict | None]]:
+        """
+        Run many FHIR queries concurrently, yielding (key, output) tuples as each query completes
+
+        Either pass a list of full query strings, which are also used as the keys, or a list of patient ids with a query_template such as
+        <baseUrl>/Condition?category=encounter-diagnosis, in which case patient_param=<patient id> is added to the template and the patient id is the key.
+
+        At most max_parallel_queries queries run at once. The gap analysis is only run once for each distinct set of search parameters (ignoring the patient),
+        and Medication and Encounter lookups are shared across every query in the batch so each referenced resource is only requested once. Failed lookups are
+        dropped so a later query retries them, and Binary lookups are dropped once the Bundle that requested them is expanded.
+        A query that raises an exception is logged and yields an OperationOutcome instead of stopping the batch.
+        """
+
+        async for result in self._run_batch_async(
+            client=self.async_client,
+            queries=queries,
+            patient_ids=patient_ids,
+            query_template=query_template,
+            patient_param=patient_param,
+            query_headers=query_headers,
+            follow_next=follow_next,
+            max_parallel_queries=max_parallel_queries,
+            expand_documents=expand_documents,
+            raw=raw,
+        ):
+            yield result
+
+    def run_fhir_query_batch(
+        self,
+        queries: list[str] | None = None,
+        patient_ids: list[str] | None = None,
+        query_template: str | None = None,
+        patient_param: str = "patient",
+        query_headers: dict[str, str] | None = None,
+        follow_next: bool = False,
+        max_parallel_queries: int = 10,
+        expand_documents: bool = True,
+        raw: bool = False,
+    ) -> Iterator[tuple[str, Bundle | OperationOutcome | dict | None]]:
+        """
+        Sync version of run_fhir_query_batch_async for callers without an event loop
+
+        The batch runs on a private event loop. Unless an async_client was given to the session, a dedicated httpx.AsyncClient is used for the batch and closed
+        when the generator finishes. Queries only make progress while the generator is being iterated.
+        """
+
+        loop: asyncio.AbstractEventLoop = asyncio.new_event_loop()
+        client: httpx.AsyncClient = self._async_client if self._async_client and not self._owns_async_client else httpx.AsyncClient(transport=create_async_transport())
+        batch: AsyncIterator[tuple[str, Bundle | OperationOutcome | dict | None]] = self._run_batch_async(
+            client=client,
+            queries=queries,
+            patient_ids=patient_ids,
+            query_template=query_template,
+            patient_param=patient_param,
+            query_headers=query_headers,
+            follow_next=follow_next,
+            max_parallel_queries=max_parallel_queries,
+            expand_documents=expand_documents,
+            raw=raw,
+        )
+        try:
+            while True:
+                try:
+                    yield loop.run_until_complete(anext(batch))  # type: ignore
+                except StopAsyncIteration:
+                    break
+        finally:
+            loop.run_until_complete(batch.aclose())  # type: ignore
+            if client is not self._async_client:
+                loop.run_until_complete(client.aclose())
+            loop.close()
+
+    async def _run_batch_async(
+        self,
+        client: httpx.AsyncClient,
+        queries: list[str] | None,
+        patient_ids: list[str] | None,
+        query_template: str | None,
+        patient_param: str,
+        query_headers: dict[str, str] | None,
+        follow_next: bool,
+        max_parallel_queries: int,
+        expand_documents: bool = True,
+        raw: bool = False,
+    ) -> AsyncIterator[tuple[str, Bundle | OperationOutcome | dict | None]]:
+        from fhir.resources.R4B.operationoutcome import OperationOutcome
+
+        if patient_ids is not None:
+            if not query_template:
+                raise ValueError("You must provide a query_template when running a batch of patient ids")
+            if "?" not in query_template:
+                query_template = f"{query_template}?"
+            separator: str = "" if query_template.endswith("?") else "&"
+            keyed_queries: dict[str, str] = {patient_id: f"{query_template}{separator}{patient_param}={patient_id}" for patient_id in patient_ids}
+        elif queries is not None:
+            keyed_queries = {query: query for query in queries}
+        else:
+            raise ValueError("You must provide either a list of queries or a list of patient ids and a query_template")
+
+        merged_query_headers: dict[str, str] = self.merge_query_headers(query_headers)
+        semaphore: asyncio.Semaphore = asyncio.Semaphore(max_parallel_queries)
+        reference_lookups: dict[str, asyncio.Task] = {}
+        gap_outputs: dict[tuple, list[str]] = {}
+
+        async def run_keyed_query(key: str, query: str) -> tuple[str, Bundle | OperationOutcome | dict | None]:
+            async with semaphore:
+                try:
+                    output: Bundle | OperationOutcome | dict | None = await self._run_query_async(
+                        client=client,
+                        query_headers=merged_query_headers,
+                        query=query,
+                        follow_next=follow_next,
+                        gap_output=self._shared_gap_output(query=query, patient_param=patient_param, gap_outputs=gap_outputs),
+                        reference_lookups=reference_lookups,
+                        expand_documents=expand_documents,
+                        raw=raw,
+                    )
+                except Exception as exc:
+                    logger.error(f"Query {query} raised {exc!r}")
+                    output = dump_search_output(
+                        OperationOutcome(**{"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "exception", "diagnostics": f"Query {query} raised {exc!r}"}]}), raw=raw
+                    )
+            return key, output
+
+        tasks: list[asyncio.Task[tuple[str, Bundle | OperationOutcome | dict | None]]] = [asyncio.create_task(run_keyed_query(key, query)) for key, query in keyed_queries.items()]
+        try:
+            for next_completed in asyncio.as_completed(tasks):
+                yield await next_completed
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def _shared_gap_output(self, query: str, patient_param: str, gap_outputs: dict[tuple, list[str]]) -> list[str] | None:
+        """Function to reuse the gap analysis between queries that only differ by patient, returning None to let the search run its own gap analysis"""
+
+        if "?" not in query:
+            return None
+        _, search_params = parse_search_query(query)
+        resource_index: dict[str, SearchParamCondition | None] | None = self.search_param_index.get(search_params.resourceType)
+        if resource_index is None or not search_params.searchParams:
+            return None
+
+        # The patient value only matters if a true-when condition depends on it
+        patient_conditioned: bool = any([condition and condition.field == patient_param for condition in resource_index.values()])
+        shape: tuple = (search_params.resourceType, tuple(sorted((name, value if name != patient_param or patient_conditioned else None) for name, value in search_params.searchParams.items())))
+        if shape not in gap_outputs:
+            gap_outputs[shape] = run_gap_analysis(supported_search_params=self.supported_search_params, query_search_params=search_params, search_param_index=self.search_param_index)
+        return gap_outputs[shape]
+
+    async def _run_query_async(
+        self,
+        client: httpx.AsyncClient,
+        base_url: str | None = None,
+        query_headers: dict[str, str] | None = None,
+        search_params: QuerySearchParams | None = None,
+        query: str | None = None,
+        follow_next: bool = False,
+        gap_output: list[str] | None = None,
+        reference_lookups: dict[str, asyncio.Task] | None = None,
+        expand_documents: bool = True,
+        raw: bool = False,
+        date_sharding: DateSharding | None = None,
+    ) -> Bundle | OperationOutcome | dict | None:
+        output_key: str | None = get_search_output_key(
+            base_url=base_url,
+            search_params=search_params,
+            query=query,
+            query_headers=query_headers,
+            capability_statement_key=self.capability_statement_key,
+            follow_next=follow_next or bool(date_sharding),
+            expand_documents=expand_documents,
+        )
+        cached_output: Bundle | dict | None = get_cached_search_output(output_key, raw=raw)
+        if cached_output is not None:
+            return cached_output
+
+        pages: AsyncIterator[Bundle | OperationOutcome | dict | None] = search_pages_async(
+            client=client,
+            supported_search_params=self.supported_search_params,
+            search_param_index=self.search_param_index,
+            base_url=base_url,
+            query_headers=query_headers,
+            search_params=search_params,
+            query=query,
+            follow_next=follow_next,
+            max_concurrency=self.max_concurrency,
+            gap_output=gap_output,
+            reference_lookups=reference_lookups,
+            expand_documents=expand_documents,
+            raw=raw,
+            reference_batch_size=self.reference_batch_size,
+            date_sharding=date_sharding,
+        )
+
+        if not follow_next and not date_sharding:
+            try:
+                return cache_search_output(output_key, await anext(pages))  # type: ignore
+            finally:
+                await pages.aclose()  # type: ignore
+
+        return cache_search_output(output_key, merge_bundle_pages([page async for page in pages]))
+
+    def merge_query_headers(self, query_headers: dict[str, str] | None) -> dict[str, str]:
+        """Function to layer per-query headers on top of the session's default headers"""
+
+        return {**self.query_headers, **(query_headers or {})}
+
+    def close(self) -> None:
+        """Close the session's sync client if the session created it"""
+
+        if self._owns_client:
+            self.client.close()
+
+    async def aclose(self) -> None:
+        """Close the session's sync and async clients if the session created them"""
+
+        self.close()
+        if self._async_client and self._owns_async_client:
+            await self._async_client.aclose()
+            self._async_client = None
+
+    def __enter__(self) -> "FHIRSearchSession":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    async def __aenter__(self) -> "FHIRSearchSession":
+        return self
+
+    async def __aexit__(self, *args) -> None:
+        await self.aclose()
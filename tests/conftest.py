@@ -0,0 +1,13 @@
+import pytest
+
+from fhirsearchhelper.helpers import conditionhelper, documenthelper, medicationhelper
+
+
+@pytest.fixture(autouse=True)
+def clear_reference_caches():
+    """Reference caches persist between queries, so start every test with empty caches"""
+
+    for cache in [medicationhelper.cached_medication_resources, conditionhelper.cached_encounter_resources, documenthelper.cached_binary_resources]:
+        if cache is not None:
+            cache.clear()
+    yield
@@ -0,0 +1,34 @@
+from benchmarks.importtime import get_deferred_modules_loaded, measure_import
+from benchmarks.mockserver import MockFHIRServer
+from benchmarks.run import BENCHMARK_QUERIES, format_timings, run_benchmarks
+
+
+def test_mock_server_pages_searchsets() -> None:
+    server = MockFHIRServer(count=25, page_size=10)
+    client = server.client()
+
+    last_page: dict = client.get(f"{server.base_url}/Condition?patient=123&page=3").json()
+
+    assert len(last_page["entry"]) == 5
+    assert last_page["total"] == 25
+    assert not [link for link in last_page["link"] if link["relation"] == "next"]
+    assert client.get(f"{server.base_url}/Encounter/enc-1").json()["period"]["start"].startswith("2020-01-02")
+    assert server.requests == {"Condition": 1, "Encounter": 1}
+
+
+def test_run_benchmarks_smallest_size() -> None:
+    timings = run_benchmarks(sizes=[10], resource_types=list(BENCHMARK_QUERIES), repeat=1)
+
+    stages: dict[tuple[str, str], int] = {(timing.resource_type, timing.stage): timing.requests for timing in timings}
+    assert ("Observation", "expand") not in stages
+    assert stages[("MedicationRequest", "expand")] == 1
+    assert stages[("DocumentReference", "end_to_end")] == 12
+    assert all(timing.min_seconds > 0 for timing in timings)
+    assert "end_to_end_async" in format_timings(timings)
+
+
+def test_import_defers_heavy_dependencies() -> None:
+    measurement: dict = measure_import("fhirsearchhelper")
+
+    assert get_deferred_modules_loaded(measurement["modules"]) == []
+    assert measurement["handlers"] == 0
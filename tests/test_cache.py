@@ -0,0 +1,109 @@
+import time
+
+import httpx
+from fhir.resources.R4B.bundle import Bundle
+
+from fhirsearchhelper.helpers import medicationhelper
+from fhirsearchhelper.helpers.cache import LRUCache, SQLiteCache, configure_reference_caches
+from fhirsearchhelper.helpers.medicationhelper import expand_medication_references_in_bundle
+
+
+def test_lru_cache_max_entries() -> None:
+    cache = LRUCache(max_entries=2)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    assert cache.get("a") == {"id": "a"}
+    cache.set("c", {"id": "c"})
+
+    assert cache.get("b") is None
+    assert cache.get("a") == {"id": "a"}
+    assert cache.get("c") == {"id": "c"}
+    assert len(cache) == 2
+    assert (cache.hits, cache.misses) == (3, 1)
+
+
+def test_lru_cache_ttl() -> None:
+    cache = LRUCache(ttl=0.01)
+    cache.set("a", "data")
+    time.sleep(0.02)
+
+    assert cache.get("a") is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_max_bytes() -> None:
+    cache = LRUCache(max_bytes=10)
+    cache.set("a", "12345")
+    cache.set("b", "12345")
+    cache.set("c", "12345")
+    cache.set("too-big", "12345678901")
+
+    assert cache.get("a") is None
+    assert cache.get("b") == "12345"
+    assert cache.get("too-big") is None
+    assert cache.total_bytes == 10
+
+
+def test_sqlite_cache_persists(tmp_path) -> None:
+    db_path = str(tmp_path / "references.db")
+    cache = SQLiteCache(db_path, max_entries=2)
+    cache.set("a", {"id": "a"})
+    cache.set("b", {"id": "b"})
+    cache.get("a")
+    cache.set("c", {"id": "c"})
+    cache.close()
+
+    reopened_cache = SQLiteCache(db_path)
+    assert reopened_cache.get("a") == {"id": "a"}
+    assert reopened_cache.get("b") is None
+    assert len(reopened_cache) == 2
+
+
+def test_cache_membership_is_not_a_read(tmp_path) -> None:
+    for cache in [LRUCache(max_entries=2), SQLiteCache(str(tmp_path / "references.db"), max_entries=2)]:
+        cache.set("a", {"id": "a"})
+        cache.set("b", {"id": "b"})
+        assert "a" in cache and "missing" not in cache
+        cache.set("c", {"id": "c"})
+
+        assert "a" not in cache
+        assert "b" in cache
+        assert (cache.hits, cache.misses) == (0, 0)
+
+
+def test_medication_cache_is_kept_between_expansions() -> None:
+    requested_paths: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_paths.append(request.url.path)
+        return httpx.Response(200, json={"resourceType": "Medication", "id": "med-1", "code": {"coding": [{"code": "1049221"}]}})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    bundle = Bundle.model_validate(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [
+                {
+                    "resource": {
+                        "resourceType": "MedicationRequest",
+                        "status": "active",
+                        "intent": "order",
+                        "subject": {"reference": "Patient/1"},
+                        "medicationReference": {"reference": "Medication/med-1"},
+                    }
+                }
+            ],
+        }
+    )
+
+    original_cache = medicationhelper.cached_medication_resources
+    configure_reference_caches(medication=LRUCache(max_entries=10))
+    try:
+        for _ in range(3):
+            output = expand_medication_references_in_bundle(client=client, input_bundle=bundle, base_url="https://fhir.example.org/R4")
+            assert output.entry[0].resource.medicationCodeableConcept.coding[0].code == "1049221"  # type: ignore
+    finally:
+        configure_reference_caches(medication=original_cache)
+
+    assert requested_paths == ["/R4/Medication/med-1"]
@@ -2,7 +2,7 @@ import httpx
 import pytest
 from fhir.resources.R4B.capabilitystatement import CapabilityStatement
 
-from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement, load_search_capabilities, supports_search_include
 from fhirsearchhelper.models.models import SupportedSearchParams
 
 transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
@@ -44,3 +44,19 @@ def test_get_supported_search_params_capstate() -> None:
     assert isinstance(ssps, list)
     assert all([isinstance(sps, SupportedSearchParams) for sps in ssps])
     assert all([resource.type in [sps.resourceType for sps in ssps] for resource in cs.rest[0].resource if "searchParam" in resource.dict(exclude_none=True)])  # type: ignore
+
+
+def test_supports_search_include() -> None:
+    cs: CapabilityStatement = load_capability_statement(client=client, file_path="epic_r4_metadata_edited.json")
+    supported_search_params: list[SupportedSearchParams] = get_supported_search_params(cs)
+
+    assert supports_search_include(supported_search_params, "MedicationRequest", "MedicationRequest:medication")
+    assert not supports_search_include(supported_search_params, "SupplyDelivery", "SupplyDelivery:patient")
+
+
+def test_load_search_capabilities_file_path_cached() -> None:
+    supported_search_params, search_param_index, _ = load_search_capabilities(client=client, file_path="epic_r4_metadata_edited.json")
+
+    assert "Condition" in search_param_index
+    assert load_search_capabilities(client=client, file_path="epic_r4_metadata_edited.json")[1] is search_param_index
+    assert load_search_capabilities(client=client, file_path="epic_r4_metadata_edited.json")[0] is supported_search_params
@@ -0,0 +1,73 @@
+import subprocess
+import sys
+from pathlib import Path
+
+from benchmarks.mockserver import FIRST_RXNORM_CODE, RXNORM_SYSTEM, MockFHIRServer
+from fhirsearchhelper.helpers import compiledcapabilitystatement
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement_file
+from fhirsearchhelper.helpers.compiledcapabilitystatement import (
+    CapabilityStatementRegistry,
+    compile_capability_statement,
+    configure_capability_statement_registry,
+    get_compiled_search_param_index,
+    get_compiled_supported_search_params,
+    load_compiled_capability_statement,
+)
+from fhirsearchhelper.helpers.gapanalysis import compile_search_param_index, run_gap_analysis
+from fhirsearchhelper.main import get_pretty_supported_search_params, run_fhir_query
+from fhirsearchhelper.models.models import QuerySearchParams
+from fhirsearchhelper.session import FHIRSearchSession
+
+
+def test_compiled_capability_statement_round_trip(tmp_path: Path) -> None:
+    cs = load_capability_statement_file("epic_r4_metadata_edited.json")
+    artifact_path: Path = tmp_path / "epic.json"
+
+    compiledcapabilitystatement.main(["--file", "epic_r4_metadata_edited.json", "--output", str(artifact_path)])
+    loaded_cs = load_compiled_capability_statement(artifact_path)
+
+    assert loaded_cs == compile_capability_statement(cs, source="epic_r4_metadata_edited.json")
+    assert get_compiled_search_param_index(loaded_cs) == compile_search_param_index(get_supported_search_params(cs))
+    assert get_pretty_supported_search_params(get_compiled_supported_search_params(loaded_cs)) == get_pretty_supported_search_params(get_supported_search_params(cs))
+    query_search_params = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "category": "problem-list-item", "code": "1234"})
+    assert run_gap_analysis([], query_search_params, search_param_index=get_compiled_search_param_index(loaded_cs)) == ["code"]
+
+
+def test_compile_capability_statement_script_exits_cleanly(tmp_path: Path) -> None:
+    artifact_path: Path = tmp_path / "epic.json"
+    # What the console script generated for the entry point runs
+    script: str = "import sys; from fhirsearchhelper.helpers.compiledcapabilitystatement import main; sys.exit(main())"
+
+    result = subprocess.run([sys.executable, "-c", script, "--file", "epic_r4_metadata_edited.json", "--output", str(artifact_path)], capture_output=True, text=True)
+
+    assert result.returncode == 0, result.stderr
+    assert artifact_path.exists()
+
+
+def test_registry_loads_artifacts_lazily_once(tmp_path: Path) -> None:
+    artifact_path: Path = tmp_path / "epic.json"
+    compiledcapabilitystatement.main(["--file", "epic_r4_metadata_edited.json", "--output", str(artifact_path)])
+    registry = CapabilityStatementRegistry({"https://fhir.test/R4/": artifact_path})
+
+    assert "https://fhir.test/R4" in registry and not registry.loaded
+    assert registry.get("https://fhir.test/R4") is registry.get("https://fhir.test/R4/")
+    assert registry.get("https://other.test/R4") is None
+
+
+def test_run_fhir_query_uses_registered_capability_statement() -> None:
+    server = MockFHIRServer(count=10, page_size=10)
+    compiled_cs = compile_capability_statement(load_capability_statement_file("epic_r4_metadata_edited.json"))
+    configure_capability_statement_registry(artifacts={server.base_url: compiled_cs})
+    try:
+        output = run_fhir_query(
+            query=f"{server.base_url}/MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}", client=server.client(), query_headers={"Authorization": "Bearer test"}
+        )
+    finally:
+        configure_capability_statement_registry(CapabilityStatementRegistry())
+
+    assert output is not None and len(output.entry) == 10
+    assert "metadata" not in server.requests
+
+    with FHIRSearchSession(capability_statement=compiled_cs, client=server.client(), query_headers={"Authorization": "Bearer test"}) as session:
+        assert session.run_fhir_query(query=f"{server.base_url}/MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}") is not None
+    assert "metadata" not in server.requests
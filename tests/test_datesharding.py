@@ -0,0 +1,107 @@
+import asyncio
+from datetime import date
+
+import httpx
+
+from benchmarks.mockserver import MockFHIRServer
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement
+from fhirsearchhelper.helpers.datesharding import MISSING_DATE_WINDOW, DateSharding, DateWindowPlanner, add_date_window, can_shard_by_date, remove_seen_entries
+from fhirsearchhelper.main import run_fhir_query, run_fhir_query_async
+from fhirsearchhelper.models.models import QuerySearchParams
+
+
+def test_date_window_planner_resizes_windows() -> None:
+    planner = DateWindowPlanner(DateSharding(start="2020-01-01", end="2020-03-01", initial_window_days=10, target_window_size=100))
+
+    assert planner.next_window() == (None, date(2020, 1, 1))
+    first_window = planner.next_window()
+    assert first_window == (date(2020, 1, 1), date(2020, 1, 11))
+    planner.record(first_window, 500)
+    assert planner.next_window() == (date(2020, 1, 11), date(2020, 1, 13))
+    planner.record((date(2020, 1, 11), date(2020, 1, 13)), 0)
+    assert planner.window_days == 2
+    while (window := planner.next_window()) and window[1] is not None:
+        assert window[1] <= date(2020, 3, 1)
+    assert window == (date(2020, 3, 1), None)
+    assert planner.next_window() is None
+
+    planner = DateWindowPlanner(DateSharding(start="2020-01-01", end="2020-01-02", missing_modifier=True))
+    assert [planner.next_window() for _ in range(4)] == [(None, date(2020, 1, 1)), (date(2020, 1, 1), date(2020, 1, 2)), (date(2020, 1, 2), None), MISSING_DATE_WINDOW]
+    assert planner.next_window() is None
+
+
+def test_add_date_window_and_can_shard_by_date() -> None:
+    assert add_date_window("https://fhir.test/R4/Observation?patient=123", (date(2020, 1, 1), date(2021, 1, 1))) == ("https://fhir.test/R4/Observation?patient=123&date=ge2020-01-01&date=lt2021-01-01")
+    assert add_date_window("https://fhir.test/R4/Observation?patient=123", (None, date(2020, 1, 1))) == "https://fhir.test/R4/Observation?patient=123&date=lt2020-01-01"
+    assert add_date_window("https://fhir.test/R4/Observation?patient=123", MISSING_DATE_WINDOW) == "https://fhir.test/R4/Observation?patient=123&date:missing=true"
+
+    supported_search_params = get_supported_search_params(load_capability_statement(client=httpx.Client(), file_path="epic_r4_metadata_edited.json"))
+    date_sharding = DateSharding(start="2020-01-01", missing_modifier=True)
+    observation_params = QuerySearchParams(resourceType="Observation", searchParams={"patient": "123", "category": "laboratory"})
+    assert can_shard_by_date(date_sharding, supported_search_params, observation_params)
+    assert not can_shard_by_date(DateSharding(start="2020-01-01"), supported_search_params, observation_params)
+    assert not can_shard_by_date(date_sharding, supported_search_params, QuerySearchParams(resourceType="Observation", searchParams={"patient": "123", "date": "ge2020-01-01"}))
+    assert not can_shard_by_date(date_sharding, supported_search_params, QuerySearchParams(resourceType="Condition", searchParams={"patient": "123"}))
+
+
+def test_run_fhir_query_with_date_sharding() -> None:
+    server = MockFHIRServer(count=200, page_size=10)
+    date_sharding = DateSharding(start="2020-01-02", end="2020-01-10", concurrency=3, initial_window_days=2, target_window_size=24, missing_modifier=True)
+    query: str = f"{server.base_url}/Observation?patient=123&category=laboratory"
+
+    output = run_fhir_query(query=query, client=server.client(), query_headers={"Authorization": "Bearer test"}, capability_statement_url=f"{server.base_url}/metadata", date_sharding=date_sharding)
+    raw_output = asyncio.run(
+        run_fhir_query_async(
+            query=query, client=server.async_client(), query_headers={"Authorization": "Bearer test"}, capability_statement_url=f"{server.base_url}/metadata", date_sharding=date_sharding, raw=True
+        )
+    )
+
+    assert output is not None and output.total == 200
+    assert sorted(entry.resource.id for entry in output.entry) == sorted(f"obs-{index}" for index in range(200))
+    assert isinstance(raw_output, dict) and sorted(entry["resource"]["id"] for entry in raw_output["entry"]) == sorted(f"obs-{index}" for index in range(200))
+    # 200 resources on pages of 10 need at least 20 pages, which the windows add to
+    assert server.requests["Observation"] > 40
+
+
+def test_date_sharding_keeps_undated_resources() -> None:
+    observations: list[dict] = [
+        {"resourceType": "Observation", "id": f"obs-{index}", "status": "final", "code": {"text": "Test"}, **({"effectiveDateTime": effective} if effective else {})}
+        for index, effective in enumerate(["2019-06-01", "2020-02-01", None, "2021-06-01", None])
+    ]
+    requested_urls: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        matched: list[dict] = observations
+        if request.url.params.get("date:missing") == "true":
+            matched = [observation for observation in matched if "effectiveDateTime" not in observation]
+        for date_param in request.url.params.get_list("date"):
+            prefix, value = date_param[:2], date_param[2:]
+            matched = [observation for observation in matched if "effectiveDateTime" in observation and (observation["effectiveDateTime"] >= value) == (prefix == "ge")]
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "total": len(matched), "entry": [{"resource": observation} for observation in matched]})
+
+    output = run_fhir_query(
+        query="https://fhir.test/R4/Observation?patient=123&category=laboratory",
+        client=httpx.Client(transport=httpx.MockTransport(handler)),
+        query_headers={"Authorization": "Bearer test"},
+        capability_statement_file="epic_r4_metadata_edited.json",
+        date_sharding=DateSharding(start="2020-01-01", end="2021-01-01", missing_modifier=True),
+        raw=True,
+    )
+
+    assert any(url.endswith("&date:missing=true") for url in requested_urls)
+    assert isinstance(output, dict) and output["total"] == 5
+    assert sorted(entry["resource"]["id"] for entry in output["entry"]) == [f"obs-{index}" for index in range(5)]
+
+
+def test_remove_seen_entries_sets_total() -> None:
+    page: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": 2,
+        "entry": [{"resource": {"resourceType": "Observation", "id": "obs-1"}}, {"resource": {"resourceType": "Observation", "id": "obs-2"}}],
+    }
+
+    deduplicated_page = remove_seen_entries(page, {"Observation/obs-1"})
+
+    assert deduplicated_page["total"] == 1 and len(deduplicated_page["entry"]) == 1  # type: ignore
@@ -1,9 +1,25 @@
+import asyncio
+import base64
 import json
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
 import httpx
+import pytest
 from fhir.resources.R4B.bundle import Bundle
 
-from fhirsearchhelper.helpers.documenthelper import expand_document_references_in_bundle
+from fhirsearchhelper.helpers import documenthelper
+from fhirsearchhelper.helpers.binaryspill import extract_json_binary_data, open_spilled_attachment, remove_spilled_attachment
+from fhirsearchhelper.helpers.cache import LRUCache, configure_reference_caches
+from fhirsearchhelper.helpers.documenthelper import (
+    configure_binary_spill,
+    configure_html_conversion,
+    convert_html_contents_async,
+    expand_document_references_in_bundle,
+    get_binary_handles,
+    html_to_base64_text,
+    iter_expanded_document_references,
+)
 
 transport: httpx.HTTPTransport = httpx.HTTPTransport(retries=5)
 client: httpx.Client = httpx.Client(transport=transport)
@@ -18,3 +34,183 @@ def test_expand_document_references_no_binary() -> None:
 
     assert isinstance(output, Bundle)
     assert output.model_dump(exclude_none=True) == dc_bundle.model_dump(exclude_none=True)
+
+
+def document_reference_bundle(count: int) -> Bundle:
+    entries: list[dict] = [
+        {
+            "resource": {
+                "resourceType": "DocumentReference",
+                "id": f"doc-{i}",
+                "status": "current",
+                "content": [{"attachment": {"contentType": "text/html", "url": f"Binary/note-{i}"}}],
+            }
+        }
+        for i in range(count)
+    ]
+    return Bundle.model_validate({"resourceType": "Bundle", "type": "searchset", "entry": entries})
+
+
+def binary_client() -> httpx.Client:
+    def handler(request: httpx.Request) -> httpx.Response:
+        note_id: str = request.url.path.rsplit("/", 1)[1]
+        html: str = f"<html><body><h1>{note_id}</h1><p>{'Patient is <b>stable</b>. ' * 50}</p></body></html>"
+        return httpx.Response(200, json={"resourceType": "Binary", "contentType": "text/html", "data": base64.b64encode(html.encode("utf-8")).decode("utf-8")})
+
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+
+def test_expand_document_references_process_pool_conversion() -> None:
+    inline_output: Bundle = expand_document_references_in_bundle(client=binary_client(), input_bundle=document_reference_bundle(4), base_url="https://example.org/fhir")
+
+    with ProcessPoolExecutor(max_workers=2) as executor:
+        configure_html_conversion(executor=executor, offload_threshold=0)
+        try:
+            offloaded_output: Bundle = expand_document_references_in_bundle(client=binary_client(), input_bundle=document_reference_bundle(4), base_url="https://example.org/fhir")
+        finally:
+            configure_html_conversion(executor=None)
+
+    def plain_texts(bundle: Bundle) -> dict[str, str]:
+        return {entry.resource.id: base64.b64decode(entry.resource.content[0].attachment.data).decode("utf-8") for entry in bundle.entry}
+
+    assert plain_texts(offloaded_output) == plain_texts(inline_output)
+    assert all(entry.resource.content[0].attachment.contentType == "text/plain" for entry in offloaded_output.entry)
+
+
+def test_iter_expanded_document_references_streams_lazily() -> None:
+    requested_urls: list[str] = []
+    client: httpx.Client = binary_client()
+    client.event_hooks["request"] = [lambda request: requested_urls.append(str(request.url))]
+
+    documents = iter_expanded_document_references(client=client, input_bundle=document_reference_bundle(6), base_url="https://example.org/fhir", prefetch=2)
+    first_document = next(documents)
+    documents.close()
+
+    assert first_document.resource.id == "doc-0"
+    assert first_document.resource.content[0].attachment.contentType == "text/plain"
+    assert len(requested_urls) <= 3
+
+    all_documents = list(iter_expanded_document_references(client=client, input_bundle=document_reference_bundle(6), base_url="https://example.org/fhir", prefetch=2))
+    assert [entry.resource.id for entry in all_documents] == [f"doc-{i}" for i in range(6)]
+
+
+def test_binary_handles_retrieve_on_access() -> None:
+    requested_urls: list[str] = []
+    client: httpx.Client = binary_client()
+    client.event_hooks["request"] = [lambda request: requested_urls.append(str(request.url))]
+    document_reference = document_reference_bundle(1).entry[0].resource
+
+    handles = get_binary_handles(client=client, document_reference=document_reference, base_url="https://example.org/fhir")
+
+    assert [handle.url for handle in handles] == ["https://example.org/fhir/Binary/note-0"]
+    assert requested_urls == []
+    configure_reference_caches(binary=LRUCache(max_bytes=1024 * 1024))
+    try:
+        assert base64.b64decode(handles[0].get_data()).decode("utf-8").startswith("<html><body><h1>note-0</h1>")
+        assert handles[0].get_plain_text_data() == html_to_base64_text(handles[0].get_data())
+    finally:
+        documenthelper.cached_binary_resources = None
+    assert requested_urls == ["https://example.org/fhir/Binary/note-0"]
+
+
+def test_expand_document_references_spills_large_binaries(tmp_path) -> None:
+    configure_reference_caches(binary=LRUCache(max_bytes=1024 * 1024))
+    configure_binary_spill(spill_dir=str(tmp_path), threshold=256)
+    try:
+        output: Bundle = expand_document_references_in_bundle(client=binary_client(), input_bundle=document_reference_bundle(3), base_url="https://example.org/spill")
+        assert len(documenthelper.cached_binary_resources) == 0  # type: ignore
+    finally:
+        configure_binary_spill(spill_dir=None)
+        documenthelper.cached_binary_resources = None
+
+    in_memory_output: Bundle = expand_document_references_in_bundle(client=binary_client(), input_bundle=document_reference_bundle(3), base_url="https://example.org/spill")
+
+    assert output.entry and len(output.entry) == 3
+    for entry, in_memory_entry in zip(output.entry, in_memory_output.entry):
+        html_attachment = next(content.attachment for content in entry.resource.content if content.attachment.contentType == "text/html")
+        in_memory_attachment = next(content.attachment for content in in_memory_entry.resource.content if content.attachment.contentType == "text/html")
+        assert html_attachment.data is None
+        assert html_attachment.url == entry.resource.id.replace("doc-", "Binary/note-")
+        with open_spilled_attachment(html_attachment) as spilled_content:
+            assert base64.b64decode(spilled_content[:]) == in_memory_attachment.data
+            assert html_attachment.size == len(base64.b64decode(spilled_content[:]))
+        assert entry.resource.content[0].attachment.contentType == "text/plain"
+        assert entry.resource.content[0].attachment.data == in_memory_entry.resource.content[0].attachment.data
+        remove_spilled_attachment(html_attachment)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_extract_json_binary_data_only_matches_the_top_level_data(tmp_path) -> None:
+    content: bytes = b"<p>spilled</p>" * 10
+    binary: dict = {
+        "resourceType": "Binary",
+        "id": "data",
+        "meta": {"extension": [{"url": "https://example.org/data", "valueString": 'a "data": "bm90IGl0"'}], "data": "bm90IGl0"},
+        "contentType": "text/html",
+        "data": base64.b64encode(content).decode(),
+    }
+    (tmp_path / "binary.json").write_text(json.dumps(binary))
+
+    content_size: int = extract_json_binary_data(str(tmp_path / "binary.json"), str(tmp_path / "binary.bin"))
+
+    assert base64.b64decode((tmp_path / "binary.bin").read_bytes()) == content
+    assert content_size == len(content)
+
+    (tmp_path / "invalid.json").write_text(json.dumps({"resourceType": "Binary", "data": "not base64!"}))
+    with pytest.raises(ValueError):
+        extract_json_binary_data(str(tmp_path / "invalid.json"), str(tmp_path / "invalid.bin"))
+
+
+def test_binary_cache_is_opt_in() -> None:
+    requested_urls: list[str] = []
+    client: httpx.Client = binary_client()
+    client.event_hooks["request"] = [lambda request: requested_urls.append(str(request.url))]
+
+    for _ in range(2):
+        expand_document_references_in_bundle(client=client, input_bundle=document_reference_bundle(1), base_url="https://example.org/fhir")
+    assert len(requested_urls) == 2
+
+    configure_reference_caches(binary=LRUCache(max_bytes=1024 * 1024))
+    try:
+        for _ in range(2):
+            expand_document_references_in_bundle(client=client, input_bundle=document_reference_bundle(1), base_url="https://example.org/fhir")
+    finally:
+        documenthelper.cached_binary_resources = None
+    assert len(requested_urls) == 3
+
+
+def test_reused_html_converter_matches_a_new_one() -> None:
+    import html2text
+
+    documents: list[str] = [
+        "<table><tr><td>a</td><td>b</td></tr></table><ul><li>item <a href='https://example.org'>link</a></li>",
+        "<pre>unclosed <b>bold",
+        "<h1>Note</h1><p>Patient is <i>stable</i>.</p>",
+    ] * 2
+
+    def convert_with_new_converter(html_blurb: str) -> str:
+        text_maker = html2text.HTML2Text()
+        text_maker.ignore_images = True
+        return base64.b64encode(text_maker.handle(html_blurb).encode("utf-8")).decode("utf-8")
+
+    assert [html_to_base64_text(document) for document in documents] == [convert_with_new_converter(document) for document in documents]
+
+
+def test_convert_html_contents_async_runs_off_the_event_loop(monkeypatch) -> None:
+    conversion_threads: list[int] = []
+
+    def record_thread(html_blurb: str) -> str:
+        conversion_threads.append(threading.get_ident())
+        return html_to_base64_text(html_blurb)
+
+    monkeypatch.setattr(documenthelper, "html_to_base64_text", record_thread)
+    resource: dict = {"resourceType": "DocumentReference", "content": [{"attachment": {"contentType": "text/html", "data": "<p>note</p>"}}]}
+
+    async def run() -> int:
+        await convert_html_contents_async(resource)
+        return threading.get_ident()
+
+    loop_thread: int = asyncio.run(run())
+
+    assert conversion_threads and loop_thread not in conversion_threads
+    assert resource["content"][0]["attachment"]["contentType"] == "text/plain"
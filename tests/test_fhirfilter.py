@@ -2,7 +2,7 @@ import json
 
 from fhir.resources.R4B.bundle import Bundle
 
-from fhirsearchhelper.helpers.fhirfilter import filter_bundle
+from fhirsearchhelper.helpers.fhirfilter import TokenSet, compile_fhirpath_filter, filter_bundle, filter_bundle_json, filter_bundle_new
 from fhirsearchhelper.models.models import QuerySearchParams
 
 
@@ -32,6 +32,176 @@ def test_filter_bundle_new() -> None:
 
     if filtered_bundle.entry:
         for entry in filtered_bundle.entry:
-            assert "eZ5-7rYdWqgv3jSgIvx.SPw3" == entry["resource"]["subject"]["reference"].split("/")[1]
-            assert "encounter-diagnosis" in [cat["coding"][0]["code"] for cat in entry["resource"]["category"]]
-            assert any(["http://snomed.info/sct|110483000".split("|")[1] == coding["code"] for coding in entry["resource"]["code"]["coding"]])
+            assert "eZ5-7rYdWqgv3jSgIvx.SPw3" == entry.resource.subject.reference.split("/")[1]
+            assert "encounter-diagnosis" in [cat.coding[0].code for cat in entry.resource.category]
+            assert any(["http://snomed.info/sct|110483000".split("|")[1] == coding.code for coding in entry.resource.code.coding])
+
+
+def condition_entry(condition_id: str, code: str, clinical_status: str = "active") -> dict:
+    return {
+        "resource": {
+            "resourceType": "Condition",
+            "id": condition_id,
+            "subject": {"reference": "Patient/1"},
+            "clinicalStatus": {"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-clinical", "code": clinical_status}]},
+            "code": {"coding": [{"system": "http://snomed.info/sct", "code": code}]},
+        }
+    }
+
+
+def test_filter_bundle_json() -> None:
+    operation_outcome_entry: dict = {"resource": {"resourceType": "OperationOutcome", "issue": [{"severity": "warning", "code": "informational"}]}}
+    bundle_json: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": 3,
+        "entry": [condition_entry("1", "110483000"), condition_entry("2", "44054006"), operation_outcome_entry],
+    }
+    search_params: QuerySearchParams = QuerySearchParams(resourceType="Condition", searchParams={"patient": "1", "code": "http://snomed.info/sct%7C110483000"})
+
+    filtered_bundle_json: dict = filter_bundle_json(bundle_json=bundle_json, search_params=search_params, gap_analysis_output=["code"])
+
+    assert [entry["resource"]["id"] for entry in filtered_bundle_json["entry"] if entry["resource"]["resourceType"] == "Condition"] == ["1"]
+    # Other resource types are left for validation to handle
+    assert operation_outcome_entry in filtered_bundle_json["entry"]
+    assert filtered_bundle_json["total"] == 1
+    # The input Bundle is not modified
+    assert len(bundle_json["entry"]) == 3 and bundle_json["total"] == 3
+
+
+def test_filter_bundle_clinical_status_and_system_free_code() -> None:
+    input_bundle: Bundle = Bundle.model_validate(
+        {"resourceType": "Bundle", "type": "searchset", "entry": [condition_entry("1", "110483000"), condition_entry("2", "110483000", "resolved"), condition_entry("3", "44054006")]}
+    )
+
+    status_bundle: Bundle = filter_bundle(input_bundle, QuerySearchParams(resourceType="Condition", searchParams={"clinical-status": "active,recurrence"}), ["clinical-status"])
+    code_bundle: Bundle = filter_bundle(input_bundle, QuerySearchParams(resourceType="Condition", searchParams={"code": "110483000"}), ["code"])
+
+    assert [entry.resource.id for entry in status_bundle.entry] == ["1", "3"]
+    assert [entry.resource.id for entry in code_bundle.entry] == ["1", "2"]
+    assert code_bundle.total == 2
+
+
+def test_filter_bundle_medication_request_moves_matching_coding_first() -> None:
+    input_bundle: Bundle = Bundle.model_validate(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [
+                {
+                    "resource": {
+                        "resourceType": "MedicationRequest",
+                        "id": "1",
+                        "status": "active",
+                        "intent": "order",
+                        "subject": {"reference": "Patient/1"},
+                        "medicationCodeableConcept": {
+                            "coding": [{"system": "urn:oid:2.16.840.1.113883.6.253", "code": "123"}, {"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": "1191"}]
+                        },
+                    }
+                }
+            ],
+        }
+    )
+    search_params: QuerySearchParams = QuerySearchParams(resourceType="MedicationRequest", searchParams={"code": "http://www.nlm.nih.gov/research/umls/rxnorm|1191"})
+
+    filtered_bundle: Bundle = filter_bundle(input_bundle, search_params, ["code"])
+
+    assert filtered_bundle.entry[0].resource.medicationCodeableConcept.coding[0].code == "1191"
+    # The input Bundle is not modified
+    assert input_bundle.entry[0].resource.medicationCodeableConcept.coding[0].code == "123"
+
+
+def observation_entry(observation_id: str, effective: str, value: float) -> dict:
+    return {
+        "resource": {
+            "resourceType": "Observation",
+            "id": observation_id,
+            "status": "final",
+            "code": {"coding": [{"system": "http://loinc.org", "code": "789-8"}]},
+            "subject": {"reference": "Patient/123"},
+            "effectiveDateTime": effective,
+            "valueQuantity": {"value": value, "unit": "mg", "system": "http://unitsofmeasure.org", "code": "mg"},
+        }
+    }
+
+
+def test_filter_bundle_new_fhirpath_semantics() -> None:
+    input_bundle: Bundle = Bundle.model_validate(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [observation_entry("1", "2021-03-04T10:00:00Z", 5.4), observation_entry("2", "2020-12-31", 7.0), observation_entry("3", "2021-06", 4.0)],
+        }
+    )
+
+    def filtered_ids(search_param: str, value: str) -> list[str]:
+        search_params: QuerySearchParams = QuerySearchParams(resourceType="Observation", searchParams={search_param: value})
+        return [entry.resource.id for entry in filter_bundle_new(input_bundle, search_params, [search_param]).entry]
+
+    assert filtered_ids("date", "ge2021-01-01") == ["1", "3"]
+    assert filtered_ids("date", "2021-03") == ["1"]
+    assert filtered_ids("date", "lt2021") == ["2"]
+    assert filtered_ids("value-quantity", "gt5|http://unitsofmeasure.org|mg") == ["1", "2"]
+    assert filtered_ids("value-quantity", "5.4") == ["1"]
+    assert filtered_ids("code", "http://loinc.org%7C789-8") == ["1", "2", "3"]
+    assert filtered_ids("code:not", "789-8") == []
+    assert filtered_ids("patient", "123") == ["1", "2", "3"]
+    assert filtered_ids("subject", "Group/123") == []
+
+
+def test_fhirpath_string_token_and_reference_semantics() -> None:
+    patient: dict = {
+        "resourceType": "Patient",
+        "id": "1",
+        "name": [{"family": "Muñoz", "given": ["José"]}],
+        "gender": "male",
+        "identifier": [{"system": "urn:mrn", "value": "42"}],
+        "generalPractitioner": [{"reference": "Practitioner/9"}],
+    }
+
+    assert compile_fhirpath_filter("Patient", "name", "munoz")(patient)
+    assert compile_fhirpath_filter("Patient", "name:contains", "OS")(patient)
+    assert not compile_fhirpath_filter("Patient", "name:exact", "munoz")(patient)
+    assert compile_fhirpath_filter("Patient", "gender", "female,male")(patient)
+    assert compile_fhirpath_filter("Patient", "identifier", "urn:mrn|42")(patient)
+    assert not compile_fhirpath_filter("Patient", "identifier", "|42")(patient)
+    assert compile_fhirpath_filter("Patient", "general-practitioner", "Practitioner/9")(patient)
+    assert compile_fhirpath_filter("Patient", "unknown-param", "x") is None
+
+
+def test_fhirpath_tokens_match_exactly() -> None:
+    condition: dict = {"resourceType": "Condition", "id": "1", "verificationStatus": {"coding": [{"code": "entered-in-error"}]}, "code": {"coding": [{"code": "44054006"}]}}
+    observation: dict = {"resourceType": "Observation", "id": "1", "status": "final", "valueString": "Final result"}
+
+    assert not compile_fhirpath_filter("Condition", "verification-status", "entered")(condition)
+    assert compile_fhirpath_filter("Condition", "verification-status", "entered-in-error")(condition)
+    assert compile_fhirpath_filter("Observation", "status", "final")(observation)
+    assert not compile_fhirpath_filter("Observation", "status", "FINAL")(observation)
+    assert not compile_fhirpath_filter("Observation", "status", "fin")(observation)
+    assert compile_fhirpath_filter("Observation", "value-string", "FINAL")(observation)
+    assert TokenSet("|44054006").matches({"code": "44054006"})
+    assert not TokenSet("|44054006").matches({"system": "http://snomed.info/sct", "code": "44054006"})
+    assert TokenSet("44054006").matches({"system": "http://snomed.info/sct", "code": "44054006"})
+
+
+def test_filter_bundle_ands_parameters_and_ors_values_without_duplicates() -> None:
+    condition_with_two_codes: dict = condition_entry("3", "110483000")
+    condition_with_two_codes["resource"]["code"]["coding"].append({"system": "http://snomed.info/sct", "code": "44054006"})
+    input_bundle: Bundle = Bundle.model_validate(
+        {
+            "resourceType": "Bundle",
+            "type": "searchset",
+            "entry": [condition_entry("1", "110483000"), condition_entry("2", "44054006", "resolved"), condition_with_two_codes, condition_entry("4", "38341003")],
+        }
+    )
+    search_params: QuerySearchParams = QuerySearchParams(
+        resourceType="Condition", searchParams={"code": "http://snomed.info/sct|110483000,http://snomed.info/sct%7C44054006", "clinical-status": "active"}
+    )
+
+    code_bundle: Bundle = filter_bundle(input_bundle, search_params, ["code"])
+    code_and_status_bundle: Bundle = filter_bundle(input_bundle, search_params, ["code", "clinical-status"])
+
+    assert [entry.resource.id for entry in code_bundle.entry] == ["1", "2", "3"]
+    assert [entry.resource.id for entry in code_and_status_bundle.entry] == ["1", "3"]
+    assert code_and_status_bundle.total == 2
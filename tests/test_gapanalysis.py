@@ -0,0 +1,35 @@
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement_file
+from fhirsearchhelper.helpers.gapanalysis import compile_search_param_index, run_gap_analysis
+from fhirsearchhelper.models.models import QuerySearchParams, SearchParamIndex, SupportedSearchParams
+
+supported_search_params: list[SupportedSearchParams] = get_supported_search_params(load_capability_statement_file("epic_r4_metadata_edited.json"))
+search_param_index: SearchParamIndex = compile_search_param_index(supported_search_params)
+
+
+def test_compile_search_param_index() -> None:
+    assert search_param_index["Condition"]["patient"] is None
+    assert search_param_index["Condition"]["code"].operator == "=="  # type: ignore
+    assert search_param_index["Condition"]["code"].values == frozenset(["infection"])  # type: ignore
+    assert "encounter-diagnosis" in search_param_index["Condition"]["category"].values  # type: ignore
+
+
+def test_run_gap_analysis_equals_condition() -> None:
+    unsupported_code = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "category": "encounter-diagnosis", "code": "http://snomed.info/sct|110483000"})
+    supported_code = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "category": "infection", "code": "http://snomed.info/sct|110483000"})
+
+    assert run_gap_analysis(supported_search_params, unsupported_code, search_param_index) == ["code"]
+    assert run_gap_analysis(supported_search_params, supported_code, search_param_index) == []
+
+
+def test_run_gap_analysis_in_condition() -> None:
+    multiple_supported = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "clinical-status": "active,resolved"})
+    one_unsupported = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "clinical-status": "active,remission"})
+
+    assert run_gap_analysis(supported_search_params, multiple_supported, search_param_index) == []
+    assert run_gap_analysis(supported_search_params, one_unsupported, search_param_index) == ["clinical-status"]
+
+
+def test_run_gap_analysis_without_index() -> None:
+    query_search_params = QuerySearchParams(resourceType="Observation", searchParams={"patient": "123", "category": "laboratory", "value-quantity": "gt5"})
+
+    assert run_gap_analysis(supported_search_params, query_search_params) == run_gap_analysis(supported_search_params, query_search_params, search_param_index) == ["value-quantity"]
@@ -0,0 +1,127 @@
+import asyncio
+import copy
+import json
+from datetime import datetime, timezone
+from pathlib import Path
+
+import httpx
+
+from fhirsearchhelper.helpers.cache import LRUCache
+from fhirsearchhelper.helpers.metrics import MetricsRecorder, add_metrics_hook, remove_metrics_hook
+from fhirsearchhelper.main import run_fhir_query, run_fhir_query_async
+
+BASE_URL = "https://fhir.example.org/R4"
+QUERY = f"{BASE_URL}/Observation?patient=123&category=laboratory"
+
+with open(f"{Path(__file__).parents[1]}/fhirsearchhelper/capabilitystatements/epic_r4_metadata_edited.json", "r") as fopen:
+    EPIC_CAPABILITY_STATEMENT: dict = json.load(fopen)
+
+
+def make_observation(index: int, value: int, last_updated: str) -> dict:
+    return {
+        "resourceType": "Observation",
+        "id": f"obs-{index}",
+        "meta": {"lastUpdated": last_updated},
+        "status": "final",
+        "code": {"text": "Erythrocytes"},
+        "valueQuantity": {"value": value},
+    }
+
+
+def observation_handler(observations: dict[str, dict], capability_statement: dict, requested_urls: list[str]):
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/metadata"):
+            return httpx.Response(200, json=capability_statement)
+        requested_urls.append(str(request.url))
+        matched: list[dict] = list(observations.values())
+        last_updated: str | None = request.url.params.get("_lastUpdated")
+        if last_updated:
+            # Only servers whose CapabilityStatement lists _lastUpdated are sent it
+            assert last_updated.startswith("gt")
+            matched = [observation for observation in matched if observation["meta"]["lastUpdated"] > last_updated[2:]]
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "total": len(matched), "entry": [{"resource": observation} for observation in matched]})
+
+    return handler
+
+
+def update_observations(observations: dict[str, dict]) -> None:
+    now: str = datetime.now(tz=timezone.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+    observations["obs-1"] = make_observation(1, 99, now)
+    observations["obs-3"] = make_observation(3, 3, now)
+
+
+def test_run_fhir_query_incremental_filters_locally() -> None:
+    observations: dict[str, dict] = {f"obs-{index}": make_observation(index, index, "2020-01-01T00:00:00Z") for index in range(3)}
+    requested_urls: list[str] = []
+    client = httpx.Client(transport=httpx.MockTransport(observation_handler(observations, EPIC_CAPABILITY_STATEMENT, requested_urls)))
+    sync_store = LRUCache()
+    query_kwargs: dict = {"query": QUERY, "query_headers": {"Authorization": "Bearer 1234567"}, "capability_statement_url": f"{BASE_URL}/metadata", "client": client}
+
+    first_output = run_fhir_query(sync_store=sync_store, **query_kwargs)
+    update_observations(observations)
+    recorder = MetricsRecorder()
+    add_metrics_hook(recorder)
+    try:
+        second_output = run_fhir_query(sync_store=sync_store, **query_kwargs)
+    finally:
+        remove_metrics_hook(recorder)
+
+    # Epic does not support _lastUpdated, so it is filtered locally and the unchanged Observations come from the stored output
+    assert all("_lastUpdated" not in url for url in requested_urls)
+    assert recorder.counters["entries_dropped"] == 2
+    assert first_output is not None and len(first_output.entry) == 3
+    assert second_output is not None and second_output.total == 4
+    assert {entry.resource.id: entry.resource.valueQuantity.value for entry in second_output.entry} == {"obs-0": 0, "obs-1": 99, "obs-2": 2, "obs-3": 3}
+    assert len(sync_store) == 1
+
+
+def test_run_fhir_query_async_incremental_uses_last_updated() -> None:
+    capability_statement: dict = copy.deepcopy(EPIC_CAPABILITY_STATEMENT)
+    observation_resource: dict = next(resource for resource in capability_statement["rest"][0]["resource"] if resource["type"] == "Observation")
+    observation_resource["searchParam"].append({"name": "_lastUpdated", "type": "date"})
+    observations: dict[str, dict] = {f"obs-{index}": make_observation(index, index, "2020-01-01T00:00:00Z") for index in range(3)}
+    requested_urls: list[str] = []
+    client = httpx.AsyncClient(transport=httpx.MockTransport(observation_handler(observations, capability_statement, requested_urls)))
+    sync_store = LRUCache()
+    query_kwargs: dict = {"query": QUERY, "query_headers": {"Authorization": "Bearer 1234567"}, "capability_statement_url": f"{BASE_URL}/metadata", "client": client, "raw": True}
+
+    asyncio.run(run_fhir_query_async(sync_store=sync_store, **query_kwargs))
+    update_observations(observations)
+    second_output = asyncio.run(run_fhir_query_async(sync_store=sync_store, **query_kwargs))
+
+    assert "_lastUpdated" not in requested_urls[0] and "_lastUpdated=gt" in requested_urls[1]
+    assert isinstance(second_output, dict) and second_output["total"] == 4
+    assert {entry["resource"]["id"]: entry["resource"]["valueQuantity"]["value"] for entry in second_output["entry"]} == {"obs-0": 0, "obs-1": 99, "obs-2": 2, "obs-3": 3}
+
+
+def test_incremental_sync_is_keyed_by_scope_not_credentials() -> None:
+    observations: dict[str, dict] = {f"obs-{index}": make_observation(index, index, "2020-01-01T00:00:00Z") for index in range(3)}
+    requested_urls: list[str] = []
+    client = httpx.Client(transport=httpx.MockTransport(observation_handler(observations, EPIC_CAPABILITY_STATEMENT, requested_urls)))
+    sync_store = LRUCache()
+    query_kwargs: dict = {"query": QUERY, "capability_statement_url": f"{BASE_URL}/metadata", "client": client, "sync_store": sync_store, "raw": True}
+
+    run_fhir_query(query_headers={"Authorization": "Bearer night1"}, sync_scope="nightly", **query_kwargs)
+    observations.pop("obs-0")
+    # A new token for the next run still finds the stored watermark, while another scope runs its own full sync
+    next_run_output = run_fhir_query(query_headers={"Authorization": "Bearer night2"}, sync_scope="nightly", **query_kwargs)
+    other_scope_output = run_fhir_query(query_headers={"Authorization": "Bearer night2"}, sync_scope="other-tenant", **query_kwargs)
+
+    assert isinstance(next_run_output, dict) and next_run_output["total"] == 3
+    assert isinstance(other_scope_output, dict) and other_scope_output["total"] == 2
+    assert len(sync_store) == 2
+
+
+def test_incremental_sync_with_a_new_token_searches_the_delta() -> None:
+    capability_statement: dict = copy.deepcopy(EPIC_CAPABILITY_STATEMENT)
+    observation_resource: dict = next(resource for resource in capability_statement["rest"][0]["resource"] if resource["type"] == "Observation")
+    observation_resource["searchParam"].append({"name": "_lastUpdated", "type": "date"})
+    observations: dict[str, dict] = {f"obs-{index}": make_observation(index, index, "2020-01-01T00:00:00Z") for index in range(3)}
+    requested_urls: list[str] = []
+    client = httpx.Client(transport=httpx.MockTransport(observation_handler(observations, capability_statement, requested_urls)))
+    query_kwargs: dict = {"query": QUERY, "capability_statement_url": f"{BASE_URL}/metadata", "client": client, "sync_store": LRUCache(), "raw": True}
+
+    run_fhir_query(query_headers={"Authorization": "Bearer night1"}, **query_kwargs)
+    run_fhir_query(query_headers={"Authorization": "Bearer night2"}, **query_kwargs)
+
+    assert "_lastUpdated" not in requested_urls[0] and "_lastUpdated=gt" in requested_urls[1]
@@ -0,0 +1,390 @@
+import asyncio
+
+import httpx
+from fhir.resources.R4B.bundle import Bundle
+
+from benchmarks.mockserver import MockFHIRServer
+from fhirsearchhelper import main
+from fhirsearchhelper.helpers.conditionhelper import expand_condition_onset_in_bundle_json, expand_condition_onset_in_bundle_json_async
+from fhirsearchhelper.main import get_next_page_url, run_fhir_query, run_fhir_query_async, run_fhir_query_pages
+
+BASE_URL = "https://fhir.example.org/R4"
+
+
+def observation_page(page: int, page_count: int, page_size: int) -> dict:
+    bundle: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "total": page_count * page_size,
+        "link": [{"relation": "self", "url": f"{BASE_URL}/Observation?patient=123&page={page}"}],
+        "entry": [
+            {
+                "fullUrl": f"{BASE_URL}/Observation/obs-{page}-{i}",
+                "resource": {"resourceType": "Observation", "id": f"obs-{page}-{i}", "status": "final", "code": {"text": "Test"}},
+                "search": {"mode": "match"},
+            }
+            for i in range(page_size)
+        ],
+    }
+    if page < page_count:
+        bundle["link"].append({"relation": "next", "url": f"{BASE_URL}/Observation?patient=123&page={page + 1}"})
+    return bundle
+
+
+def paged_client(page_count: int, page_size: int, requested_urls: list[str]) -> httpx.Client:
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        page = int(request.url.params.get("page", 1))
+        return httpx.Response(200, json=observation_page(page, page_count, page_size))
+
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+
+def test_get_next_page_url() -> None:
+    assert get_next_page_url(observation_page(1, 2, 1)) == f"{BASE_URL}/Observation?patient=123&page=2"
+    assert get_next_page_url(observation_page(2, 2, 1)) is None
+
+
+def test_run_fhir_query_first_page_only() -> None:
+    requested_urls: list[str] = []
+    client = paged_client(page_count=3, page_size=5, requested_urls=requested_urls)
+
+    output = run_fhir_query(query=f"{BASE_URL}/Observation?patient=123", query_headers={"Authorization": "Bearer 1234567"}, capability_statement_file="epic_r4_metadata_edited.json", client=client)
+
+    assert isinstance(output, Bundle)
+    assert len(output.entry) == 5  # type: ignore
+    assert len(requested_urls) == 1
+
+
+def test_run_fhir_query_first_page_only_closes_the_pages(monkeypatch) -> None:
+    closed: list[bool] = []
+
+    def pages(**kwargs):
+        try:
+            yield observation_page(1, 3, 5)
+            yield observation_page(2, 3, 5)
+        finally:
+            closed.append(True)
+
+    monkeypatch.setattr(main, "run_fhir_query_pages", pages)
+
+    output = run_fhir_query(query=f"{BASE_URL}/Observation?patient=123", raw=True)
+
+    assert isinstance(output, dict) and len(output["entry"]) == 5
+    assert closed == [True]
+
+
+def test_run_fhir_query_follow_next_merges_pages() -> None:
+    requested_urls: list[str] = []
+    client = paged_client(page_count=3, page_size=5, requested_urls=requested_urls)
+
+    output = run_fhir_query(
+        query=f"{BASE_URL}/Observation?patient=123",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_file="epic_r4_metadata_edited.json",
+        follow_next=True,
+        client=client,
+    )
+
+    assert isinstance(output, Bundle)
+    assert output.total == 15
+    assert [entry.resource.id for entry in output.entry] == [f"obs-{page}-{i}" for page in range(1, 4) for i in range(5)]  # type: ignore
+    assert not [link for link in output.link if link.relation == "next"]  # type: ignore
+    assert len(requested_urls) == 3
+
+
+def test_run_fhir_query_pages_yields_each_page() -> None:
+    requested_urls: list[str] = []
+    client = paged_client(page_count=4, page_size=2, requested_urls=requested_urls)
+
+    pages = list(
+        run_fhir_query_pages(query=f"{BASE_URL}/Observation?patient=123", query_headers={"Authorization": "Bearer 1234567"}, capability_statement_file="epic_r4_metadata_edited.json", client=client)
+    )
+
+    assert len(pages) == 4
+    assert all(isinstance(page, Bundle) and len(page.entry) == 2 for page in pages)  # type: ignore
+
+
+def test_run_fhir_query_async_follow_next_merges_pages() -> None:
+    requested_urls: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        page = int(request.url.params.get("page", 1))
+        return httpx.Response(200, json=observation_page(page, 3, 4))
+
+    async def run() -> Bundle:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await run_fhir_query_async(  # type: ignore
+                query=f"{BASE_URL}/Observation?patient=123",
+                query_headers={"Authorization": "Bearer 1234567"},
+                capability_statement_file="epic_r4_metadata_edited.json",
+                follow_next=True,
+                client=client,
+            )
+
+    output = asyncio.run(run())
+
+    assert isinstance(output, Bundle)
+    assert output.total == 12
+    assert len(requested_urls) == 3
+
+
+def test_run_fhir_query_async_expands_medications_once() -> None:
+    requested_urls: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(request.url.path)
+        if request.url.path.endswith("/Medication/med-1"):
+            return httpx.Response(200, json={"resourceType": "Medication", "id": "med-1", "code": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": "1049221"}]}})
+        return httpx.Response(
+            200,
+            json={
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "entry": [
+                    {
+                        "resource": {
+                            "resourceType": "MedicationRequest",
+                            "id": f"mr-{i}",
+                            "status": "active",
+                            "intent": "order",
+                            "subject": {"reference": "Patient/123"},
+                            "medicationReference": {"reference": "Medication/med-1"},
+                        }
+                    }
+                    for i in range(10)
+                ],
+            },
+        )
+
+    async def run() -> Bundle:
+        async with httpx.AsyncClient(transport=httpx.MockTransport(handler)) as client:
+            return await run_fhir_query_async(  # type: ignore
+                query=f"{BASE_URL}/MedicationRequest?patient=123",
+                query_headers={"Authorization": "Bearer 1234567"},
+                capability_statement_file="epic_r4_metadata_edited.json",
+                client=client,
+                max_concurrency=2,
+            )
+
+    output = asyncio.run(run())
+
+    assert isinstance(output, Bundle)
+    assert [entry.resource.id for entry in output.entry] == [f"mr-{i}" for i in range(10)]  # type: ignore
+    assert all(entry.resource.medicationCodeableConcept.coding[0].code == "1049221" for entry in output.entry)  # type: ignore
+    assert requested_urls.count("/R4/Medication/med-1") == 1
+
+
+def test_raw_medication_codes_are_not_shared_with_the_cache() -> None:
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.path.endswith("/Medication/med-1"):
+            return httpx.Response(200, json={"resourceType": "Medication", "id": "med-1", "code": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": "1049221"}]}})
+        medication_request: dict = {
+            "resourceType": "MedicationRequest",
+            "id": "mr-1",
+            "status": "active",
+            "intent": "order",
+            "subject": {"reference": "Patient/123"},
+            "medicationReference": {"reference": "Medication/med-1"},
+        }
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": medication_request}]})
+
+    query_kwargs: dict = {
+        "query": f"{BASE_URL}/MedicationRequest?patient=123",
+        "query_headers": {"Authorization": "Bearer 1234567"},
+        "capability_statement_file": "epic_r4_metadata_edited.json",
+        "raw": True,
+    }
+    first_output = run_fhir_query(client=httpx.Client(transport=httpx.MockTransport(handler)), **query_kwargs)
+    first_output["entry"][0]["resource"]["medicationCodeableConcept"]["coding"][0]["code"] = "edited"  # type: ignore
+    second_output = asyncio.run(run_fhir_query_async(client=httpx.AsyncClient(transport=httpx.MockTransport(handler)), **query_kwargs))
+
+    assert second_output["entry"][0]["resource"]["medicationCodeableConcept"]["coding"][0]["code"] == "1049221"  # type: ignore
+
+
+def test_run_fhir_query_without_expanding_documents() -> None:
+    requested_urls: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        document_reference: dict = {"resourceType": "DocumentReference", "id": "doc-1", "status": "current", "content": [{"attachment": {"contentType": "text/html", "url": "Binary/note-1"}}]}
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "total": 1, "entry": [{"resource": document_reference, "search": {"mode": "match"}}]})
+
+    output = run_fhir_query(
+        query=f"{BASE_URL}/DocumentReference?patient=123&category=clinical-note",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_file="epic_r4_metadata_edited.json",
+        client=httpx.Client(transport=httpx.MockTransport(handler)),
+        expand_documents=False,
+    )
+
+    assert isinstance(output, Bundle)
+    assert output.entry[0].resource.content[0].attachment.url == "Binary/note-1"  # type: ignore
+    assert len(requested_urls) == 1
+
+
+def test_run_fhir_query_raw_returns_dict_pages() -> None:
+    requested_urls: list[str] = []
+    client = paged_client(page_count=2, page_size=3, requested_urls=requested_urls)
+
+    output = run_fhir_query(
+        query=f"{BASE_URL}/Observation?patient=123",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_file="epic_r4_metadata_edited.json",
+        follow_next=True,
+        client=client,
+        raw=True,
+    )
+
+    assert isinstance(output, dict)
+    assert output["total"] == 6
+    assert [entry["resource"]["id"] for entry in output["entry"]] == [f"obs-{page}-{i}" for page in range(1, 3) for i in range(3)]
+    assert not [link for link in output["link"] if link["relation"] == "next"]
+    assert Bundle.model_validate(output).total == 6
+
+
+def test_run_fhir_query_resolves_included_medications() -> None:
+    requested_urls: list[httpx.URL] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(request.url)
+        if request.url.path.endswith("/Medication/med-2"):
+            return httpx.Response(200, json={"resourceType": "Medication", "id": "med-2", "code": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": "2"}]}})
+        medication_requests: list[dict] = [
+            {
+                "resource": {
+                    "resourceType": "MedicationRequest",
+                    "id": f"mr-{i}",
+                    "status": "active",
+                    "intent": "order",
+                    "subject": {"reference": "Patient/123"},
+                    "medicationReference": {"reference": f"Medication/med-{i % 3}"},
+                },
+                "search": {"mode": "match"},
+            }
+            for i in range(6)
+        ]
+        included_medications: list[dict] = [
+            {
+                "fullUrl": f"{BASE_URL}/Medication/med-{i}",
+                "resource": {"resourceType": "Medication", "id": f"med-{i}", "code": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": str(i)}]}},
+                "search": {"mode": "include"},
+            }
+            for i in range(2)
+        ]
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "entry": medication_requests + included_medications})
+
+    output = run_fhir_query(
+        query=f"{BASE_URL}/MedicationRequest?patient=123",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_file="epic_r4_metadata_edited.json",
+        client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+
+    assert isinstance(output, Bundle)
+    assert requested_urls[0].params.get("_include") == "MedicationRequest:medication"
+    assert [url.path for url in requested_urls[1:]] == ["/R4/Medication/med-2"]
+    assert [entry.resource.id for entry in output.entry] == [f"mr-{i}" for i in range(6)]  # type: ignore
+    assert [entry.resource.medicationCodeableConcept.coding[0].code for entry in output.entry] == ["0", "1", "2", "0", "1", "2"]  # type: ignore
+
+
+def test_run_fhir_query_reads_encounters_in_batches() -> None:
+    server = MockFHIRServer(count=200, page_size=100, batch=True)
+
+    output = run_fhir_query(
+        query=f"{server.base_url}/Condition?patient=123&category=encounter-diagnosis",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_url=f"{server.base_url}/metadata",
+        client=server.client(),
+        follow_next=True,
+        reference_batch_size=8,
+    )
+
+    assert isinstance(output, Bundle)
+    assert len(output.entry) == 200  # type: ignore
+    assert output.entry[21].resource.onsetDateTime.isoformat().startswith("2020-01-02")  # type: ignore
+    # 20 distinct Encounters in batches of 8, all read on the first page
+    assert server.requests == {"metadata": 1, "Condition": 2, "batch": 3}
+
+
+def test_run_fhir_query_async_reads_encounters_in_batches() -> None:
+    server = MockFHIRServer(count=50, batch=True)
+
+    async def run() -> Bundle:
+        async with server.async_client() as client:
+            return await run_fhir_query_async(  # type: ignore
+                query=f"{server.base_url}/Condition?patient=123&category=encounter-diagnosis",
+                query_headers={"Authorization": "Bearer 1234567"},
+                capability_statement_url=f"{server.base_url}/metadata",
+                client=client,
+            )
+
+    output = asyncio.run(run())
+
+    assert len(output.entry) == 50  # type: ignore
+    assert server.requests == {"metadata": 1, "Condition": 1, "batch": 1}
+
+
+def test_run_fhir_query_without_batch_support_reads_one_at_a_time() -> None:
+    server = MockFHIRServer(count=50)
+
+    run_fhir_query(
+        query=f"{server.base_url}/Condition?patient=123&category=encounter-diagnosis",
+        query_headers={"Authorization": "Bearer 1234567"},
+        capability_statement_url=f"{server.base_url}/metadata",
+        client=server.client(),
+    )
+
+    assert server.requests == {"metadata": 1, "Condition": 1, "Encounter": 5}
+
+
+def test_batch_reads_that_fail_fall_back_to_single_reads() -> None:
+    requests: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(f"{request.method} {request.url.path}")
+        if request.method == "POST":
+            encounter: dict = {"resourceType": "Encounter", "id": "enc-1", "status": "finished", "class": {"code": "AMB"}, "period": {"start": "2021-05-01"}}
+            return httpx.Response(
+                200, json={"resourceType": "Bundle", "type": "batch-response", "entry": [{"resource": encounter, "response": {"status": "200 OK"}}, {"response": {"status": "404 Not Found"}}]}
+            )
+        return httpx.Response(200, json={"resourceType": "Encounter", "id": "enc-2", "status": "finished", "class": {"code": "AMB"}, "period": {"start": "2022-05-01"}})
+
+    bundle_json: dict = {
+        "resourceType": "Bundle",
+        "type": "searchset",
+        "entry": [{"resource": {"resourceType": "Condition", "id": f"cond-{i}", "subject": {"reference": "Patient/123"}, "encounter": {"reference": f"Encounter/enc-{i}"}}} for i in [1, 2]],
+    }
+
+    output_json: dict = expand_condition_onset_in_bundle_json(client=httpx.Client(transport=httpx.MockTransport(handler)), bundle_json=bundle_json, base_url=BASE_URL, batch_size=10)
+
+    assert [entry["resource"]["onsetDateTime"] for entry in output_json["entry"]] == ["2021-05-01", "2022-05-01"]
+    assert requests == ["POST /R4", "GET /R4/Encounter/enc-2"]
+
+
+def test_failed_shared_lookups_are_retried() -> None:
+    requests: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request.url.path)
+        if len(requests) == 1:
+            return httpx.Response(500, json={"resourceType": "OperationOutcome", "issue": [{"severity": "error", "code": "exception"}]})
+        return httpx.Response(200, json={"resourceType": "Encounter", "id": "enc-retry", "status": "finished", "class": {"code": "AMB"}, "period": {"start": "2021-05-01"}})
+
+    def bundle_json() -> dict:
+        return {"resourceType": "Bundle", "type": "searchset", "entry": [{"resource": {"resourceType": "Condition", "id": "cond-1", "encounter": {"reference": "Encounter/enc-retry"}}}]}
+
+    async def run() -> list[dict]:
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        reference_lookups: dict[str, asyncio.Task] = {}
+        first_output: dict = await expand_condition_onset_in_bundle_json_async(client=client, bundle_json=bundle_json(), base_url=BASE_URL, reference_lookups=reference_lookups)
+        assert reference_lookups == {}
+        second_output: dict = await expand_condition_onset_in_bundle_json_async(client=client, bundle_json=bundle_json(), base_url=BASE_URL, reference_lookups=reference_lookups)
+        return [first_output, second_output]
+
+    first_output, second_output = asyncio.run(run())
+
+    assert first_output["entry"] == []
+    assert second_output["entry"][0]["resource"]["onsetDateTime"] == "2021-05-01"
+    assert requests == ["/R4/Encounter/enc-retry", "/R4/Encounter/enc-retry"]
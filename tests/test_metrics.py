@@ -0,0 +1,70 @@
+import asyncio
+
+from benchmarks.mockserver import FIRST_RXNORM_CODE, RXNORM_SYSTEM, MockFHIRServer
+from fhirsearchhelper.helpers.metrics import MetricsHook, MetricsRecorder, add_metrics_hook, count, metrics_hooks, remove_metrics_hook, timed
+from fhirsearchhelper.main import run_fhir_query, run_fhir_query_async
+
+
+def test_metrics_are_noops_without_hooks() -> None:
+    assert metrics_hooks == ()
+    with timed("search"):
+        count("http_calls")
+
+
+def test_run_fhir_query_reports_metrics() -> None:
+    server = MockFHIRServer(count=20, page_size=10)
+    recorder = MetricsRecorder()
+    add_metrics_hook(recorder)
+    try:
+        output = run_fhir_query(
+            query=f"{server.base_url}/MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}",
+            client=server.client(),
+            query_headers={"Authorization": "Bearer test"},
+            capability_statement_url=f"{server.base_url}/metadata",
+            follow_next=True,
+        )
+    finally:
+        remove_metrics_hook(recorder)
+
+    assert output is not None and len(output.entry) == 10
+    for stage in ["capability_statement", "gap_analysis", "expand_medications", "filter", "validate"]:
+        assert len(recorder.timings[stage]) >= 1
+    assert len(recorder.timings["search"]) == 2
+    # metadata and two search pages, which include the Medications so none are looked up
+    assert recorder.counters["http_calls"] == 3 == sum(server.requests.values())
+    assert recorder.counters["http_bytes"] > 0
+    assert recorder.counters["prefetched_references"] == 20
+    assert "cache_misses" not in recorder.counters
+    assert recorder.counters["entries_dropped"] == 10
+
+
+def test_run_fhir_query_async_reports_metrics() -> None:
+    server = MockFHIRServer(count=10, page_size=10)
+    recorder = MetricsRecorder()
+
+    class FailingHook(MetricsHook):
+        def on_count(self, counter, value, attributes):
+            raise RuntimeError("hooks must not break the query")
+
+    failing_hook = FailingHook()
+    add_metrics_hook(recorder)
+    add_metrics_hook(failing_hook)
+
+    async def run() -> None:
+        async with server.async_client() as client:
+            await run_fhir_query_async(
+                query=f"{server.base_url}/Condition?patient=123&category=encounter-diagnosis",
+                client=client,
+                query_headers={"Authorization": "Bearer test"},
+                capability_statement_url=f"{server.base_url}/metadata",
+            )
+
+    try:
+        asyncio.run(run())
+    finally:
+        remove_metrics_hook(recorder)
+        remove_metrics_hook(failing_hook)
+
+    assert len(recorder.timings["expand_conditions"]) == 1
+    assert recorder.counters["cache_misses"] == 1
+    assert recorder.counters["http_calls"] == 3
@@ -0,0 +1,146 @@
+import asyncio
+import json
+from pathlib import Path
+
+import httpx
+
+from benchmarks.mockserver import FIRST_RXNORM_CODE, RXNORM_SYSTEM, MockFHIRServer, synthetic_bundle
+from fhirsearchhelper.helpers import querycache
+from fhirsearchhelper.helpers.cache import LRUCache
+from fhirsearchhelper.helpers.capabilitystatement import parse_capability_statement
+from fhirsearchhelper.main import fetch_search_page, run_fhir_query, run_fhir_query_async
+from fhirsearchhelper.models.models import QuerySearchParams
+from fhirsearchhelper.session import FHIRSearchSession
+
+
+def test_normalize_search_url() -> None:
+    assert querycache.normalize_search_url("https://fhir.test/R4/Observation?patient=123&category=vital-signs") == querycache.normalize_search_url(
+        "https://fhir.test/R4/Observation/?category=vital-signs&patient=123"
+    )
+    assert querycache.normalize_search_url("https://fhir.test/R4/Observation/") == "https://fhir.test/R4/Observation"
+
+
+def test_run_fhir_query_uses_search_output_cache() -> None:
+    server = MockFHIRServer(count=20, page_size=10)
+    querycache.configure_query_caches(outputs=LRUCache(max_entries=10, ttl=60))
+    try:
+        query_kwargs: dict = {"client": server.client(), "query_headers": {"Authorization": "Bearer test"}, "capability_statement_url": f"{server.base_url}/metadata", "follow_next": True}
+        first_output = run_fhir_query(query=f"{server.base_url}/MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}", **query_kwargs)
+        requests_made: int = sum(server.requests.values())
+        repeat_output = run_fhir_query(query=f"{server.base_url}/MedicationRequest?code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}&patient=123", **query_kwargs)
+        raw_output = asyncio.run(
+            run_fhir_query_async(
+                query=f"{server.base_url}/MedicationRequest?patient=123&code={RXNORM_SYSTEM}|{FIRST_RXNORM_CODE}",
+                client=server.async_client(),
+                query_headers={"Authorization": "Bearer test"},
+                capability_statement_url=f"{server.base_url}/metadata",
+                follow_next=True,
+                raw=True,
+            )
+        )
+    finally:
+        querycache.disable_query_caches()
+
+    assert sum(server.requests.values()) == requests_made
+    assert first_output is not None and repeat_output is not None and repeat_output is not first_output
+    assert repeat_output.model_dump() == first_output.model_dump()
+    assert isinstance(raw_output, dict) and len(raw_output["entry"]) == 10
+
+
+def test_fetch_search_page_revalidates_with_etag() -> None:
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if request.headers.get("If-None-Match") == '"v1"':
+            return httpx.Response(304)
+        return httpx.Response(200, headers={"ETag": '"v1"'}, json=synthetic_bundle("Observation", range(2), 1))
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    querycache.configure_query_caches(responses=LRUCache(max_entries=10, ttl=60), fresh_for=60)
+    try:
+        first_response = fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {}, "Observation")
+        fresh_response = fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {}, "Observation")
+        querycache.configure_query_caches(fresh_for=0)
+        revalidated_response = fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {}, "Observation")
+    finally:
+        querycache.disable_query_caches()
+        querycache.configure_query_caches(fresh_for=60)
+
+    assert len(requests) == 2
+    assert requests[1].headers["If-None-Match"] == '"v1"'
+    assert first_response.json() == fresh_response.json() == revalidated_response.json()
+
+
+def test_fetch_search_page_probes_last_updated_without_validators() -> None:
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        if "_lastUpdated" in request.url.params:
+            return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "total": 0})
+        return httpx.Response(200, json=synthetic_bundle("Observation", range(2), 1))
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    querycache.configure_query_caches(responses=LRUCache(max_entries=10, ttl=60), fresh_for=0)
+    try:
+        fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {}, "Observation", last_updated_probe=True)
+        cached_response = fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {}, "Observation", last_updated_probe=True)
+    finally:
+        querycache.disable_query_caches()
+        querycache.configure_query_caches(fresh_for=60)
+
+    assert len(requests) == 2
+    assert requests[1].url.params["_lastUpdated"].startswith("gt") and requests[1].url.params["_summary"] == "count"
+    assert len(cached_response.json()["entry"]) == 2
+
+
+def test_query_caches_are_keyed_by_credentials() -> None:
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json=synthetic_bundle("Observation", range(2), 1))
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    querycache.configure_query_caches(responses=LRUCache(max_entries=10, ttl=60), fresh_for=60)
+    try:
+        fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {"Authorization": "Bearer first"}, "Observation")
+        fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {"authorization": "Bearer first"}, "Observation")
+        fetch_search_page(client, "https://fhir.test/R4/Observation?patient=123", {"Authorization": "Bearer second"}, "Observation")
+    finally:
+        querycache.disable_query_caches()
+
+    params = QuerySearchParams(resourceType="Observation", searchParams={"patient": "123"})
+    first_key: str = querycache.get_search_output_key("https://fhir.test/R4", params, {"Authorization": "Bearer first"}, None, follow_next=True, expand_documents=True)
+    second_key: str = querycache.get_search_output_key("https://fhir.test/R4", params, {"Authorization": "Bearer second"}, None, follow_next=True, expand_documents=True)
+
+    assert [request.headers["Authorization"] for request in requests] == ["Bearer first", "Bearer second"]
+    assert first_key != second_key and "Bearer" not in first_key
+
+
+def test_search_output_cache_is_keyed_by_capability_statement() -> None:
+    requests: list[httpx.Request] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requests.append(request)
+        return httpx.Response(200, json=synthetic_bundle("Observation", range(2), 1))
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    with open(f"{Path(__file__).parents[1]}/fhirsearchhelper/capabilitystatements/epic_r4_metadata_edited.json", "r") as fopen:
+        capability_statement: dict = json.load(fopen)
+    observation_resource: dict = next(resource for resource in capability_statement["rest"][0]["resource"] if resource["type"] == "Observation")
+    observation_resource["searchParam"].append({"name": "_lastUpdated", "type": "date"})
+
+    querycache.configure_query_caches(outputs=LRUCache(max_entries=10, ttl=60))
+    try:
+        query_kwargs: dict = {"query": "https://fhir.test/R4/Observation?patient=123", "query_headers": {"Authorization": "Bearer test"}}
+        with FHIRSearchSession(capability_statement_file="epic_r4_metadata_edited.json", client=client) as epic_session:
+            epic_session.run_fhir_query(**query_kwargs)
+            epic_session.run_fhir_query(**query_kwargs)
+        with FHIRSearchSession(capability_statement=parse_capability_statement(capability_statement), client=client) as edited_session:
+            edited_session.run_fhir_query(**query_kwargs)
+    finally:
+        querycache.disable_query_caches()
+
+    assert len(requests) == 2
@@ -0,0 +1,93 @@
+import asyncio
+import json
+from pathlib import Path
+
+import httpx
+
+from fhirsearchhelper.helpers import queryplanner
+from fhirsearchhelper.helpers.capabilitystatement import get_supported_search_params, load_capability_statement
+from fhirsearchhelper.helpers.queryplanner import QueryStatistics, enumerate_query_plans
+from fhirsearchhelper.main import run_fhir_query, run_fhir_query_async
+from fhirsearchhelper.models.models import QuerySearchParams
+
+BASE_URL = "https://fhir.example.org/R4"
+
+with open(f"{Path(__file__).parents[1]}/fhirsearchhelper/capabilitystatements/epic_r4_metadata_edited.json", "r") as fopen:
+    EPIC_CAPABILITY_STATEMENT: dict = json.load(fopen)
+
+
+def make_condition(index: int, category: str, code: str) -> dict:
+    return {
+        "resourceType": "Condition",
+        "id": f"cond-{index}",
+        "category": [{"coding": [{"system": "http://terminology.hl7.org/CodeSystem/condition-category", "code": category}]}],
+        "code": {"coding": [{"system": "http://snomed.info/sct", "code": code}]},
+        "subject": {"reference": "Patient/123"},
+    }
+
+
+# 40 infections, one with the searched code, and 5 encounter diagnoses, two with the searched code
+CONDITIONS: list[dict] = [make_condition(index, "infection", "38341003" if index == 0 else "840539006") for index in range(40)] + [
+    make_condition(index, "encounter-diagnosis", "38341003" if index < 42 else "44054006") for index in range(40, 45)
+]
+
+
+def condition_handler(requested_urls: list[str]):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        if request.url.path.endswith("/metadata"):
+            return httpx.Response(200, json=EPIC_CAPABILITY_STATEMENT)
+        categories: list[str] = request.url.params.get("category", "").split(",")
+        code: str | None = request.url.params.get("code")
+        matched: list[dict] = [
+            condition for condition in CONDITIONS if condition["category"][0]["coding"][0]["code"] in categories and (code is None or condition["code"]["coding"][0]["code"] == code)
+        ]
+        return httpx.Response(200, json={"resourceType": "Bundle", "type": "searchset", "total": len(matched), "entry": [{"resource": condition} for condition in matched]})
+
+    return handler
+
+
+def test_enumerate_query_plans_splits_on_true_when() -> None:
+    supported_search_params = get_supported_search_params(load_capability_statement(client=httpx.Client(), file_path="epic_r4_metadata_edited.json"))
+    search_params = QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "category": "infection,encounter-diagnosis,problem-list-item", "code": "38341003"})
+
+    plans = enumerate_query_plans(search_params, supported_search_params)
+
+    assert len(plans) == 2
+    assert plans[0].branches == [search_params]
+    assert [branch.searchParams["category"] for branch in plans[1].branches] == ["infection", "encounter-diagnosis,problem-list-item"]
+    assert len(enumerate_query_plans(QuerySearchParams(resourceType="Condition", searchParams={"patient": "123", "category": "infection,encounter-diagnosis"}), supported_search_params)) == 1
+
+
+def test_run_fhir_query_with_query_planner() -> None:
+    requested_urls: list[str] = []
+    client = httpx.Client(transport=httpx.MockTransport(condition_handler(requested_urls)))
+    query_kwargs: dict = {
+        "query": f"{BASE_URL}/Condition?patient=123&category=infection,encounter-diagnosis&code=38341003",
+        "query_headers": {"Authorization": "Bearer 1234567"},
+        "capability_statement_url": f"{BASE_URL}/metadata",
+        "follow_next": True,
+    }
+    statistics: QueryStatistics = queryplanner.configure_query_planner(statistics=QueryStatistics(), cost_per_request=5)
+    try:
+        first_output = run_fhir_query(client=client, **query_kwargs)
+        first_search_urls: list[str] = [url for url in requested_urls if "/Condition" in url]
+        requested_urls.clear()
+        second_output = run_fhir_query(client=client, **query_kwargs)
+        third_output = asyncio.run(run_fhir_query_async(client=httpx.AsyncClient(transport=httpx.MockTransport(condition_handler(requested_urls))), raw=True, **query_kwargs))
+    finally:
+        queryplanner.disable_query_planner()
+
+    # The first search is run as is, filtering code locally, and estimates the split from the 45 Conditions it returned
+    assert len(first_search_urls) == 1 and "code=" not in first_search_urls[0]
+    assert statistics.estimate("Condition?category=encounter-diagnosis,infection") == 45
+    assert statistics.estimate("Condition?category=infection&code=38341003") == 1
+    assert statistics.estimate("Condition?category=encounter-diagnosis") == 5
+
+    # Later searches send code to the server for the infections, and return the same Conditions
+    second_search_urls: list[str] = [url for url in requested_urls if "/Condition" in url]
+    assert len(second_search_urls) == 4 and "code=38341003" in second_search_urls[0]
+    assert first_output is not None and second_output is not None and isinstance(third_output, dict)
+    assert sorted(entry.resource.id for entry in first_output.entry) == ["cond-0", "cond-40", "cond-41"]
+    assert sorted(entry.resource.id for entry in second_output.entry) == ["cond-0", "cond-40", "cond-41"]
+    assert sorted(entry["resource"]["id"] for entry in third_output["entry"]) == ["cond-0", "cond-40", "cond-41"]
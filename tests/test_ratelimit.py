@@ -0,0 +1,127 @@
+import asyncio
+import email.utils
+import threading
+import time
+
+import httpx
+
+from fhirsearchhelper.helpers.metrics import MetricsRecorder, add_metrics_hook, remove_metrics_hook
+from fhirsearchhelper.helpers.ratelimit import AdaptiveConcurrencyLimit, AsyncRateLimitedTransport, RateLimitedTransport, RequestScheduler, TokenBucket, parse_retry_after
+
+
+def throttling_handler(statuses: list[int], retry_after: str | None = None):
+    """Build a MockTransport handler that answers with each of statuses in turn and then 200"""
+
+    calls: list[float] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        calls.append(time.monotonic())
+        status: int = statuses[len(calls) - 1] if len(calls) <= len(statuses) else 200
+        headers: dict[str, str] = {"Retry-After": retry_after} if retry_after and status != 200 else {}
+        return httpx.Response(status, headers=headers, json={"resourceType": "Bundle", "type": "searchset"})
+
+    return handler, calls
+
+
+def test_token_bucket_spaces_requests_after_burst() -> None:
+    bucket = TokenBucket(rate=10, burst=2)
+
+    delays: list[float] = [bucket.reserve() for _ in range(4)]
+
+    assert delays[:2] == [0.0, 0.0]
+    assert 0.09 < delays[2] < 0.11
+    assert 0.19 < delays[3] < 0.21
+
+
+def test_adaptive_concurrency_limit_backs_off_and_recovers() -> None:
+    limit = AdaptiveConcurrencyLimit(initial=8, minimum=1, maximum=10)
+
+    limit.acquire()
+    limit.release(throttled=True)
+    assert limit.limit == 4
+    for _ in range(8):
+        limit.acquire()
+        limit.release()
+    assert 5 < limit.limit < 6
+    assert [limit.try_acquire() for _ in range(6)] == [True] * 5 + [False]
+
+
+def test_parse_retry_after() -> None:
+    assert parse_retry_after("3") == 3.0
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("soon") is None
+    http_date: str = email.utils.formatdate(time.time() + 30, usegmt=True)
+    assert 28 < parse_retry_after(http_date) <= 30  # type: ignore
+
+
+def test_rate_limited_transport_retries_throttled_responses() -> None:
+    handler, calls = throttling_handler([429, 503], retry_after="0.05")
+    scheduler = RequestScheduler(backoff_base=0.01)
+    client = httpx.Client(transport=RateLimitedTransport(httpx.MockTransport(handler), scheduler=scheduler))
+    recorder = MetricsRecorder()
+    add_metrics_hook(recorder)
+    try:
+        response: httpx.Response = client.get("https://fhir.example.org/R4/Observation?patient=123")
+    finally:
+        remove_metrics_hook(recorder)
+
+    assert response.status_code == 200
+    assert len(calls) == 3
+    assert calls[1] - calls[0] >= 0.05
+    assert recorder.counters["http_retries"] == 2
+    assert scheduler.get_throttle(httpx.URL("https://fhir.example.org/R4/Condition")).concurrency.limit < 10
+
+
+def test_rate_limited_transport_gives_up_after_max_retries() -> None:
+    handler, calls = throttling_handler([500] * 10)
+    client = httpx.Client(transport=RateLimitedTransport(httpx.MockTransport(handler), scheduler=RequestScheduler(max_retries=2, backoff_base=0.001)))
+
+    assert client.get("https://fhir.example.org/R4/Observation").status_code == 500
+    assert len(calls) == 3
+
+
+def test_async_rate_limited_transport_limits_rate_and_retries() -> None:
+    handler, calls = throttling_handler([429], retry_after="0")
+    scheduler = RequestScheduler(rate=50, burst=1)
+
+    async def run() -> list[httpx.Response]:
+        async with httpx.AsyncClient(transport=AsyncRateLimitedTransport(httpx.MockTransport(handler), scheduler=scheduler)) as client:
+            return await asyncio.gather(*[client.get(f"https://fhir.example.org/R4/Encounter/enc-{i}") for i in range(5)])
+
+    start: float = time.monotonic()
+    responses: list[httpx.Response] = asyncio.run(run())
+
+    assert [response.status_code for response in responses] == [200] * 5
+    assert len(calls) == 6
+    # 6 requests at 50 per second with no burst take at least 5 / 50 seconds
+    assert time.monotonic() - start >= 0.1
+
+
+def test_streamed_response_holds_its_slot_until_closed() -> None:
+    scheduler = RequestScheduler(initial_concurrency=1, min_concurrency=1, max_concurrency=1)
+    client = httpx.Client(transport=RateLimitedTransport(httpx.MockTransport(lambda request: httpx.Response(200, content=iter([b"x" * 1024]))), scheduler=scheduler))
+
+    with client.stream("GET", "https://fhir.example.org/R4/Binary/1") as response:
+        concurrency: AdaptiveConcurrencyLimit = scheduler.get_throttle(response.request.url).concurrency
+        assert concurrency.in_flight == 1
+        response.read()
+    assert concurrency.in_flight == 0
+
+    client.get("https://fhir.example.org/R4/Binary/2")
+    assert concurrency.in_flight == 0
+
+
+def test_async_acquire_is_woken_by_a_release_from_another_thread() -> None:
+    limit = AdaptiveConcurrencyLimit(initial=1, minimum=1, maximum=1)
+    limit.acquire()
+
+    async def acquire_after_release() -> float:
+        releaser = threading.Timer(0.05, limit.release)
+        releaser.start()
+        start: float = time.monotonic()
+        await asyncio.wait_for(limit.acquire_async(), timeout=2)
+        return time.monotonic() - start
+
+    assert asyncio.run(acquire_after_release()) >= 0.04
+    assert limit.in_flight == 1
+    assert not limit._async_waiters
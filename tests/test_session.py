@@ -0,0 +1,120 @@
+import asyncio
+import json
+from pathlib import Path
+
+import httpx
+from fhir.resources.R4B.bundle import Bundle
+
+from fhirsearchhelper.session import FHIRSearchSession
+
+BASE_URL = "https://fhir.example.org/R4"
+
+with open(f"{Path(__file__).parents[1]}/fhirsearchhelper/capabilitystatements/epic_r4_metadata_edited.json", "r") as fopen:
+    EPIC_CAPABILITY_STATEMENT: dict = json.load(fopen)
+
+
+def handler_factory(requested_paths: list[str]):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_paths.append(request.url.path)
+        if request.url.path.endswith("/metadata"):
+            return httpx.Response(200, json=EPIC_CAPABILITY_STATEMENT)
+        assert request.headers["Authorization"] == "Bearer 1234567"
+        return httpx.Response(
+            200,
+            json={
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "entry": [{"resource": {"resourceType": "Observation", "id": "obs-1", "status": "final", "code": {"text": "Test"}}}],
+            },
+        )
+
+    return handler
+
+
+def test_session_reuses_capability_statement_and_client() -> None:
+    requested_paths: list[str] = []
+    client = httpx.Client(transport=httpx.MockTransport(handler_factory(requested_paths)))
+
+    with FHIRSearchSession(capability_statement_url=f"{BASE_URL}/metadata", query_headers={"Authorization": "Bearer 1234567"}, client=client) as session:
+        first = session.run_fhir_query(query=f"{BASE_URL}/Observation?patient=123")
+        second = session.run_fhir_query(query=f"{BASE_URL}/Observation?patient=456")
+
+    assert isinstance(first, Bundle) and isinstance(second, Bundle)
+    assert requested_paths.count("/R4/metadata") == 1
+    assert requested_paths.count("/R4/Observation") == 2
+    assert not client.is_closed
+
+
+def test_session_run_fhir_query_async() -> None:
+    requested_paths: list[str] = []
+
+    async def run() -> Bundle:
+        async_client = httpx.AsyncClient(transport=httpx.MockTransport(handler_factory(requested_paths)))
+        async with FHIRSearchSession(capability_statement_file="epic_r4_metadata_edited.json", query_headers={"Authorization": "Bearer 1234567"}, async_client=async_client) as session:
+            return await session.run_fhir_query_async(query=f"{BASE_URL}/Observation?patient=123")  # type: ignore
+
+    output = asyncio.run(run())
+
+    assert isinstance(output, Bundle)
+    assert requested_paths == ["/R4/Observation"]
+
+
+def medication_request_handler(requested_paths: list[str]):
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_paths.append(request.url.path)
+        if request.url.path.endswith("/Medication/med-1"):
+            return httpx.Response(200, json={"resourceType": "Medication", "id": "med-1", "code": {"coding": [{"system": "http://www.nlm.nih.gov/research/umls/rxnorm", "code": "1049221"}]}})
+        patient_id: str = request.url.params["patient"]
+        return httpx.Response(
+            200,
+            json={
+                "resourceType": "Bundle",
+                "type": "searchset",
+                "entry": [
+                    {
+                        "resource": {
+                            "resourceType": "MedicationRequest",
+                            "id": f"mr-{patient_id}-{i}",
+                            "status": "active",
+                            "intent": "order",
+                            "subject": {"reference": f"Patient/{patient_id}"},
+                            "medicationReference": {"reference": "Medication/med-1"},
+                        }
+                    }
+                    for i in range(3)
+                ],
+            },
+        )
+
+    return handler
+
+
+def test_session_run_fhir_query_batch_async_dedupes_references() -> None:
+    requested_paths: list[str] = []
+
+    async def run() -> list[tuple[str, Bundle]]:
+        async_client = httpx.AsyncClient(transport=httpx.MockTransport(medication_request_handler(requested_paths)))
+        async with FHIRSearchSession(capability_statement_file="epic_r4_metadata_edited.json", query_headers={"Authorization": "Bearer 1234567"}, async_client=async_client) as session:
+            return [result async for result in session.run_fhir_query_batch_async(patient_ids=["p1", "p2", "p3", "p4"], query_template=f"{BASE_URL}/MedicationRequest", max_parallel_queries=2)]  # type: ignore
+
+    results = asyncio.run(run())
+
+    assert sorted(key for key, _ in results) == ["p1", "p2", "p3", "p4"]
+    for patient_id, output in results:
+        assert isinstance(output, Bundle)
+        assert all(entry.resource.subject.reference == f"Patient/{patient_id}" for entry in output.entry)  # type: ignore
+        assert all(entry.resource.medicationCodeableConcept.coding[0].code == "1049221" for entry in output.entry)  # type: ignore
+    assert requested_paths.count("/R4/Medication/med-1") == 1
+    assert requested_paths.count("/R4/MedicationRequest") == 4
+
+
+def test_session_run_fhir_query_batch_sync() -> None:
+    requested_paths: list[str] = []
+    async_client = httpx.AsyncClient(transport=httpx.MockTransport(medication_request_handler(requested_paths)))
+
+    with FHIRSearchSession(capability_statement_file="epic_r4_metadata_edited.json", query_headers={"Authorization": "Bearer 1234567"}, async_client=async_client) as session:
+        results = dict(session.run_fhir_query_batch(queries=[f"{BASE_URL}/MedicationRequest?patient=p1", f"{BASE_URL}/MedicationRequest?patient=p2"]))
+
+    assert set(results) == {f"{BASE_URL}/MedicationRequest?patient=p1", f"{BASE_URL}/MedicationRequest?patient=p2"}
+    assert all(isinstance(output, Bundle) and len(output.entry) == 3 for output in results.values())  # type: ignore
+    assert requested_paths.count("/R4/Medication/med-1") == 1
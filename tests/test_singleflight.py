@@ -0,0 +1,93 @@
+import threading
+import time
+
+import httpx
+from fhir.resources.R4B.bundle import Bundle
+
+from fhirsearchhelper.helpers import medicationhelper
+from fhirsearchhelper.helpers.medicationhelper import expand_medication_references_in_bundle
+from fhirsearchhelper.helpers.singleflight import SingleFlight
+
+
+def test_single_flight_shares_in_flight_call() -> None:
+    single_flight = SingleFlight()
+    calls: list[str] = []
+    started = threading.Event()
+    release = threading.Event()
+
+    def fetch() -> str:
+        calls.append("fetch")
+        started.set()
+        release.wait(timeout=5)
+        return "result"
+
+    results: list[str] = []
+    leader = threading.Thread(target=lambda: results.append(single_flight.do("key", fetch)))
+    leader.start()
+    started.wait(timeout=5)
+    followers = [threading.Thread(target=lambda: results.append(single_flight.do("key", fetch))) for _ in range(4)]
+    for follower in followers:
+        follower.start()
+    while single_flight.saved_calls < 4:
+        time.sleep(0.001)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join()
+
+    assert calls == ["fetch"]
+    assert results == ["result"] * 5
+    assert single_flight.saved_calls == 4
+    # The key is released once the call finishes, so the next call runs again
+    assert single_flight.do("key", lambda: "again") == "again"
+
+
+def test_single_flight_shares_exceptions() -> None:
+    single_flight = SingleFlight()
+
+    def fail() -> None:
+        raise ValueError("lookup failed")
+
+    try:
+        single_flight.do("key", fail)
+    except ValueError as exc:
+        assert str(exc) == "lookup failed"
+    assert single_flight.do("key", lambda: "recovered") == "recovered"
+
+
+def test_medication_lookups_deduplicated_across_threads() -> None:
+    requested_urls: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        requested_urls.append(str(request.url))
+        # Keep the lookup in flight long enough for the other threads to join it
+        time.sleep(0.2)
+        return httpx.Response(200, json={"resourceType": "Medication", "id": "med-1", "code": {"text": "Aspirin"}})
+
+    client = httpx.Client(transport=httpx.MockTransport(handler))
+    entries: list[dict] = [
+        {
+            "resource": {
+                "resourceType": "MedicationRequest",
+                "id": f"mr-{i}",
+                "status": "active",
+                "intent": "order",
+                "subject": {"reference": "Patient/1"},
+                "medicationReference": {"reference": "Medication/med-1"},
+            }
+        }
+        for i in range(8)
+    ]
+    bundle: Bundle = Bundle.model_validate({"resourceType": "Bundle", "type": "searchset", "entry": entries})
+    saved_calls_before: int = medicationhelper.medication_lookups.saved_calls
+    cache_hits_before: int = medicationhelper.cached_medication_resources.hits
+
+    expanded_bundle: Bundle = expand_medication_references_in_bundle(client=client, input_bundle=bundle, base_url="https://example.org/fhir", query_headers={})
+
+    assert requested_urls == ["https://example.org/fhir/Medication/med-1"]
+    assert len(expanded_bundle.entry) == 8
+    assert all(entry.resource.medicationCodeableConcept.text == "Aspirin" for entry in expanded_bundle.entry)
+    # Entries picked up after the lookup finished are answered by the cache instead of the in-flight call
+    saved_calls: int = medicationhelper.medication_lookups.saved_calls - saved_calls_before
+    cache_hits: int = medicationhelper.cached_medication_resources.hits - cache_hits_before
+    assert saved_calls > 0
+    assert saved_calls + cache_hits == 7